@@ -21,6 +21,7 @@ import datetime
 import colorama
 import time
 import stat
+from types import MappingProxyType
 
 from dustcluster.util import setup_logger
 logger = setup_logger( __name__ )
@@ -30,6 +31,34 @@ class EC2Cloud(object):
     provides a connection to EC2 and generates a list of Node objects 
     '''
 
+    # filter expression keys that can be evaluated by describe_instances
+    server_filter_names = {
+                            'state'     : 'instance-state-name',
+                            'id'        : 'instance-id',
+                            'instance_id' : 'instance-id',
+                            'vpc'       : 'vpc-id',
+                            'vpc_id'    : 'vpc-id',
+                            'type'      : 'instance-type',
+                            'instance_type' : 'instance-type',
+                            'image'     : 'image-id',
+                            'image_id'  : 'image-id',
+                            'subnet_id' : 'subnet-id',
+                            'key'       : 'key-name',
+                            'key_name'  : 'key-name',
+                            'ip'        : 'ip-address',
+                            'public_ip_address'  : 'ip-address',
+                            'private_ip_address' : 'private-ip-address'
+                          }
+
+    # MaxResults per describe_instances page
+    page_size = 1000
+
+    # values per describe_instances filter
+    filter_values_max = 200
+
+    # max InstanceIds per start/stop/terminate/create_tags call
+    instance_ids_max = 200
+
     def __init__(self, name='', key='', region="", image="", username="", keyfile="", profile_name=""):
 
         if not region:
@@ -83,24 +112,202 @@ class EC2Cloud(object):
         resource = self.conn()
         return resource.meta.client
 
-    def refresh(self):
-        ''' get nodes/reservations from cloud '''
+    def new_client(self):
+        ''' an ec2 client on its own boto3 session, for use off the main thread '''
+
+        if self.profile_name:
+            session = boto3.Session(profile_name=self.profile_name)
+        else:
+            session = boto3.Session(region_name=self.region)
+        return session.client('ec2', region_name=self.region)
+
+    def refresh(self, filters=None, instance_ids=None, client=None):
+        '''
+        get nodes/reservations from cloud, optionally filtered server side or just for instance_ids.
+        client defaults to the shared one, pass new_client() when calling from another thread.
+        '''
+
+        if instance_ids:
+            logger.debug('hydrating from cloud nodes %s' % instance_ids)
+            records = []
+            for i in range(0, len(instance_ids), self.filter_values_max):
+                chunk = instance_ids[i:i + self.filter_values_max]
+                id_filters = [ { 'Name' : 'instance-id', 'Values' : chunk } ]
+                records.extend( NodeRecord(instance_data) for instance_data in self._get_instances(id_filters, client) )
+
+            return self.nodes_from_records(records)
+
+        if filters:
+            logger.debug('hydrating from cloud nodes matching %s' % filters)
+        else:
+            logger.debug('hydrating from all cloud nodes')
+
+        records = [NodeRecord(instance_data) for instance_data in self._get_instances(filters, client)]
 
-        logger.debug('hydrating from all cloud nodes')
+        return self.nodes_from_records(records)
 
-        vms = self._get_instances()
+    def nodes_from_records(self, records):
+        ''' EC2Node objects for NodeRecords from the cloud or from a snapshot '''
 
         all_nodes = []
-        for vm in vms:
+        for record in records:
             node = EC2Node(username=self.username, cloud=self)
-            node.hydrate(vm)
+            node.hydrate(record)
             all_nodes.append(node)
         return all_nodes
 
-    def _get_instances(self, iids=None):
-        ret = []
-        instances = self.conn().instances.all()
-        return instances
+    def _get_instances(self, filters=None, client=None):
+        ''' iterate over the raw instance data in all pages of describe_instances '''
+
+        kwargs = { 'PaginationConfig' : { 'PageSize' : self.page_size } }
+        if filters:
+            kwargs['Filters'] = filters
+
+        paginator = (client or self.client()).get_paginator('describe_instances')
+        for page in paginator.paginate(**kwargs):
+            for reservation in page.get('Reservations') or []:
+                for instance_data in reservation.get('Instances') or []:
+                    yield instance_data
+
+    def start_nodes(self, nodes):
+        '''
+        restart stopped nodes with batched start_instances calls
+        returns { instance_id : (previous state, current state) }
+        '''
+
+        nodes = [node for node in nodes if node.vm and node.state == 'stopped']
+        return self._change_state('start_instances', 'StartingInstances', nodes)
+
+    def stop_nodes(self, nodes):
+        ''' stop nodes with batched stop_instances calls, returns { instance_id : (previous state, current state) } '''
+
+        nodes = [node for node in nodes if node.vm and node.state not in ('stopped', 'terminated')]
+        return self._change_state('stop_instances', 'StoppingInstances', nodes)
+
+    def terminate_nodes(self, nodes):
+        '''
+        rename nodes to name_terminated and terminate them with batched calls
+        returns { instance_id : (previous state, current state) }
+        '''
+
+        nodes = [node for node in nodes if node.vm and node.state != 'terminated']
+
+        # create_tags sets one value on all its resources, so one call per distinct new name
+        renames = {}
+        for node in nodes:
+            name = node.tags.get('Name')
+            if name:
+                renames.setdefault(name + '_terminated', []).append(node.get('id'))
+
+        client = self.client()
+        for newname, instance_ids in renames.items():
+            for chunk in self._chunks(instance_ids):
+                client.create_tags( Resources=chunk, Tags= [ { 'Key': 'Name', 'Value' : newname } ] )
+
+        return self._change_state('terminate_instances', 'TerminatingInstances', nodes)
+
+    def _chunks(self, instance_ids):
+        for i in range(0, len(instance_ids), self.instance_ids_max):
+            yield instance_ids[i:i + self.instance_ids_max]
+
+    def _change_state(self, api, response_key, nodes):
+        '''
+        call a start/stop/terminate api with chunks of instance ids.
+        EC2 fails the whole call if one instance is in the wrong state, the instances
+        of a failed chunk are retried one at a time so the others still change state.
+        '''
+
+        results = {}
+        if not nodes:
+            return results
+
+        api_call = getattr(self.client(), api)
+        instance_ids = [node.get('id') for node in nodes]
+
+        for chunk in self._chunks(instance_ids):
+
+            logger.debug('%s for %d instances' % (api, len(chunk)))
+            try:
+                response = api_call(InstanceIds=chunk)
+                results.update( self._state_changes(response, response_key) )
+                continue
+            except ClientError as ex:
+                if len(chunk) == 1:
+                    results[chunk[0]] = ('', 'error: %s' % ex.response['Error']['Message'])
+                    continue
+                logger.debug('%s failed for a batch, retrying one at a time : %s' % (api, ex))
+
+            for instance_id in chunk:
+                try:
+                    response = api_call(InstanceIds=[instance_id])
+                    results.update( self._state_changes(response, response_key) )
+                except ClientError as ex:
+                    results[instance_id] = ('', 'error: %s' % ex.response['Error']['Message'])
+
+        return results
+
+    @staticmethod
+    def _state_changes(response, response_key):
+
+        ret = {}
+        for change in response.get(response_key) or []:
+            ret[change['InstanceId']] = (change['PreviousState']['Name'], change['CurrentState']['Name'])
+        return ret
+
+    def server_filters(self, target_str):
+        '''
+        translate a filter expression into describe_instances Filters
+        returns None if the expression cannot be evaluated by EC2
+
+        A comma separated list is an OR, so all terms must use the same key.
+        e.g. state=running, state=running,state=stopped, tags=env:prod, vpc=vpc-123*
+        Note that EC2 matches tag keys and values case sensitively.
+        '''
+
+        if not target_str or target_str.strip() == '*':
+            return None
+
+        filter_name = None
+        values = []
+        for filter_exp in target_str.split(","):
+
+            parts = filter_exp.split("=")
+            if len(parts) != 2:
+                return None
+
+            filterkey, filterval = parts[0].strip().lower(), parts[1].strip()
+            if not filterval or '[' in filterval:
+                return None
+
+            if filterkey == 'tags':
+                pos = filterval.rfind(':')
+                if pos <= 0:
+                    return None
+                tagkey, tagval = filterval[:pos], filterval[pos+1:]
+                if tagkey[0] == '"' and tagkey[-1] == '"':
+                    tagkey = tagkey[1:-1]
+                if not tagkey or '*' in tagkey or '?' in tagkey:
+                    return None
+
+                if tagval in ('', '*'):
+                    name, value = 'tag-key', tagkey
+                else:
+                    name, value = 'tag:%s' % tagkey, tagval
+            else:
+                name = self.server_filter_names.get(filterkey)
+                if not name:
+                    return None
+                value = filterval
+                if name in ('instance-state-name', 'instance-id', 'instance-type'):
+                    value = value.lower()
+
+            if filter_name and filter_name != name:
+                return None
+
+            filter_name = name
+            values.append(value)
+
+        return [ { 'Name' : filter_name, 'Values' : values } ]
 
     def create_absent_node(self, nodename, **kwargs):
         node = EC2Node(nodename=nodename, **kwargs)
@@ -174,11 +381,114 @@ class EC2Cloud(object):
 
 
 
+class NodeRecord(object):
+    '''
+    flat snapshot of one instance from the raw describe_instances response.
+    attribute names match the boto3 ec2.Instance attributes, and every field is resolved 
+    once here so reading a node never calls the cloud.
+    '''
+
+    # attribute : describe_instances key
+    instance_keys = (
+                ('ami_launch_index',        'AmiLaunchIndex'),
+                ('architecture',            'Architecture'),
+                ('block_device_mappings',   'BlockDeviceMappings'),
+                ('client_token',            'ClientToken'),
+                ('ebs_optimized',           'EbsOptimized'),
+                ('elastic_gpu_associations','ElasticGpuAssociations'),
+                ('ena_support',             'EnaSupport'),
+                ('hypervisor',              'Hypervisor'),
+                ('iam_instance_profile',    'IamInstanceProfile'),
+                ('id',                      'InstanceId'),
+                ('image_id',                'ImageId'),
+                ('instance_id',             'InstanceId'),
+                ('instance_lifecycle',      'InstanceLifecycle'),
+                ('instance_type',           'InstanceType'),
+                ('kernel_id',               'KernelId'),
+                ('key_name',                'KeyName'),
+                ('launch_time',             'LaunchTime'),
+                ('monitoring',              'Monitoring'),
+                ('placement',               'Placement'),
+                ('platform',                'Platform'),
+                ('private_dns_name',        'PrivateDnsName'),
+                ('private_ip_address',      'PrivateIpAddress'),
+                ('product_codes',           'ProductCodes'),
+                ('public_dns_name',         'PublicDnsName'),
+                ('public_ip_address',       'PublicIpAddress'),
+                ('ramdisk_id',              'RamdiskId'),
+                ('root_device_name',        'RootDeviceName'),
+                ('security_groups',         'SecurityGroups'),
+                ('sriov_net_support',       'SriovNetSupport'),
+                ('state',                   'State'),
+                ('state_reason',            'StateReason'),
+                ('state_transition_reason', 'StateTransitionReason'),
+                ('subnet_id',               'SubnetId'),
+                ('tags',                    'Tags'),
+                ('virtualization_type',     'VirtualizationType'),
+                ('vpc_id',                  'VpcId')
+            )
+
+    # the boto3 resource returns sub-resources for these, we keep their ids
+    derived_keys = ('network_interfaces', 'placement_group', 'volumes')
+
+    __slots__ = tuple(attr for attr, _ in instance_keys) + derived_keys
+
+    def __init__(self, instance_data):
+
+        for attr, key in self.instance_keys:
+            setattr(self, attr, instance_data.get(key))
+
+        self.network_interfaces = [ eni.get('NetworkInterfaceId') for eni in instance_data.get('NetworkInterfaces') or [] ]
+        self.placement_group = (self.placement or {}).get('GroupName') or None
+        self.volumes = [ bdm['Ebs'].get('VolumeId') for bdm in self.block_device_mappings or [] if bdm.get('Ebs') ]
+
+    def to_dict(self):
+        ''' non empty fields, for the inventory snapshot '''
+        return dict( (attr, getattr(self, attr)) for attr in self.__slots__ if getattr(self, attr) )
+
+    @classmethod
+    def from_dict(cls, fields):
+        ''' inverse of to_dict '''
+
+        record = cls.__new__(cls)
+        for attr in cls.__slots__:
+            setattr(record, attr, fields.get(attr))
+        return record
+
+
 class EC2Node(object):
     '''
     describe and control EC2 nodes within an EC2 cloud
     '''
 
+    friendly_names = { 
+                        'image'    : 'image_id', 
+                        'dns_name' : 'public_dns_name', 
+                        'type'     : 'instance_type',
+                        'key'      : 'key_name',
+                        'vpc'      : 'vpc_id',
+                        'subnet'   : 'subnet_id',
+                        'ip'       : 'public_ip_address'
+                       }
+
+    extended_fields = [ 'dns_name', 'image', 'tags', 'key', 'launch_time', 
+                        'username', 'groups', 'state', 'login']
+
+    all_fields = ['ami_launch_index', 'architecture', 'block_device_mappings',
+                 'client_token', 'ebs_optimized', 'elastic_gpu_associations', 
+                 'ena_support', 'hypervisor', 'iam_instance_profile', 'id', 'image', 'image_id',
+                  'instance_id', 'instance_lifecycle', 'instance_type', 'kernel_id', 'launch_time', 
+                  'monitoring', 'network_interfaces', 'placement', 'placement_group', 'platform', 
+                  'private_dns_name', 'private_ip_address', 'product_codes', 'public_dns_name', 'public_ip_address', 
+                  'ramdisk_id', 'root_device_name', 'security_groups', 'sriov_net_support', 'state', 'state_reason',
+                   'state_transition_reason', 'subnet', 'subnet_id', 'tags', 'virtualization_type', 'volumes', 
+                   'vpc', 'vpc_id']
+
+    non_instance_fields = ['name', 'username', 'cluster', 'keyfile', 'key', 'tags', 'groups', 'state', 'index', 'login']
+
+    # shared by all untagged and absent nodes
+    no_tags = MappingProxyType({})
+
     def __init__(self, key="", keyfile="", nodename="", instance_type="", image="",  username='', vm=None, cloud=None):
 
         self._key = key
@@ -192,48 +502,36 @@ class EC2Node(object):
 
         self._hydrated = False
 
+        self._tags = self.no_tags
+        self._lower_tags = self.no_tags
+
         self.login_rule = {}
         self.index = None
 
         # for starting new nodes
         self._clustername = None
 
-        self.friendly_names = { 
-                                'image'    : 'image_id', 
-                                'dns_name' : 'public_dns_name', 
-                                'type'     : 'instance_type',
-                                'key'      : 'key_name',
-                                'vpc'      : 'vpc_id',
-                                'ip'       : 'ip_address'
-                               }
-
-        self.extended_fields = [ 'dns_name', 'image', 'tags', 'key', 'launch_time', 
-                                'username', 'groups', 'state', 'login']
-
-        self.all_fields = ['ami_launch_index', 'architecture', 'block_device_mappings', 'classic_address',
-                     'client_token', 'console_output', 'ebs_optimized', 'elastic_gpu_associations', 
-                     'ena_support', 'hypervisor', 'iam_instance_profile', 'id', 'image', 'image_id',
-                      'instance_id', 'instance_lifecycle', 'instance_type', 'kernel_id', 'launch_time', 
-                      'monitoring', 'network_interfaces', 'placement', 'placement_group', 'platform', 
-                      'private_dns_name', 'private_ip_address', 'product_codes', 'public_dns_name', 'public_ip_address', 
-                      'ramdisk_id', 'root_device_name', 'security_groups', 'sriov_net_support', 'state', 'state_reason',
-                       'state_transition_reason', 'subnet', 'subnet_id', 'tags', 'virtualization_type', 'volumes', 
-                       'vpc', 'vpc_addresses', 'vpc_id']
-
-        self.non_instance_fields = ['name', 'username', 'cluster', 'keyfile', 'key', 'tags', 'groups', 'state', 'index', 'login']
-
     def __repr__(self):
         data = self.disp_data()
         return ",".join(str(datum) for datum in data)
 
     def hydrate(self, vm):
-        ''' populate template node state from the cloud reservation ''' 
+        ''' populate template node state from a NodeRecord ''' 
         self._name      = ""
         self._image     = vm.image_id
         self._instance_type     = vm.instance_type
         self._vm = vm
         self._hydrated = True
 
+        # parse tags once per hydrate, filters and search use the lowercase view
+        if vm.tags:
+            tags = dict( (tagitem.get('Key'), tagitem.get('Value')) for tagitem in vm.tags )
+            self._tags = MappingProxyType(tags)
+            self._lower_tags = MappingProxyType( dict( (k.lower(), (v or "").lower()) for k, v in tags.items() ) )
+        else:
+            self._tags = self.no_tags
+            self._lower_tags = self.no_tags
+
     @property
     def hydrated(self):
         return self._hydrated
@@ -288,13 +586,13 @@ class EC2Node(object):
 
     @property
     def tags(self):
-        if self._vm and self._vm.tags:
-            ret = {}
-            for tagitem in self._vm.tags:
-                ret[ tagitem.get('Key') ] = tagitem.get('Value')
-            return ret
-        else:
-            return {}
+        ''' read only { key : value } tags, parsed on hydrate '''
+        return self._tags
+
+    @property
+    def lower_tags(self):
+        ''' read only { lowercase key : lowercase value } tags, parsed on hydrate '''
+        return self._lower_tags
 
     @property
     def state(self):
@@ -306,7 +604,7 @@ class EC2Node(object):
     @property
     def groups(self):
         if self._vm:
-            return [ "(name=%s id=%s) " % ( grp.get('GroupName'),grp.get('GroupId') ) for grp in self._vm.security_groups ] 
+            return [ "(name=%s id=%s) " % ( grp.get('GroupName'),grp.get('GroupId') ) for grp in self._vm.security_groups or [] ] 
         return []
 
     @property
@@ -322,14 +620,12 @@ class EC2Node(object):
 
         vm = self._vm
         if vm:
-            if self.state == 'running' or self.state == 'pending':
-                logger.info( "Nothing to do for node [%s]" % self._name )
-                return
-
             if self.state == 'stopped':
-                logger.info( 'restarting node %s : %s' % (self._name, self) )
-                self.vm.start()
-                return
+                logger.info( 'restarting node %s : %s' % (self.name, self) )
+                self.cloud.start_nodes([self])
+            else:
+                logger.info( "Nothing to do for node [%s]" % self.name )
+            return
 
         logger.info( 'creating instance name=[%s] image=[%s] instance=[%s]'
                         % (self._name, self._image, self._instance_type) )
@@ -338,31 +634,17 @@ class EC2Node(object):
 
     def stop(self):
 
-        vm = self._vm
-        if vm:
-            if self.state == 'stopped':
-                return 
-            else:
-                logger.info('stopping %s' % self._name)
-                vm.stop()
+        if self._vm:
+            logger.info('stopping %s' % self.name)
+            self.cloud.stop_nodes([self])
         else:
             logger.error('no vm that matches node defination for %s' %  self._name)
 
     def terminate(self):
 
         if self._vm:
-            tags = self.tags
-            newname = ''
-            if tags and tags.get('Name'):
-                newname = tags['Name'] + '_terminated'
-                self._vm.create_tags( Tags= [ { 'Key': 'Name', 'Value' : newname } ] )
-
-            instance_ids = [self._vm.id]
-
-            logger.info('terminating %s id=[%s]' % (self._name, self._vm.id))
-
-            self._vm.stop()
-            self._vm.terminate()
+            logger.info('terminating %s id=[%s]' % (self.name, self._vm.id))
+            self.cloud.terminate_nodes([self])
 
     def disp_headers(self):
         headers = ["@",    "Name", "Type", "State", "ID",  "IP", "int_IP"]
@@ -15,12 +15,11 @@ Cluster command engine
 '''
 
 import time
-import re
-import fnmatch
 import os
 import yaml
 import colorama
 import sys
+import threading
 
 from copy import deepcopy
 
@@ -28,6 +27,8 @@ from dustcluster.lineterm import LineTerm
 from pkgutil import walk_packages
 from dustcluster import commands
 from dustcluster.config import DustConfig
+from dustcluster.filterexp import FilterTerm, NodeIndex, compile_target
+from dustcluster.inventory import Inventory, InventoryStore
 
 from dustcluster.util import setup_logger
 logger = setup_logger( __name__ )
@@ -62,10 +63,11 @@ class ClusterCommandEngine(object):
     def __init__(self):
 
         self.cloud = None
-        self.nodecache = dict() # invalidated on load template/start/stop/terminate/etc
+        self.nodecache = dict() # { region : Inventory }, invalidated on load template/start/stop/terminate/etc
         self.region = None
 
         self.config = DustConfig()
+        self.inventory_store = InventoryStore(self.config.get_cache_dir())
 
         self.cur_cluster = ""
         self.provider_cache = {}
@@ -77,11 +79,158 @@ class ClusterCommandEngine(object):
         self._commands = {}
         self.command_state = CommandState()
         self.lineterm = LineTerm()
+        self.lineterm.configure(ssh_concurrency=self.config.get_setting('ssh-concurrency', 32),
+                                buffer_max=self.config.get_setting('ssh-buffer-max', None),
+                                max_sessions=self.config.get_setting('ssh-max-sessions', None),
+                                max_idle=self.config.get_setting('ssh-max-idle', None),
+                                window_size=self.config.get_setting('sftp-window-size', None),
+                                max_packet_size=self.config.get_setting('sftp-max-packet-size', None),
+                                compression=self.config.get_setting('ssh-compression', None),
+                                sftp_stripes=self.config.get_setting('sftp-stripes', None),
+                                stripe_transports=self.config.get_setting('sftp-stripe-transports', None),
+                                stripe_min_size=self.config.get_setting('sftp-stripe-min-size', None))
+
+        self.warm_start()
 
     def invalidate_cache(self):
 
-        if self.nodecache.get(self.cloud.region):
-            del self.nodecache[self.cloud.region]
+        self.nodecache.pop(self.cloud.region, None)
+        self.inventory_store.remove(self.cloud.region)
+
+    def get_cache_ttl(self):
+        ''' seconds before a cached inventory is revalidated, from user_data inventory-cache-ttl '''
+        return int(self.config.get_setting('inventory-cache-ttl', 600))
+
+    def warm_start(self):
+        ''' 
+        load the current region's inventory snapshot from the last session so the first command 
+        does not wait on the cloud provider. expired snapshots are revalidated in the background.
+        '''
+
+        if not self.cloud or self.cloud.region in self.nodecache:
+            return
+
+        inventory = self.inventory_store.read(self.cloud.region, self.cloud)
+        if not inventory:
+            return
+
+        logger.debug("loaded [%d] nodes from snapshot %s" % (len(inventory.nodes), self.inventory_store.path(self.cloud.region)))
+        self.nodecache[self.cloud.region] = inventory
+
+        if inventory.is_expired(self.get_cache_ttl()):
+            self._revalidate(inventory)
+
+    def _revalidate(self, inventory):
+        ''' refetch an expired inventory in a background thread, keep serving it until then '''
+
+        inventory.revalidating = True
+        thread = threading.Thread(target=self._revalidate_inventory, args=(inventory,))
+        thread.daemon = True
+        thread.start()
+
+    def _revalidate_inventory(self, stale):
+        ''' merge a full refetch into the stale inventory, so index numbers stay stable '''
+
+        try:
+            merges = stale.merges
+            cloud = self.get_cloud_provider_by_region('ec2', stale.region)
+            filters = None
+            if stale.scope:
+                filters = cloud.server_filters(stale.scope)
+
+            # boto3 sessions are not thread safe, dont share the provider's
+            nodes = cloud.refresh(filters, client=cloud.new_client())
+
+            # a refresh, invalidate or update while we were fetching wins
+            if self.nodecache.get(stale.region) is stale and stale.merges == merges:
+                stale.merge(nodes, prune=True)
+                stale.fetched = time.time()
+                stale.from_snapshot = False
+                self.inventory_store.write(stale)
+                self._prune_sessions(stale)
+                logger.debug("revalidated [%d] nodes in %s" % (len(nodes), stale.region))
+
+        except Exception as ex:
+            logger.debug("could not revalidate inventory for %s : %s" % (stale.region, ex))
+        finally:
+            stale.revalidating = False
+
+    def refresh(self, target_str=""):
+        '''
+        reload the node cache from the cloud provider.
+        if target_str is a simple filter expression (see EC2Cloud.server_filters) only matching
+        nodes are fetched and the cache is scoped to them until the next full refresh.
+        '''
+
+        self.invalidate_cache()
+
+        filters = None
+        if target_str and target_str.strip() != '*':
+            filters = self.cloud.server_filters(target_str)
+
+        if filters:
+            self._load_nodes(filters, scope=target_str.strip())
+        else:
+            self._load_nodes()
+
+    def update_nodes(self, instance_ids=None, filters=None):
+        '''
+        re-describe only the given instances, or the instances matching EC2 filters, and merge
+        them into the cached inventory after an operation on them. Index numbers stay stable.
+        Does nothing if there is no cached inventory, the next command will load everything.
+        '''
+
+        inventory = self.nodecache.get(self.cloud.region)
+        if not inventory or (not instance_ids and not filters):
+            return
+
+        if instance_ids:
+            nodes = self.cloud.refresh(instance_ids=list(instance_ids))
+        else:
+            nodes = self.cloud.refresh(filters)
+
+        inventory.merge(nodes)
+        logger.debug("updated [%d] nodes in cache" % len(nodes))
+        self._prune_sessions(inventory)
+
+        try:
+            self.inventory_store.write(inventory)
+        except Exception as ex:
+            logger.warning("Could not write inventory snapshot : %s" % ex)
+
+    def _load_nodes(self, filters=None, scope=""):
+        ''' fetch nodes from the cloud provider into the node cache and the snapshot '''
+
+        nodes = self.cloud.refresh(filters)
+
+        scope_str = ""
+        if scope:
+            scope_str = " matching [%s]" % scope
+
+        logger.info("Retrieved [%d] nodes%s %s%sfrom cloud provider%s" % (len(nodes), scope_str,
+                                                                colorama.Fore.GREEN, colorama.Style.BRIGHT, colorama.Style.RESET_ALL))
+
+        inventory = Inventory(self.cloud.region, nodes, scope=scope)
+        self.nodecache[self.cloud.region] = inventory
+        self._prune_sessions(inventory)
+
+        try:
+            self.inventory_store.write(inventory)
+        except Exception as ex:
+            logger.warning("Could not write inventory snapshot : %s" % ex)
+
+        return inventory
+
+    def _prune_sessions(self, inventory):
+        ''' close pooled ssh sessions to nodes that were terminated or no longer exist '''
+
+        live_ids = set(node.get('id') for node in inventory.nodes if node.state != 'terminated')
+        known_ids = None
+        if inventory.scope:
+            # a filtered inventory does not say anything about the nodes it left out
+            known_ids = set(node.get('id') for node in inventory.nodes)
+
+        self.lineterm.prune_sessions(inventory.region, live_ids, known_ids)
 
     def load_commands(self):
         '''
@@ -157,10 +306,8 @@ class ClusterCommandEngine(object):
 
         self.unload_cur_cluster()
 
-        if new_region != self.cloud.region:
-            self.invalidate_cache()
-
         self.init_cloud_provider(cloud_data)
+        self.warm_start()
 
         logger.info("Connected to %s " % self.region)
 
@@ -308,7 +455,12 @@ class ClusterCommandEngine(object):
             logger.debug("No nodes to show")
             return []
 
-        logger.info("Nodes in region: %s" % self.cloud.region)
+        inventory = self.nodecache.get(self.cloud.region)
+        inventory_str = ""
+        if inventory and inventory.describe():
+            inventory_str = " %s(%s)%s" % (colorama.Fore.YELLOW, inventory.describe(), colorama.Style.RESET_ALL)
+
+        logger.info("Nodes in region: %s%s" % (self.cloud.region, inventory_str))
 
         try:
             header_data, header_fmt = nodes[0].disp_headers()
@@ -359,94 +511,16 @@ class ClusterCommandEngine(object):
             print(colorama.Style.RESET_ALL)
 
 
-    def _filter_tags(self, tags, fkey, fval):
-
-        keyregex = fnmatch.translate(fkey)
-        keymatch = re.compile(keyregex)
-
-        valregex = fnmatch.translate(fval)
-        valmatch = re.compile(valregex)
-
-        # match tag keys, then vals
-        for tagkey, tagval in tags.items():
-            if keymatch.match(tagkey.lower()) and valmatch.match(tagval.lower()):
-                return True
-
-        return False
-
-
     def _filter(self, nodes, filterkey, filterval):
         '''
         filter a list of nodes by attribute values
         e.g. filterkey=state,  filterval=running
         '''
 
-        filtered = []
-
         if not filterkey:
             return nodes
 
-        filterkey = filterkey.lower()
-        filterval = filterval.lower()
-
-        if filterkey == "tags":
-
-            fkey = ""
-            fval = ""
-
-            pos = filterval.rfind(':')
-            if pos:
-                fval = filterval[pos+1:]
-                fkey = filterval[:pos]
-
-                if fkey[0] == '"' and fkey[-1] == '"':
-                    fkey = fkey[1:-1]
-
-            if not fkey and not fval:
-                logger.error("Bad filter. Use tags=key:value, wildcards allowed on key, value.")
-                return []
-
-            for node in nodes:
-                if self._filter_tags(node.get('tags'), fkey, fval):
-                    filtered.append(node)
-
-        else:
-
-            regex = fnmatch.translate(filterval.lower())
-            valid = re.compile(regex)
-
-            for node in nodes:
-                val =  node.get(filterkey)
-                if not val:
-                    continue
-                logger.debug("trying filter %s on %s..." % (filterval, val))
-                if not valid.match(str(val).lower()):
-                    continue
-                filtered.append(node)
-
-        return filtered
-
-    def _search(self, nodes, search_term):
-        '''
-        filter a list of nodes by search term
-        e.g. "running"
-        '''
-
-        results = set()
-        search_term = search_term.lower()
-
-        for node in nodes:
-            for val in node.get('tags').values():
-                if search_term in val.lower():
-                    results.add(node)
-                    break
-
-            for key in node.extended_fields + node.all_fields:
-                if search_term in str(node.get(key)).lower():
-                    results.add(node)
-                    break
-
-        return list(results)
+        return FilterTerm(filterkey, filterval).filter(nodes)
 
     def _find_matching_nodes(self, selector, cluster_nodes):
         ''' using node_props.selector, find the matching node in cluster_nodes ''' 
@@ -465,35 +539,57 @@ class ClusterCommandEngine(object):
 
         return matching_nodes
 
-    def _get_nodes_with_login_data(self):
-        ''' get all nodes matched to login rules '''
+    def _get_inventory(self):
+        ''' cached or freshly loaded inventory for the current region, with nodes matched to login rules and indexed '''
+
+        inventory = self.nodecache.get(self.cloud.region)
+        if inventory:
+            desc = inventory.describe()
+            if desc:
+                desc = " (%s)" % desc
+            logger.info("Retrieved [%d] nodes %s%sfrom cache%s%s" % (len(inventory.nodes),
+                                                                    colorama.Fore.GREEN, colorama.Style.BRIGHT, colorama.Style.RESET_ALL, desc))
 
-        nodecache_nodes = self.nodecache.get(self.cloud.region)
-        if nodecache_nodes:
-            logger.info("Retrieved [%d] nodes %s%sfrom cache%s" % (len(nodecache_nodes),
-                                                                    colorama.Fore.GREEN, colorama.Style.BRIGHT, colorama.Style.RESET_ALL))
-            nodes = nodecache_nodes
+            if not inventory.revalidating and inventory.is_expired(self.get_cache_ttl()):
+                self._revalidate(inventory)
         else:
-            nodes = self.cloud.refresh()
-            logger.info("Retrieved [%d] nodes %s%sfrom cloud provider%s" % (len(nodes), 
-                                                                    colorama.Fore.GREEN, colorama.Style.BRIGHT, colorama.Style.RESET_ALL))
-            self.nodecache[self.cloud.region] = nodes
+            inventory = self._load_nodes()
 
-        self._match_nodes_to_login_rules(nodes)
-        ret_nodes = sorted(nodes, key =lambda x: (x.cluster or '', x.get('vpc') or ''))
-        for i in range( len(ret_nodes) ):
-            ret_nodes[i].index = str(i + 1)
-        return ret_nodes
+        matched = self._match_nodes_to_login_rules(inventory.nodes)
+
+        # number nodes once per load, grouped by cluster and vpc. after that numbers are stable
+        if not inventory.numbered:
+            ret_nodes = sorted(inventory.nodes, key =lambda x: (x.cluster or '', x.get('vpc') or ''))
+            for i in range( len(ret_nodes) ):
+                ret_nodes[i].index = str(i + 1)
+            inventory.nodes = ret_nodes
+            inventory.numbered = True
+            inventory.node_index = None
+
+        # cluster membership is indexed, so reindex if it changed
+        if matched or not inventory.node_index:
+            inventory.node_index = NodeIndex(inventory.nodes)
+
+        return inventory
 
     def _match_nodes_to_login_rules(self, nodes):
+        ''' match unassigned nodes to login rules, returns the number of newly matched nodes '''
 
+        unmatched = [node for node in nodes if not node.login_rule]
+        if not unmatched:
+            return 0
+
+        count = 0
         for rule in self.config.get_login_rules():
             selector = rule.get('selector')
-            matched_nodes = self._find_matching_nodes(selector, nodes)
+            matched_nodes = self._find_matching_nodes(selector, unmatched)
             for node in matched_nodes:
                 if not node.login_rule:         # to maintain rule precedence, dont rematch
                     node.login_rule = rule
                     node.cluster = rule.get('member-of')
+                    count += 1
+
+        return count
 
     def resolve_target_nodes(self, search=False, target_node_name=""):
         '''
@@ -503,7 +599,9 @@ class ClusterCommandEngine(object):
         if not self.cloud:
             raise Exception('Internal error: No cloud provider loaded.')
 
-        cluster_nodes = self._get_nodes_with_login_data()
+        inventory = self._get_inventory()
+        cluster_nodes = inventory.nodes
+        node_index = inventory.node_index
 
         # working set
         if self.cur_cluster:
@@ -518,35 +616,23 @@ class ClusterCommandEngine(object):
         if target_node_name == '*' or not target_node_name:
             return cluster_nodes
 
-        filtered_nodes = set()
-        for filter_exp in target_node_name.split(","):
-            if '=' in filter_exp:
-                parts = filter_exp.split("=")
-                if len(parts) != 2:
-                    str_err = "Filter format error. Should be key=value for node properties or tags=key:value for tags. Use quotes if needed."
-                    raise Exception("%s%s%s" %(colorama.Fore.RED, str_err, colorama.Style.RESET_ALL))
-                filterkey, filterval  = parts
-            elif filter_exp in self.clusters:
-                filterkey, filterval = 'cluster', filter_exp    
-            else:
-                filterkey, filterval = 'name', filter_exp
-                if self.is_numeric(filter_exp):
-                    filterkey = 'index'
-
-            if filterkey and filterval:
-                target_nodes  = list(self._filter(cluster_nodes, filterkey, filterval))
-                filtered_nodes.update(target_nodes)
+        plan = compile_target(target_node_name, frozenset(self.clusters or ()))
+
+        filtered_nodes = plan.select(cluster_nodes, node_index)
 
         if search and not filtered_nodes:
-            for search_term in target_node_name.split(","):
-                filtered_nodes.update( self._search(cluster_nodes, search_term))
+            filtered_nodes = plan.search(cluster_nodes, node_index)
+
+        # index lookups cover the whole region
+        if self.cur_cluster:
+            filtered_nodes = [node for node in filtered_nodes if node.cluster == self.cur_cluster]
 
         if not filtered_nodes:
             logger.info( "no nodes found that match filter %s" % (target_node_name) )
         else:
             logger.debug( "resolved target string [%s] to %s nodes" % (target_node_name, len(filtered_nodes)) )
 
-        return sorted( list(filtered_nodes), key=lambda x: x.index )
+        return sorted( filtered_nodes, key=lambda x: int(x.index) )
 
 
     def running_nodes_from_target(self, target_str):
@@ -581,10 +667,3 @@ class ClusterCommandEngine(object):
 
     def logout(self):
         self.lineterm.shutdown()
-
-    def is_numeric(self, s):
-        try:
-            int(s)
-            return True
-        except ValueError:
-            return False
@@ -14,6 +14,9 @@ import yaml
 import os
 import colorama
 
+from dustcluster.util import compact_hostlist
+from dustcluster.transfer import host_labels
+
 '''
 dust command for invoking ssh operations on a set of nodes, or entering a raw ssh shell to a single node 
 '''
@@ -21,30 +24,53 @@ dust command for invoking ssh operations on a set of nodes, or entering a raw ss
 # export commands
 commands  = ['atssh']
 
+# switches before the filter, e.g. @-x worker* uptime
+atssh_switches = 'xa'
+
 # @target cmd - line bufferred and raw mode ssh
 
 def atssh(cmdline, cluster, logger):
     '''
-    @[filter] [cmd]     - ssh command or ssh shell.  see help atssh.
+    @[-x|-a] [filter] [cmd]  - ssh command or ssh shell.  see help atssh.
 
     @filter cmd         - execute cmd on target nodes
     @ cmd               - execute on all running nodes
     @filter             - @filter with no command drops to a shell
+    @-x filter cmd      - run cmd non-interactively, wait for it to exit on all nodes
+    @-a filter cmd      - as -x, but print each distinct output once with the nodes that produced it
 
     Arguments:
     cmd         --- Shell command to invoke on the nodes via ssh
     filter      --- A node name or filter expression
+    -x          --- exec mode: each command runs on its own exec channel without a pty,
+                    output is shown per node with its exit status once all nodes finish
+    -a          --- aggregate: exec mode with identical outputs grouped, e.g. worker[1-40,42]
 
     @[filter] [cmd] and @[nodename] use the same interactive shell.
+    Nodes are logged into in parallel, ssh-concurrency (in user_data, default 32) at a time.
+    Output over ssh-buffer-max bytes (default 4MB) per node pauses the interactive shell until it
+    is written out, in exec mode the full output is saved to a temp file and the path is shown.
 
     Example:
     @worker* restart service xyz
     @master sudo apt-get install xyz
     @ tail /etc/resolve.conf
+    @-x worker* df -h /
+    @-a worker* cat /etc/issue
     '''
     is_error = False
 
     try:
+        switches, cmdline = _parse_switches(cmdline)
+        unknown = switches - set(atssh_switches)
+        if unknown:
+            logger.error("unknown switch -%s. see help atssh" % "".join(sorted(unknown)))
+            return
+
+        if not cmdline:
+            logger.error("@[-x|-a] [filter] [cmd]  - see help atssh")
+            return
+
         target = cmdline.split()[0]
 
         target_nodes = cluster.running_nodes_from_target(target)
@@ -70,11 +96,26 @@ def atssh(cmdline, cluster, logger):
 
         if sshcmd:
             logger.info( 'running [%s] over ssh on nodes: %s' % (sshcmd,  str([node.name for node in target_nodes])) )
+            targets = []
             for node in target_nodes:
                 keyfile = _get_key_file(node, cluster, logger)
                 if keyfile:
-                    cluster.lineterm.command(keyfile, node, sshcmd)
+                    targets.append((keyfile, node))
+
+            if 'a' in switches:
+                results = cluster.lineterm.exec_all(targets, sshcmd)
+                show_aggregated(results, logger)
+            elif 'x' in switches:
+                results = cluster.lineterm.exec_all(targets, sshcmd)
+                show_results(results, logger)
+            else:
+                timings = cluster.lineterm.command_all(targets, sshcmd)
+                _log_timings(timings, logger)
         else:
+            if switches:
+                logger.error("-%s needs a command. see help atssh" % "".join(sorted(switches)))
+                return
+
             if len(target_nodes) > 1: 
                 logger.info( 'Raw shell support is for single host targets only. See help atssh' )
                 return
@@ -91,6 +132,113 @@ def atssh(cmdline, cluster, logger):
         logger.info('ok')
 
 
+def _parse_switches(cmdline):
+    ''' split leading switches (-x, -xa) off the cmdline, returns (set of switch chars, rest) '''
+
+    switches = set()
+    rest = cmdline.strip()
+    while rest.startswith('-'):
+        parts = rest.split(None, 1)
+        switches.update(parts[0][1:])
+        rest = parts[1] if len(parts) > 1 else ''
+
+    return switches, rest
+
+
+def show_results(results, logger):
+    ''' print the output of an exec mode command per node, then a summary of exit codes '''
+
+    for result in results:
+        prefix = "%s%s[%s]%s " % (colorama.Style.BRIGHT, colorama.Fore.WHITE, result.node.name, colorama.Style.RESET_ALL)
+        if result.error:
+            print("%s%serror: %s%s" % (prefix, colorama.Fore.RED, result.error, colorama.Style.RESET_ALL))
+            continue
+
+        for line in result.stdout.splitlines():
+            print(prefix + line)
+        for line in result.stderr.splitlines():
+            print("%s%s%s%s" % (prefix, colorama.Fore.RED, line, colorama.Style.RESET_ALL))
+        if result.truncated:
+            print("%s%s%s%s" % (prefix, colorama.Fore.YELLOW, truncated_note(result), colorama.Style.RESET_ALL))
+        if result.exit_status:
+            print("%s%sexit status %s%s" % (prefix, colorama.Fore.RED, result.exit_status, colorama.Style.RESET_ALL))
+
+    logger.info(exit_summary(results))
+
+
+def show_aggregated(results, logger):
+    ''' print each distinct (output, exit status) once, headed by the compacted list of nodes that produced it '''
+
+    # node names are not unique, label each host so the counts in a header add up
+    labels = dict( zip( (id(result) for result in results), host_labels([result.node for result in results]) ) )
+
+    groups = {}     # { digest : [results] }
+    for result in results:
+        groups.setdefault(result.digest, []).append(result)
+
+    # most common output first
+    for group in sorted(groups.values(), key=lambda g: -len(g)):
+        first = group[0]
+        hosts = compact_hostlist([labels[id(result)] for result in group])
+        status = "error" if first.error else "exit %s" % first.exit_status
+
+        print("%s%s%s" % (colorama.Style.BRIGHT, "-" * 40, colorama.Style.RESET_ALL))
+        print("%s%s%s (%d) %s%s" % (colorama.Style.BRIGHT, colorama.Fore.WHITE, hosts, len(group), status, colorama.Style.RESET_ALL))
+        print("%s%s%s" % (colorama.Style.BRIGHT, "-" * 40, colorama.Style.RESET_ALL))
+
+        if first.error:
+            print("%s%s%s" % (colorama.Fore.RED, first.error, colorama.Style.RESET_ALL))
+            continue
+        if first.stdout:
+            print(first.stdout.rstrip('\n'))
+        if first.stderr:
+            print("%s%s%s" % (colorama.Fore.RED, first.stderr.rstrip('\n'), colorama.Style.RESET_ALL))
+        if first.truncated:
+            print("%s%s%s" % (colorama.Fore.YELLOW, truncated_note(first), colorama.Style.RESET_ALL))
+
+    logger.info("%s, %d distinct outputs" % (exit_summary(results), len(groups)))
+
+
+def truncated_note(result):
+    ''' where the full output went for output over ssh-buffer-max '''
+
+    ret = []
+    if result.stdout_file:
+        ret.append("output truncated, all %d bytes in %s" % (result.stdout_size, result.stdout_file))
+    if result.stderr_file:
+        ret.append("stderr truncated, all %d bytes in %s" % (result.stderr_size, result.stderr_file))
+    return ", ".join(ret)
+
+
+def exit_summary(results):
+    ''' e.g. 3 nodes in 1.20s : exit 0 on 2, exit 1 on 1 '''
+
+    counts = {}
+    for result in results:
+        key = 'error' if result.error else 'exit %s' % result.exit_status
+        counts[key] = counts.get(key, 0) + 1
+
+    elapsed = max([result.elapsed for result in results] or [0])
+    summary = ", ".join("%s on %d" % (key, counts[key]) for key in sorted(counts))
+
+    return "%d nodes in %.2fs : %s" % (len(results), elapsed, summary)
+
+
+def _log_timings(timings, logger):
+    ''' one line summary of per host connect and dispatch latency '''
+
+    connected = [t for t in timings if not t.error]
+    errors = len(timings) - len(connected)
+    if not connected:
+        return
+
+    slowest = max(connected, key=lambda t: t.connect)
+    total = max(t.total for t in connected)
+    logger.info( 'dispatched to %d nodes in %.2fs, slowest connect %.2fs [%s]%s' %
+                    (len(connected), total, slowest.connect, slowest.node.name,
+                     ', %d errors' % errors if errors else '') )
+
+
 def _get_key_file(node, cluster, logger):
     '''
     if node has a keyfile property return it, else find a mapped key 
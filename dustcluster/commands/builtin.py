@@ -23,8 +23,9 @@ def show(cmdline, cluster, logger):
     show  [-vv] [filter | search_term]  - show all nodes or filtered nodes
 
     List node data from in memory cache. If filter does not match a node index,
-    cluster name, node name, or EC2 attribute key=value expression then search
-    all attributes and tags.
+    cluster name, node name, IP address, or EC2 attribute key=value expression then
+    search all attributes, tag keys and tag values. A search term with * or ? is a
+    glob matched against each attribute or tag on its own.
 
     Use $refresh to update cache.  
     Shows only nodes selected by the use command, if it was invoked earlier.
@@ -36,9 +37,11 @@ def show(cmdline, cluster, logger):
     show 1,3,4                   # filter_exp matches index numbers
     show worker[3-15]            # filter_exp matchs node names
     show launch_time=2017-10*    # filter_exp matches EC2 attribute 
-    show 192.168.0.1             # no filter_exp match, use as search term 
+    show 192.168.0.1             # filter_exp matches public or private ip
+    show 192.168                 # no filter_exp match, use as search term
     show state=running           # filter_exp matches 
     show running                 # search term matches
+    show prod-*-db               # search term glob matches a name or tag
 
     '''
 
@@ -79,9 +82,23 @@ def refresh(cmdline, cluster, logger):
     refresh [filter]  - refresh from cloud and call show with filter
 
     Note that some operations (start/stop/etc) cause a refresh to occur on the next show.
+
+    Simple filters on state, id, vpc, type, image, subnet_id, key, ip or tags are evaluated 
+    by EC2, and only the matching nodes are fetched and cached until the next refresh.
+    EC2 matches tags case sensitively.
+
+    The node cache is saved to ~/.dustcluster/[profile]/cache and reused on startup. 
+    Once older than inventory-cache-ttl seconds (in user_data, default 600) it is 
+    shown as stale and revalidated in the background.
+
+    Example:
+    refresh                      # fetch all nodes in the region
+    refresh state=running        # fetch only running nodes
+    refresh tags=env:prod        
+    refresh state=running,state=pending
     '''
 
-    cluster.invalidate_cache()
+    cluster.refresh(cmdline)
     _show(cmdline, cluster, logger, False)
 
 def start(cmdline, cluster, logger):
@@ -113,9 +130,15 @@ def start(cmdline, cluster, logger):
             logger.info('no target nodes to operate on')
             return
 
+        launched = False
         for node in target_nodes:
 
-            if not node.hydrated and not node.key:
+            if node.hydrated:
+                continue
+
+            launched = True
+
+            if not node.key:
                 logger.info("No key name configured for this node in the template. Need a key name to launch a node.")
                 keyname = input("Keyname [Enter to use dustcluster default]:")
                 if keyname:
@@ -126,13 +149,23 @@ def start(cmdline, cluster, logger):
 
             node.start()
 
+        # existing nodes are restarted in batches
+        existing = [node for node in target_nodes if node.hydrated]
+        if existing:
+            results = cluster.cloud.start_nodes(existing)
+            report_state_changes(logger, 'start', existing, results)
+
     except Exception as e:
         logger.exception('Error: %s' % e)
         return
 
     logger.info( 'ok' )
 
-    cluster.invalidate_cache()
+    # new instances have no ids yet, so reload everything for those
+    if launched:
+        cluster.invalidate_cache()
+    else:
+        cluster.update_nodes([node.get('id') for node in target_nodes])
 
 def stop(cmdline, cluster, logger):
     '''
@@ -154,7 +187,6 @@ def stop(cmdline, cluster, logger):
         return
     
     operation(logger, cluster, 'stop', cmdline, confirm=True)
-    cluster.invalidate_cache()
 
 def terminate(cmdline, cluster, logger):
     '''
@@ -177,10 +209,11 @@ def terminate(cmdline, cluster, logger):
         return
 
     operation(logger, cluster, 'terminate', cmdline, confirm=True)
-    cluster.invalidate_cache()
 
 def operation(logger, cluster, op, target_node_str=None, confirm=False):
-    ''' invoke attribute op on a set of nodes ''' 
+    ''' invoke a batched cloud lifecycle op (start, stop, terminate) on a set of nodes '''
+
+    operated = []
 
     try:
 
@@ -201,17 +234,38 @@ def operation(logger, cluster, op, target_node_str=None, confirm=False):
             if s.lower() == 'n':
                 return
 
-        for node in target_nodes:
-            if node.state != "terminated":
-                getattr(node, op)()
+        nodes = [node for node in target_nodes if node.hydrated and node.state != "terminated"]
+        operated = [node.get('id') for node in nodes]
+
+        # one start/stop/terminate_instances call per batch of nodes
+        results = getattr(cluster.cloud, "%s_nodes" % op)(nodes)
+        report_state_changes(logger, op, nodes, results)
 
     except Exception as e:
         logger.exception('Error: %s' % e)
         return
 
+    finally:
+        # re-describe just the nodes we touched
+        if operated:
+            cluster.update_nodes(operated)
+
     logger.info( 'ok' )
 
 
+def report_state_changes(logger, op, nodes, results):
+    ''' log the per node result of a batched lifecycle operation '''
+
+    for node in nodes:
+        result = results.get(node.get('id'))
+        if not result:
+            logger.info("%s %s [%s] : nothing to do in state %s" % (op, node.name, node.get('id'), node.state))
+        elif result[1].startswith('error'):
+            logger.error("%s %s [%s] : %s" % (op, node.name, node.get('id'), result[1]))
+        else:
+            logger.info("%s %s [%s] : %s -> %s" % (op, node.name, node.get('id'), result[0], result[1]))
+
+
 def get_target_nodes(logger, cluster, target_node_str=None, search=False):
 
     target_nodes = cluster.resolve_target_nodes(search=search, target_node_name=target_node_str)
@@ -368,7 +368,9 @@ def create_cluster(args, cluster, logger):
 
         conn.create_stack(stack_name=cluster_name,  template_body=cfn_json)
 
-        cluster.invalidate_cache()
+        # pick up any stack instances already launched, $refresh finds the rest
+        if target_region == cluster.cloud.region:
+            cluster.update_nodes(filters=stack_filters(cluster_name))
 
         save_cluster(cluster, obj_yaml, logger)
 
@@ -408,7 +410,8 @@ def delete_cluster(args, cluster, logger):
         cluster.config.delete_cluster_config(cluster_name, region)
         cluster.config.read_all_clusters()
 
-        cluster.invalidate_cache()
+        if region == cluster.cloud.region:
+            cluster.update_nodes(filters=stack_filters(cluster_name))
 
         if cluster.cur_cluster == cluster_name:
             cluster.cur_cluster = ""
@@ -419,6 +422,10 @@ def delete_cluster(args, cluster, logger):
         return
 
 
+def stack_filters(cluster_name):
+    ''' EC2 filters for the instances in a cloudformation stack '''
+    return [ { 'Name' : 'tag:aws:cloudformation:stack-name', 'Values' : [cluster_name] } ]
+
 def expand_clones(nodes):
 
     ret_nodes = []
@@ -49,7 +49,8 @@ Filter expression is evaluated as (in order of precedence):
 
 Note: in addition, the show command takes a search term so  
         $show -v 192.168
-      does a free text search for "192.168" in all attributes/tags.
+      does a free text search for "192.168" in all attributes, tag keys and tag values.
+      A search term with * or ? is a glob matched against each attribute or tag.
 '''
 
 # export commands 
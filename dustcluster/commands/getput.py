@@ -12,29 +12,55 @@
 
 ''' dust command for getting and putting files from/to a set of nodes '''
 
+import os
 import glob
+import colorama
+
+from dustcluster import transfer
+from dustcluster.commands.atssh import _get_key_file
 
 # export commands
 
-commands = ['put', 'get']
+commands = ['put', 'get', 'sync']
 
 def put(cmdline, cluster, logger):
     '''
-    put localfiles filter [target dir] - upload local files
+    put [-u|-b|-t|-s] localfiles filter [target dir] - upload local files
+    put [-z] localdir filter [target dir] - upload a local directory tree
 
     Notes:
     localfiles can have wildcards
+    a directory is sent to each node as one tar stream, unpacked with tar on the node. -z gzips the stream
+    nodes are uploaded to in parallel, ssh-concurrency (in user_data, default 32) at a time,
+    with several files in flight per node
+    -u skips files that are unchanged on a node (by sha256) and resumes partial uploads
+    -b is -u and also sends only the changed 1MB blocks of files that differ
+    -t broadcasts large files: they are uploaded to broadcast-seeds nodes (default 2), and then
+       every node that has a file serves it to broadcast-fanout (default 3) more nodes over the
+       intra cluster network, until all have it. needs python3 on the nodes
+    -s stages files in the s3 bucket s3-staging-bucket (in user_data), and every node downloads them
+       from there with curl over a presigned url. s3-endpoint-url overrides the s3 endpoint.
 
     Examples:
     put /opt/data/data1.txt worker* # uploads data.txt to cwd
     put /opt/data/data*.txt 1,2     # wildcards work
     put /opt/data/data2.txt worker* /opt/data
+    put -b build/app.jar worker* /opt/app   # redeploy, sending only what changed
+    put -t /data/genome.tar worker* /data   # one copy from here, the rest within the cluster
+    put -s /data/genome.tar worker* /data   # one copy to s3, all nodes pull from s3
+    put -z src/myapp worker* /opt           # the tree lands in /opt/myapp
     '''
-    if not cmdline or len(cmdline) < 2:
-        logger.error("usage: put src filter [dest]")
+
+    switch = None
+    arr = cmdline.split() if cmdline else []
+    if arr and arr[0] in ('-u', '-b', '-t', '-s', '-z'):
+        switch = arr[0]
+        arr = arr[1:]
+
+    if len(arr) < 2:
+        logger.error("usage: put [-u|-b|-t|-s|-z] src filter [dest]")
         return
 
-    arr  = cmdline.split()
     srcfile = arr[0]
     target = arr[1]
 
@@ -42,57 +68,160 @@ def put(cmdline, cluster, logger):
     if len(arr) > 2:
         destdir = arr[2]
 
-    globbed = glob.iglob(srcfile)
-    if not list(globbed):
+    if os.path.isdir(srcfile):
+        targets = get_targets(cluster, target, logger)
+        if targets:
+            results, elapsed = transfer.put_tree(cluster.lineterm, targets, srcfile, destdir, compress=switch == '-z')
+            show_errors(results, logger)
+            logger.info(transfer.summary('put', results, elapsed))
+        return
+
+    if switch == '-z':
+        logger.error('put -z is for directories, %s is not one' % srcfile)
+        return
+
+    srcfiles = [fname for fname in glob.glob(srcfile) if os.path.isfile(fname)]
+    if not srcfiles:
         logger.error('local files not found : %s' % srcfile)
         return
 
-    target_nodes = cluster.running_nodes_from_target(target)
-    if not target_nodes:
+    bucket = cluster.config.get_setting('s3-staging-bucket', None)
+    if switch == '-s' and not bucket:
+        logger.error("put -s needs an s3-staging-bucket in %s" % cluster.config.userdata_file)
         return
 
-    for node in target_nodes:
-        globbed = glob.iglob(srcfile)
-        for fname in globbed: 
-            cluster.lineterm.put(node.login_rule.get('keyfile'), node, fname, destdir)
+    targets = get_targets(cluster, target, logger)
+    if not targets:
+        return
+
+    if switch == '-s':
+        s3 = cluster.cloud.get_session().client('s3', region_name=cluster.cloud.region,
+                                                endpoint_url=cluster.config.get_setting('s3-endpoint-url', None))
+        results, elapsed = transfer.stage_files(cluster.lineterm, targets, srcfiles, s3, bucket, destdir)
+    elif switch == '-t':
+        results, elapsed = transfer.broadcast_files(cluster.lineterm, targets, srcfiles, destdir,
+                                                    seeds=int(cluster.config.get_setting('broadcast-seeds', 2)),
+                                                    fanout=int(cluster.config.get_setting('broadcast-fanout', 3)))
+    else:
+        results, elapsed = transfer.put_files(cluster.lineterm, targets, srcfiles, destdir,
+                                              update=switch in ('-u', '-b'), delta=switch == '-b')
+    show_errors(results, logger)
+    logger.info(transfer.summary('put', results, elapsed))
 
 
 def get(cmdline, cluster, logger):
     '''
-    get filter remotefile [localdir] - download remotefile from tgt nodes as remotefile.nodename
+    get [-d] [-z|-Z] filter remotefiles [localdir] - download remote files from target nodes
 
     Notes:
-    remotefile cannot be a wildcard
+    remotefiles can have wildcards, in any part of the path
+    files are saved as localdir/file.nodename, or with -d as localdir/nodename/remote/path.
+    nodes that share a name are told apart as nodename.index, nodes without a name by instance id
+    nodes are downloaded from in parallel, ssh-concurrency (in user_data, default 32) at a time
+    -z compresses files on the nodes (zstd if there and the zstandard module is installed here, else gzip)
+       and decompresses them here, for logs and other text. -Z keeps them compressed, as .zst or .gz
 
     Example:
-    get worker* /opt/output/data1.txt    # download to cwd
-    get worker* /opt/output/data1.txt /tmp   # download to /tmp
+    get worker* /opt/output/data1.txt           # download to cwd
+    get worker* /opt/output/data1.txt /tmp      # download to /tmp
+    get -d worker* /var/log/*.log logs          # logs/worker1/var/log/syslog.log ..
+    get -d -z worker* /var/log/*.log logs       # same, compressed on the wire
     '''
 
-    if not cmdline or len(cmdline) < 2:
-        logger.error("usage: get filter remotefile [localdir]")
+    per_host_dirs, compressed, keep_compressed = False, False, False
+    args = cmdline.split() if cmdline else []
+    while args and args[0] in ('-d', '-z', '-Z'):
+        if args[0] == '-d':
+            per_host_dirs = True
+        else:
+            compressed = True
+            keep_compressed = args[0] == '-Z'
+        args = args[1:]
+
+    if len(args) < 2:
+        logger.error("usage: get [-d] [-z|-Z] filter remotefiles [localdir]")
         return
 
-    target = cmdline.split()[0]
+    target, remotefile = args[0], args[1]
 
-    target_nodes = cluster.running_nodes_from_target(target)
-    if not target_nodes:
-        logger.info('no running nodes match %s' % target)
+    localdir = None
+    if len(args) > 2:
+        localdir = args[2]
+        if not os.path.isdir(localdir):
+            logger.error('dir does not exist locally : %s' % localdir)
+            return
+
+    targets = get_targets(cluster, target, logger)
+    if not targets:
         return
 
-    args = cmdline[len(target):].strip()
+    results, elapsed = transfer.get_files(cluster.lineterm, targets, remotefile, localdir, per_host_dirs,
+                                          compressed=compressed, keep_compressed=keep_compressed)
+    show_errors(results, logger)
+    logger.info(transfer.summary('get', results, elapsed))
 
-    arrargs = args.split()
 
-    remotefile = None
-    localdir = None
+def sync(cmdline, cluster, logger):
+    '''
+    sync [-d] localdir filter remotedir - make remotedir on target nodes match localdir
 
-    remotefile = arrargs[0]
+    Notes:
+    files are compared by size and modification time, files that only differ in mtime by sha256.
+    only missing or changed files are uploaded, with their local mtime.
+    each node is listed with one find, nodes are synced in parallel, ssh-concurrency at a time
+    -d also deletes remote files that are not in localdir
+
+    Example:
+    sync src/myapp worker* /opt/myapp
+    sync -d build/site web* /var/www/site
+    '''
+
+    delete = False
+    args = cmdline.split() if cmdline else []
+    if args and args[0] == '-d':
+        delete = True
+        args = args[1:]
+
+    if len(args) < 3:
+        logger.error("usage: sync [-d] localdir filter remotedir")
+        return
+
+    localdir, target, remotedir = args[0], args[1], args[2]
+    if not os.path.isdir(localdir):
+        logger.error('dir does not exist locally : %s' % localdir)
+        return
+
+    targets = get_targets(cluster, target, logger)
+    if not targets:
+        return
+
+    results, elapsed = transfer.sync_files(cluster.lineterm, targets, localdir, remotedir, delete)
+    show_errors(results, logger)
+    logger.info(transfer.summary('sync', results, elapsed))
 
-    if len(arrargs) > 1:
-        localdir = arrargs[1]
 
+def get_targets(cluster, target, logger):
+    ''' (keyfile, node) for running nodes matching target that have a login rule and a key '''
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        logger.info('no running nodes match %s' % target)
+        return []
+
+    targets = []
     for node in target_nodes:
-        cluster.lineterm.get(cluster.cloud.keyfile, node, remotefile, localdir)
+        if not node.login_rule:
+            logger.info("%sNo login rule for %s. Type $help assign to fix.%s" %
+                            (colorama.Fore.RED, node.name, colorama.Style.RESET_ALL))
+            continue
+        keyfile = _get_key_file(node, cluster, logger)
+        if keyfile:
+            targets.append((keyfile, node))
+
+    return targets
 
 
+def show_errors(results, logger):
+    for result in results:
+        if result.error:
+            logger.error("%s%s: %s%s" % (colorama.Fore.RED, result.node.name, result.error, colorama.Style.RESET_ALL))
@@ -41,8 +41,8 @@ def tag(cmdline, cluster, logger):
 
         client.create_tags(Resources=r_ids, Tags=tagparam)
 
-        # refresh from cloud next operation
-        cluster.invalidate_cache()
+        # re-describe the tagged nodes
+        cluster.update_nodes(r_ids)
 
     except Exception as e:
         logger.exception('Error: %s' % e)
@@ -90,8 +90,8 @@ def untag(cmdline, cluster, logger):
 
         client.delete_tags(Resources=r_ids, Tags=tagparam)
 
-        # refresh from cloud next operation
-        cluster.invalidate_cache()
+        # re-describe the tagged nodes
+        cluster.update_nodes(r_ids)
 
     except Exception as e:
         logger.exception('Error: %s' % e)
@@ -49,6 +49,7 @@ class DustConfig(object):
         self.login_rules_file = os.path.join(self.dust_dir, 'login_rules.yaml')
         self.default_keys_dir = os.path.join(self.dust_dir, 'keys')
         self.clusters_dir = os.path.join(self.dust_dir, 'clusters')
+        self.cache_dir = os.path.join(self.dust_dir, 'cache')
 
     def init(self, profile_name):
 
@@ -67,6 +68,7 @@ class DustConfig(object):
         self.login_rules_file = os.path.join(self.dust_profile_dir, 'login_rules.yaml')
         self.default_keys_dir = os.path.join(self.dust_profile_dir, 'keys')
         self.clusters_dir = os.path.join(self.dust_profile_dir, 'clusters')
+        self.cache_dir = os.path.join(self.dust_profile_dir, 'cache')
 
         # creds in environment is not supported.
         if not os.path.exists(self.aws_credentials_file):
@@ -129,6 +131,17 @@ class DustConfig(object):
     def get_clusters(self):
         return self.clusters
 
+    def get_cache_dir(self):
+        return self.cache_dir
+
+    def get_setting(self, name, default):
+        ''' optional tunable from user_data, e.g. inventory-cache-ttl '''
+
+        val = self.user_data.get(name)
+        if val is None:
+            return default
+        return val
+
     def get_history_file_path(self):
         return self.history_file
 
@@ -175,7 +175,14 @@ class Console(Cmd):
         if line and line[0] == '@':
             tokens = line.split()
             if len(tokens[0]) == 1:
-                line = 'atssh * ' + line[1:]
+                # keep switches in front of the target, @ -x cmd is atssh -x * cmd
+                switches = []
+                rest = line[1:].strip()
+                while rest.startswith('-'):
+                    parts = rest.split(None, 1)
+                    switches.append(parts[0])
+                    rest = parts[1] if len(parts) > 1 else ''
+                line = 'atssh %s * %s' % (" ".join(switches), rest)
             else:
                 target = tokens[0][1:]
                 line = 'atssh %s %s ' % (target, line[len(tokens[0]):])
@@ -0,0 +1,321 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+'''
+Compiled filter expressions and inverted node indexes for resolving command targets
+'''
+
+import re
+import fnmatch
+import colorama
+from bisect import bisect_left
+from functools import lru_cache
+
+from dustcluster.util import setup_logger, is_numeric
+logger = setup_logger( __name__ )
+
+
+# filter keys that are indexed : node property the index is built from
+index_keys = {
+                'name'                  : 'name',
+                'index'                 : 'index',
+                'cluster'               : 'cluster',
+                'state'                 : 'state',
+                'type'                  : 'instance_type',
+                'instance_type'         : 'instance_type',
+                'vpc'                   : 'vpc_id',
+                'vpc_id'                : 'vpc_id',
+                'ip'                    : 'public_ip_address',
+                'public_ip_address'     : 'public_ip_address',
+                'private_ip_address'    : 'private_ip_address',
+                'id'                    : 'id',
+                'instance_id'           : 'id'
+             }
+
+wildcards = re.compile(r'[*?\[]')
+
+# a bare target that looks like an ip address or an ip pattern, e.g. 10.0.3.7 or 10.0.3.*
+ip_like = re.compile(r'^[0-9*?\[\]-]+(\.[0-9*?\[\]-]*)+$')
+
+# the node properties an ip-like bare target is matched against
+ip_keys = ('name', 'public_ip_address', 'private_ip_address')
+
+
+class Pattern(object):
+    '''
+    a lowercase fnmatch pattern, classified as exact, prefix (abc*) or glob
+    so that index lookups can avoid the regex where possible
+    '''
+
+    __slots__ = ('text', 'exact', 'prefix', 'regex')
+
+    def __init__(self, text):
+
+        self.text   = text
+        self.exact  = None
+        self.prefix = None
+
+        if not wildcards.search(text):
+            self.exact = text
+        elif text.endswith('*') and not wildcards.search(text[:-1]):
+            self.prefix = text[:-1]
+
+        self.regex = re.compile(fnmatch.translate(text))
+
+    def match(self, val):
+        return self.regex.match(val) is not None
+
+    def select(self, sorted_keys, keyset):
+        ''' keys matching this pattern from a sorted list of distinct keys '''
+
+        if self.exact is not None:
+            return [self.exact] if self.exact in keyset else []
+
+        if self.prefix is not None:
+            ret = []
+            pos = bisect_left(sorted_keys, self.prefix)
+            while pos < len(sorted_keys) and sorted_keys[pos].startswith(self.prefix):
+                ret.append(sorted_keys[pos])
+                pos += 1
+            return ret
+
+        return [key for key in sorted_keys if self.regex.match(key)]
+
+
+class FilterTerm(object):
+    '''
+    one key=value filter expression, e.g. state=run* or tags=env:dev
+    '''
+
+    def __init__(self, filterkey, filterval):
+
+        self.key = filterkey.lower()
+        filterval = filterval.lower()
+
+        self.tagkey = None
+        self.val = None
+
+        if self.key == 'tags':
+
+            pos = filterval.rfind(':')
+            if pos == -1:
+                fkey, fval = filterval, '*'
+            else:
+                fkey, fval = filterval[:pos], filterval[pos+1:]
+
+            if fkey and fkey[0] == '"' and fkey[-1] == '"':
+                fkey = fkey[1:-1]
+
+            if not fkey:
+                logger.error("Bad filter. Use tags=key:value, wildcards allowed on key, value.")
+                fkey, fval = '', ''
+
+            self.tagkey = Pattern(fkey)
+            self.val = Pattern(fval or '*')
+        else:
+            self.val = Pattern(filterval)
+
+    def filter(self, nodes):
+        ''' scan a list of nodes '''
+
+        if self.tagkey:
+            if not self.tagkey.text:
+                return []
+            return [node for node in nodes if self._match_tags(node.lower_tags)]
+
+        filtered = []
+        for node in nodes:
+            val = node.get(self.key)
+            if not val:
+                continue
+            if self.val.match(str(val).lower()):
+                filtered.append(node)
+
+        return filtered
+
+    def _match_tags(self, lower_tags):
+
+        for tagkey, tagval in lower_tags.items():
+            if self.tagkey.match(tagkey) and self.val.match(tagval):
+                return True
+
+        return False
+
+    def lookup(self, node_index):
+        ''' use the index if this term is on an indexed key, returns None otherwise '''
+
+        if self.tagkey:
+            if not self.tagkey.text:
+                return []
+            return node_index.lookup_tags(self.tagkey, self.val)
+
+        prop = index_keys.get(self.key)
+        if not prop:
+            return None
+
+        return node_index.lookup(prop, self.val)
+
+
+class FilterPlan(object):
+    '''
+    a target string compiled once into a union of FilterTerms.
+    target string is a comma separated list of filter expressions, each is
+    key=value, a cluster name, a node index, a node name, or an ip address
+    or ip pattern which also matches names.
+    '''
+
+    def __init__(self, target_str, clusters):
+
+        self.target_str = target_str
+        self.terms = []
+        self.search_terms = [term.lower() for term in target_str.split(",") if term]
+
+        # search terms with wildcards match anywhere in one attribute or tag
+        self.search_patterns = [Pattern('*%s*' % term) if wildcards.search(term) else None for term in self.search_terms]
+
+        for filter_exp in target_str.split(","):
+            if '=' in filter_exp:
+                parts = filter_exp.split("=")
+                if len(parts) != 2:
+                    str_err = "Filter format error. Should be key=value for node properties or tags=key:value for tags. Use quotes if needed."
+                    raise Exception("%s%s%s" %(colorama.Fore.RED, str_err, colorama.Style.RESET_ALL))
+                filterkey, filterval  = parts
+            elif filter_exp in clusters:
+                filterkey, filterval = 'cluster', filter_exp
+            elif ip_like.match(filter_exp):
+                for key in ip_keys:
+                    self.terms.append(FilterTerm(key, filter_exp))
+                continue
+            else:
+                filterkey, filterval = 'name', filter_exp
+                if is_numeric(filter_exp):
+                    filterkey = 'index'
+
+            if filterkey and filterval:
+                self.terms.append(FilterTerm(filterkey, filterval))
+
+    def select(self, nodes, node_index=None):
+        ''' set of nodes matching any term. indexed terms are looked up in node_index '''
+
+        selected = set()
+        for term in self.terms:
+            matched = None
+            if node_index:
+                matched = term.lookup(node_index)
+            if matched is None:
+                matched = term.filter(nodes)
+            selected.update(matched)
+
+        return selected
+
+    def search(self, nodes, node_index=None):
+        ''' set of nodes where any search term is a substring of any attribute or tag '''
+
+        selected = set()
+        for node in nodes:
+            if node_index:
+                haystack = node_index.haystack(node)
+            else:
+                haystack = make_haystack(node)
+            for search_term, pattern in zip(self.search_terms, self.search_patterns):
+                if search_term in haystack if not pattern else any(pattern.match(val) for val in haystack.split("\n")):
+                    selected.add(node)
+                    break
+
+        return selected
+
+
+@lru_cache(maxsize=256)
+def compile_target(target_str, clusters=frozenset()):
+    ''' compile a target string to a FilterPlan, plans are cached by target string and cluster names '''
+    return FilterPlan(target_str, clusters)
+
+
+class NodeIndex(object):
+    '''
+    inverted indexes over a region's nodes, built once per refresh.
+
+    For each indexed property: { lowercase value : [nodes] } and a sorted list of values,
+    so exact matches are a dict lookup and prefix matches are a bisect.
+    Tags are indexed as { lowercase key : { lowercase value : [nodes] } }.
+    '''
+
+    def __init__(self, nodes):
+
+        self.nodes = nodes
+        self.props = {}         # { prop : (valuemap, sorted_values) }
+        self.tags = {}          # { tagkey : (valuemap, sorted_values) }
+        self.tagkeys = []
+        self._haystacks = {}    # { node : search text }
+
+        for prop in set(index_keys.values()):
+            valuemap = {}
+            for node in nodes:
+                val = node.get(prop)
+                if not val:
+                    continue
+                valuemap.setdefault(str(val).lower(), []).append(node)
+            self.props[prop] = (valuemap, sorted(valuemap))
+
+        tagmaps = {}
+        for node in nodes:
+            for tagkey, tagval in node.lower_tags.items():
+                tagmaps.setdefault(tagkey, {}).setdefault(tagval, []).append(node)
+
+        for tagkey, valuemap in tagmaps.items():
+            self.tags[tagkey] = (valuemap, sorted(valuemap))
+        self.tagkeys = sorted(self.tags)
+
+        logger.debug("indexed %d nodes on %d properties and %d tag keys" % (len(nodes), len(self.props), len(self.tagkeys)))
+
+    def lookup(self, prop, pattern):
+
+        valuemap, sorted_values = self.props[prop]
+
+        ret = []
+        for val in pattern.select(sorted_values, valuemap):
+            ret.extend(valuemap[val])
+        return ret
+
+    def lookup_tags(self, keypattern, valpattern):
+
+        ret = []
+        for tagkey in keypattern.select(self.tagkeys, self.tags):
+            valuemap, sorted_values = self.tags[tagkey]
+            for val in valpattern.select(sorted_values, valuemap):
+                ret.extend(valuemap[val])
+        return ret
+
+    def haystack(self, node):
+        ''' lowercase text of all node attributes and tags, built on first search '''
+
+        ret = self._haystacks.get(node)
+        if ret is None:
+            ret = make_haystack(node)
+            self._haystacks[node] = ret
+        return ret
+
+
+def make_haystack(node):
+    ''' all attribute values and tags of a node as one lowercase search string '''
+
+    vals = []
+    for key in node.extended_fields + node.all_fields:
+        if key == 'tags':
+            continue
+        vals.append(str(node.get(key)).lower())
+
+    for tagkey, tagval in node.lower_tags.items():
+        vals.append(tagkey)
+        vals.append(tagval)
+
+    return "\n".join(vals)
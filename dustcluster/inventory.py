@@ -0,0 +1,174 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+'''
+Per region node inventory, and its on-disk snapshot for warm starts
+'''
+
+import os
+import json
+import time
+
+from dustcluster.EC2 import NodeRecord
+
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+
+class Inventory(object):
+    '''
+    the cached nodes for one region, when they were fetched,
+    the filter they were fetched with and the lookup index over them
+    '''
+
+    def __init__(self, region, nodes, fetched=None, scope=""):
+
+        self.region     = region
+        self.nodes      = nodes
+        self.fetched    = fetched or time.time()
+        self.scope      = scope     # filter expression evaluated by the cloud provider
+        self.node_index = None      # built when nodes are matched to login rules
+        self.numbered   = False     # index numbers are assigned once, then kept stable
+        self.from_snapshot = False
+        self.revalidating  = False
+        self.merges     = 0         # bumped by merge, a background revalidation started before a merge is discarded
+
+    def merge(self, nodes, prune=False):
+        '''
+        replace cached nodes with freshly described ones by instance id.
+        known nodes keep their index number, new nodes are numbered after the last one.
+        if prune, nodes is a full refetch and cached nodes missing from it are dropped.
+        '''
+
+        merged = list(self.nodes)
+        positions = dict( (node.get('id'), pos) for pos, node in enumerate(merged) )
+        next_index = max( [int(node.index) for node in merged if node.index] or [0] ) + 1
+
+        for node in nodes:
+            pos = positions.get(node.get('id'))
+            if pos is not None:
+                node.index = merged[pos].index
+                merged[pos] = node
+            else:
+                node.index = str(next_index)
+                next_index += 1
+                positions[node.get('id')] = len(merged)
+                merged.append(node)
+
+        if prune:
+            fetched_ids = set(node.get('id') for node in nodes)
+            merged = [node for node in merged if node.get('id') in fetched_ids]
+
+        # swapped in whole, readers on other threads see the old or the new list
+        self.nodes = merged
+
+        # rebuilt on next access, after the new nodes are matched to login rules
+        self.node_index = None
+        self.merges += 1
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def is_expired(self, ttl):
+        return ttl >= 0 and self.age() > ttl
+
+    def describe(self):
+        ''' short description of where the nodes came from, for show '''
+
+        ret = []
+        if self.from_snapshot:
+            ret.append("snapshot from %s ago" % fmt_age(self.age()))
+        if self.revalidating:
+            ret.append("stale, revalidating")
+        if self.scope:
+            ret.append("refreshed with filter [%s], $refresh to load all" % self.scope)
+
+        return ", ".join(ret)
+
+
+class InventoryStore(object):
+    '''
+    reads and writes inventory snapshots, one JSON lines file per region:
+    a header line, then one line of NodeRecord fields per node
+    '''
+
+    version = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, region):
+        return os.path.join(self.cache_dir, "%s.jsonl" % region)
+
+    def write(self, inventory):
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        header = { 'version' : self.version, 'region' : inventory.region,
+                   'fetched' : inventory.fetched, 'scope' : inventory.scope }
+
+        snapshot_file = self.path(inventory.region)
+        tmp_file = snapshot_file + ".tmp"
+        with open(tmp_file, 'w') as fh:
+            fh.write(json.dumps(header) + "\n")
+            for node in inventory.nodes:
+                if node.vm:
+                    fh.write(json.dumps(node.vm.to_dict(), default=str, separators=(',', ':')) + "\n")
+
+        os.replace(tmp_file, snapshot_file)
+
+        logger.debug("wrote %d nodes to %s" % (len(inventory.nodes), snapshot_file))
+
+    def read(self, region, cloud):
+        ''' returns an Inventory of cloud nodes or None if there is no usable snapshot '''
+
+        snapshot_file = self.path(region)
+        if not os.path.exists(snapshot_file):
+            return None
+
+        try:
+            with open(snapshot_file, 'r') as fh:
+                header = json.loads(fh.readline())
+                if header.get('version') != self.version or header.get('region') != region:
+                    logger.debug("ignoring snapshot %s with header %s" % (snapshot_file, header))
+                    return None
+
+                records = [NodeRecord.from_dict(json.loads(line)) for line in fh if line.strip()]
+
+        except Exception as ex:
+            logger.warning("Could not read inventory snapshot %s : %s" % (snapshot_file, ex))
+            return None
+
+        inventory = Inventory(region, cloud.nodes_from_records(records), header.get('fetched'), header.get('scope') or "")
+        inventory.from_snapshot = True
+
+        return inventory
+
+    def remove(self, region):
+
+        snapshot_file = self.path(region)
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
+
+
+def fmt_age(seconds):
+    ''' 42s, 5m, 3h, 2d '''
+
+    seconds = int(seconds)
+    if seconds < 60:
+        return "%ds" % seconds
+    if seconds < 3600:
+        return "%dm" % (seconds // 60)
+    if seconds < 86400:
+        return "%dh" % (seconds // 3600)
+    return "%dd" % (seconds // 86400)
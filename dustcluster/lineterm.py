@@ -13,17 +13,22 @@
 ''' invoke commands or a shell over ssh sessions,  demultiplex the ssh output '''  
 
 import getpass
-from threading import Thread
-import select
+from threading import Thread, Lock, Event
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import selectors
+import time
+import hashlib
+import tempfile
 import socket
 import sys
 import os, struct, fcntl
 import colorama
 
-from paramiko.py3compat import u
 import paramiko
 
 from dustcluster.util import setup_logger
+from dustcluster import transfer
 logger = setup_logger( __name__ )
 
 
@@ -35,48 +40,123 @@ logger = setup_logger( __name__ )
 # This allows us to execute arbitrarily interactive scripts. 
 
 class ReceiveDemux(object):
-    ''' receive demultiplexer for all open ssh interactive shells ''' 
+    ''' 
+    receive demultiplexer for all open ssh interactive shells 
+
+    One thread waits on all channels with a selector (epoll/kqueue where available, 
+    so there is no 1024 fd limit). Output is buffered per channel and written once the 
+    channel has been quiet for flush_idle, or its oldest buffered output is flush_max old, 
+    so a chatty host is flushed regularly and cannot hold back the others.
+    All output due in one pass is coalesced into a single write.
+
+    A session with buffer_max unflushed bytes is not read again until it is flushed.
+    The remote end then fills the ssh channel window and is paused by the server, 
+    so memory stays flat however fast a host produces output.
+    ''' 
+
+    read_size  = 65536
+    read_max   = 262144     # bytes read from one channel per pass, before serving the others
+    buffer_max = 4 * 1024 * 1024    # unflushed bytes per session, reading pauses at this size
+    flush_idle = 0.05
+    flush_max  = 0.25
 
     def __init__(self, session_mgr):
         self.refresh_callback = None
-        self.chans = {} # { chan : receive_buffer }
+        self.chans = {} # { chan : sshterm }
+        self.buffered = {} # { chan : (first read time, last read time) } for chans with unflushed output
         self.session_mgr = session_mgr
         self.state = 'created'
+
+        # channels are added and removed from other threads, the receive thread applies 
+        # the changes to the selector after a wakeup
+        self.lock = Lock()
+        self.pending = []
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
         self.thread = Thread(target=self.receive_loop)
         self.thread.daemon = True
         self.thread.start()
 
     def start(self, sshterm):
         ''' start demuxing output on this term '''
-        self.chans[sshterm.chan] = sshterm
+        with self.lock:
+            self.chans[sshterm.chan] = sshterm
+            self.pending.append(('add', sshterm.chan))
+        self.wakeup()
 
     def stop(self, chan):
         ''' stop receiving on chan, remove session ''' 
-        term = self.chans[chan]
-        del self.chans[chan]
-        self.session_mgr.remove_session(term)
+        with self.lock:
+            term = self.chans.pop(chan, None)
+            self.buffered.pop(chan, None)
+            self.pending.append(('remove', chan))
+        self.wakeup()
+        if term:
+            self.session_mgr.remove_session(term)
 
     def shutdown(self):
         ''' shut down receiver thread '''
         self.state = 'shutdown'
+        self.wakeup()
         self.thread.join()
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
 
-    def handle_read(self, achan):
+    def wakeup(self):
         try:
-            readbytes = u(achan.recv(1024))
-            if len(readbytes) == 0:
-                sys.stdout.write('\r\SSH session disconnected.\r\n')
-                sys.stdout.flush()
-                self.stop(achan)
-                return
-
-            sshterm = self.chans[achan]
-            if sshterm.raw_shell_mode:
-                sys.stdout.write(readbytes)
-                sys.stdout.flush()
-                
-            else:
-                sshterm.recvbuf = sshterm.recvbuf + readbytes
+            os.write(self.wakeup_w, b'x')
+        except OSError:
+            pass
+
+    def apply_pending(self):
+        ''' register and unregister channels queued by start and stop '''
+
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        for op, chan in pending:
+            try:
+                if op == 'add':
+                    self.selector.register(chan, selectors.EVENT_READ)
+                else:
+                    self.selector.unregister(chan)
+            except (KeyError, ValueError, OSError):
+                pass
+
+    def handle_read(self, achan, now):
+        sshterm = self.chans.get(achan)
+        if not sshterm:
+            return
+
+        try:
+            total = 0
+            while total < self.read_max and len(sshterm.recvbuf) < self.buffer_max:
+                data = achan.recv(self.read_size)
+                if len(data) == 0:
+                    sys.stdout.write('\r\SSH session disconnected.\r\n')
+                    sys.stdout.flush()
+                    self.stop(achan)
+                    return
+
+                total += len(data)
+                if sshterm.raw_shell_mode:
+                    write_stdout(data)
+                else:
+                    sshterm.recvbuf += data
+
+                if not achan.recv_ready():
+                    break
+
+            if not sshterm.raw_shell_mode:
+                first, _ = self.buffered.get(achan, (now, now))
+                if len(sshterm.recvbuf) >= self.buffer_max:
+                    # full, flush on this pass before reading any more
+                    first = now - self.flush_max
+                self.buffered[achan] = (first, now)
 
         except socket.timeout:
             sys.stdout.write('\r\SSH session timedout.\r\n')
@@ -89,20 +169,29 @@ class ReceiveDemux(object):
         except:
             logger.exception('Error on socket, could not shutdown cleanly.\r\n')
 
+    def next_deadline(self):
+        ''' earliest time a buffered channel is due to be flushed, None if nothing is buffered '''
+
+        deadlines = [min(first + self.flush_max, last + self.flush_idle) for first, last in self.buffered.values()]
+        return min(deadlines) if deadlines else None
 
-    def handle_timeout(self):
+    def flush(self, now):
+        ''' write out the buffered output of channels that are due, in one write '''
     
         try:
 
-            wrote_output = False
-            for chan, sshterm in  self.chans.items():
+            out = []
+            for chan, (first, last) in list(self.buffered.items()):
 
-                if not sshterm.recvbuf:
+                if now < first + self.flush_max and now < last + self.flush_idle:
                     continue
 
-                if sshterm.raw_shell_mode:
+                del self.buffered[chan]
+                sshterm = self.chans.get(chan)
+                if not sshterm or not sshterm.recvbuf or sshterm.raw_shell_mode:
                     continue
 
+                recvbuf = sshterm.recvbuf
                 if not sshterm.login_guid_found:
                 # surpress login banner. disabled for now.
                 # Note: RFC-4254 reccomends the use of magic cookeis to surpress spurious
@@ -110,63 +199,132 @@ class ReceiveDemux(object):
                 # arbitrary output generated by shell initialization scripts, etc. This spurious 
                 # output from the shell may be filtered out either at the server or at the client"
                 # We can reuse this trick to surpress login banner text and echo enable/disable.
-                    pos1 = sshterm.recvbuf.find( '\n' + SSHTerm.login_complete_guid )
+                    # only search what arrived since the last search
+                    marker = b'\n' + SSHTerm.login_complete_guid.encode('ascii')
+                    pos1 = recvbuf.find( marker, max(0, sshterm.guid_scan_pos - len(marker)) )
                     if pos1 != -1:
                         sshterm.login_guid_found = True
-                        guid_len = len(SSHTerm.login_complete_guid)  + 1
-                        sshterm.recvbuf = sshterm.recvbuf[pos1 + guid_len:]
+                        del recvbuf[:pos1 + len(marker)]
                     else:
+                        # everything before the guid is dropped, so keep only what could be the start of a
+                        # marker split across reads. the buffer never fills up and reading goes on
+                        if len(recvbuf) >= len(marker):
+                            del recvbuf[:len(recvbuf) - len(marker) + 1]
+                        sshterm.guid_scan_pos = len(recvbuf)
                         continue
 
-                if sshterm.recvbuf.strip():
-                    sys.stdout.write('\n')
-                    prefix = "\n%s%s[%s]%s " % (colorama.Style.BRIGHT, colorama.Fore.WHITE, sshterm.node.name, 
-                                                colorama.Style.RESET_ALL)
-                    sys.stdout.write(prefix)
-                    sys.stdout.write(sshterm.recvbuf.replace('\n', prefix))
-                    sys.stdout.flush()
-                    sshterm.recvbuf = u('')
-                    sys.stdout.write('\n')
-                    sys.stdout.flush()
-                    wrote_output = True
+                # hold back a multibyte character split across reads so it is not split between hosts
+                end = utf8_boundary(recvbuf)
+                chunk = bytes(recvbuf[:end])
+                del recvbuf[:end]
 
-            #reset prompt
-            if wrote_output and self.refresh_callback:
-                self.refresh_callback()
+                if chunk.strip():
+                    prefix = sshterm.output_prefix
+                    out.append(b'\n')
+                    out.append(prefix)
+                    out.append(chunk.replace(b'\n', prefix))
+                    out.append(b'\n')
+
+            if out:
+                write_stdout(b''.join(out))
+
+                #reset prompt
+                if self.refresh_callback:
+                    self.refresh_callback()
 
         except: 
             logger.exception('Error on receive loop, ssh session in bad state.\r\n')
 
-
     def receive_loop(self):
         ''' demux receive loop '''
 
-
         while self.state != 'shutdown':
-            r, w, e = select.select(self.chans, [], self.chans, 0.25)
-            if r:
-                for achan in r:
-                    self.handle_read(achan)
-            if e:
-                for achan in e:
-                    self.handle_err(achan)
 
-            if not r and not e:
-                self.handle_timeout()
+            self.apply_pending()
+
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.time())
+
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj == self.wakeup_r:
+                    try:
+                        os.read(self.wakeup_r, 4096)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    self.handle_read(key.fileobj, time.time())
+                except Exception:
+                    self.handle_err(key.fileobj)
+
+            self.flush(time.time())
 
         logger.debug('Exiting receive loop.\r\n')
 
         return 0
 
 
+def write_stdout(data):
+    ''' write bytes to stdout without decoding them '''
+
+    out = getattr(sys.stdout, 'buffer', None)
+    if out is None:
+        sys.stdout.write(data.decode('utf-8', 'replace'))
+    else:
+        sys.stdout.flush()
+        out.write(data)
+    sys.stdout.flush()
+
+
+def utf8_boundary(buf):
+    ''' length of buf without a trailing incomplete utf-8 sequence '''
+
+    # look back at most 3 bytes for the lead byte of the last character
+    for back in range(1, min(4, len(buf)) + 1):
+        byte = buf[-back]
+        if byte & 0xC0 == 0x80:
+            continue                # continuation byte
+        if byte & 0x80 == 0:
+            return len(buf)         # ascii
+        if byte & 0xE0 == 0xC0:
+            needed = 2
+        elif byte & 0xF0 == 0xE0:
+            needed = 3
+        elif byte & 0xF8 == 0xF0:
+            needed = 4
+        else:
+            return len(buf)         # not utf-8, pass it through
+        return len(buf) if back >= needed else len(buf) - back
+
+    return len(buf)
+
+
 class SessionManager(object):
-    ''' holds a map of node ids to ssh sessions
+    ''' holds a pool of ssh sessions keyed by node id
         registers/unregisters ssh sessions with the demultiplexer 
+
+        Sessions are kept in least recently used order. Past max_sessions the least recently
+        used sessions that are not in use are closed. A health thread closes sessions idle for 
+        max_idle seconds or with a dead transport, and sends a keepalive on the others.
+        Logins that fail on network errors are retried with exponential backoff.
     '''
 
+    max_sessions    = 256
+    max_idle        = 1800
+    check_interval  = 60
+    connect_retries = 2
+    retry_backoff   = 1.0
+
     def __init__(self):
         self.demux = ReceiveDemux(self)
-        self.session_map = {}
+        self.session_map = OrderedDict()   # { node id : SSHTerm } least recently used first
+        self.transport_options = {}        # SSHTerm window_size, max_packet_size, compression
+        self.lock = Lock()      # sessions are created from concurrent connect workers
+
+        self.stopping = Event()
+        self.health_thread = Thread(target=self.health_loop)
+        self.health_thread.daemon = True
+        self.health_thread.start()
 
     def remove_session(self, term):
     
@@ -175,39 +333,283 @@ class SessionManager(object):
             term.raw_shell_mode = True
             term.revert_tty()
 
-        todel = []
-        for nodeid, nodeterm in self.session_map.items():
-            if nodeterm == term:
-                todel.append(nodeid)
-        for nodeid in todel:
-            del self.session_map[nodeid]
+        with self.lock:
+            todel = []
+            for nodeid, nodeterm in self.session_map.items():
+                if nodeterm == term:
+                    todel.append(nodeid)
+            for nodeid in todel:
+                del self.session_map[nodeid]
+
+    def close_session(self, term):
+        ''' remove a session from the pool and the demux and close it '''
+
+        with self.lock:
+            for nodeid, nodeterm in list(self.session_map.items()):
+                if nodeterm is term:
+                    del self.session_map[nodeid]
+
+        if term.chan is not None:
+            self.demux.stop(term.chan)
+        term.close()
 
     def shutdown(self):
-        for term in self.session_map.values():
+        self.stopping.set()
+        with self.lock:
+            terms = list(self.session_map.values())
+        for term in terms:
             term.shutdown()
 
         self.demux.shutdown()
 
     def term_from_node(self, node, keyfile, rawshell=False):
 
-        term = self.session_map.get(node.get('id'))
+        nodeid = node.get('id')
+        with self.lock:
+            term = self.session_map.get(nodeid)
+            if term:
+                self.session_map.move_to_end(nodeid)
+
+        if term and not term.is_connected():
+            logger.info('%s: ssh session lost, logging in again' % node.name)
+            self.close_session(term)
+            term = None
 
         if not term:
-            term = SSHTerm(node, keyfile)
+            # connect and auth outside the lock so many nodes can log in at once
+            term = self.connect(node, keyfile, rawshell)
+            with self.lock:
+                self.session_map[nodeid] = term
+            self.evict()
+
+        term.last_used = time.time()
+        return term
+
+    def acquire(self, node, keyfile, rawshell=False):
+        ''' a session for node that is not evicted until it is released '''
+
+        term = self.term_from_node(node, keyfile, rawshell)
+        with self.lock:
+            term.leases += 1
+        return term
+
+    def release(self, term):
+        with self.lock:
+            term.leases -= 1
+        term.last_used = time.time()
+
+    def connect(self, node, keyfile, rawshell=False):
+        ''' log in to node, retrying network errors with exponential backoff '''
+
+        delay = self.retry_backoff
+        attempt = 0
+        while True:
+            term = SSHTerm(node, keyfile, **self.transport_options)
             # hide login banner unless this is a raw shell login
             cookie = False
             if not rawshell:
                 term.login_guid_found = False
                 cookie = True
-            term.login(cookie)
-            self.demux.start(term)
-            self.session_map[node.get('id')] = term
+            try:
+                term.login(cookie)
+                break
+            except paramiko.AuthenticationException:
+                term.close()
+                raise
+            except (socket.error, EOFError, paramiko.SSHException) as ex:
+                term.close()
+                attempt += 1
+                if attempt > self.connect_retries:
+                    raise
+                logger.info('%s: ssh login failed (%s), retrying in %.0fs' % (node.name, ex, delay))
+                time.sleep(delay)
+                delay *= 2
+
+        self.demux.start(term)
+        return term
 
-        if not term.is_connected():
-            logger.info('no ssh connection, logging in')
-            term.login()
+    def evict(self):
+        ''' close the least recently used sessions over max_sessions, skipping sessions in use '''
+
+        with self.lock:
+            excess = len(self.session_map) - self.max_sessions
+            victims = []
+            for term in self.session_map.values():
+                if len(victims) >= excess:
+                    break
+                if not term.leases and not term.raw_shell_mode:
+                    victims.append(term)
+
+        for term in victims:
+            logger.debug('%s: closing least recently used ssh session' % term.node.name)
+            self.close_session(term)
+
+    def prune(self, region, live_ids, known_ids=None):
+        '''
+        close sessions to nodes in region that are not in live_ids.
+        with known_ids, only sessions to those nodes are considered, for a partial inventory.
+        returns the number of sessions closed
+        '''
+
+        with self.lock:
+            dead = []
+            for nodeid, term in self.session_map.items():
+                cloud = getattr(term.node, 'cloud', None)
+                if getattr(cloud, 'region', None) != region or nodeid in live_ids:
+                    continue
+                if known_ids is not None and nodeid not in known_ids:
+                    continue
+                if not term.raw_shell_mode:
+                    dead.append(term)
+
+        for term in dead:
+            logger.debug('%s: closing ssh session to node no longer in inventory' % term.node.name)
+            self.close_session(term)
+
+        return len(dead)
+
+    def health_loop(self):
+        ''' check sessions every check_interval seconds until shutdown '''
+
+        while not self.stopping.wait(self.check_interval):
+            try:
+                self.check_sessions()
+            except Exception:
+                logger.exception('Error checking ssh sessions')
+
+    def check_sessions(self):
+        ''' close idle and dead sessions, send a keepalive on the rest '''
+
+        now = time.time()
+        with self.lock:
+            terms = list(self.session_map.values())
+
+        for term in terms:
+            if term.leases or term.raw_shell_mode:
+                continue
+
+            if now - term.last_used > self.max_idle:
+                reason = 'idle'
+            elif not term.is_connected():
+                reason = 'dead'
+            else:
+                try:
+                    term.transport.send_ignore()
+                    continue
+                except Exception:
+                    reason = 'keepalive failed'
+
+            logger.debug('%s: closing ssh session, %s' % (term.node.name, reason))
+            self.close_session(term)
 
-        return term
+
+class KeyLoadError(paramiko.AuthenticationException):
+    ''' a private key file that could not be read or decrypted. an auth error, so logins do not retry it '''
+    pass
+
+
+class KeyCache(object):
+    '''
+    private keys parsed once per process, keyed by path and modification time, 
+    so a passphrase is asked for once however many nodes are logged into.
+    a key that cannot be read is remembered too, and fails again without another prompt
+    until the file changes.
+    RSA, ECDSA and Ed25519 key files are supported, and keys held by a running ssh-agent.
+    '''
+
+    key_types = [getattr(paramiko, name) for name in ('RSAKey', 'ECDSAKey', 'Ed25519Key', 'DSSKey') if hasattr(paramiko, name)]
+
+    passphrase_attempts = 3
+
+    def __init__(self):
+        self.keys = {}          # { (path, mtime) : PKey }
+        self.failures = {}      # { (path, mtime) : KeyLoadError }
+        self.agent = None
+        self.lock = Lock()      # held while parsing, so concurrent logins wait for one passphrase prompt
+
+    def get(self, path):
+
+        path = os.path.abspath(os.path.expanduser(path))
+        try:
+            cache_key = (path, os.path.getmtime(path))
+        except (IOError, OSError):
+            # missing or unreadable, remembered until the file shows up
+            cache_key = (path, None)
+
+        key = self.keys.get(cache_key)
+        if key:
+            return key
+
+        with self.lock:
+            if cache_key in self.failures:
+                raise self.failures[cache_key]
+            key = self.keys.get(cache_key)
+            if not key:
+                # OSError is a socket.error, wrapped so logins do not retry it as a network error
+                try:
+                    key = self.load(path)
+                except (paramiko.SSHException, IOError, OSError) as ex:
+                    self.failures[cache_key] = KeyLoadError(str(ex) or 'Could not read private key %s' % path)
+                    raise self.failures[cache_key]
+                self.keys[cache_key] = key
+
+        return key
+
+    def load(self, path):
+        ''' parse a private key file of any supported type, asking for a passphrase if it is encrypted '''
+
+        password = None
+        attempts = 0
+        while True:
+            try:
+                return self._load(path, password)
+            except paramiko.PasswordRequiredException:
+                pass
+            except paramiko.SSHException:
+                # an encrypted key that none of the key types could read: most likely a bad passphrase
+                if password is None or attempts >= self.passphrase_attempts:
+                    raise
+                logger.error('Could not decrypt key %s, wrong passphrase?' % path)
+
+            attempts += 1
+            password = getpass.getpass('Passphrase for key %s: ' % path)
+
+    def _load(self, path, password):
+
+        errors = []
+        for key_type in self.key_types:
+            try:
+                return key_type.from_private_key_file(path, password)
+            except paramiko.PasswordRequiredException:
+                raise
+            except (paramiko.SSHException, ValueError) as ex:
+                # not this key type
+                errors.append('%s: %s' % (key_type.__name__, ex))
+
+        raise paramiko.SSHException('Could not read private key %s (%s)' % (path, "; ".join(errors)))
+
+    def agent_keys(self):
+        ''' keys offered by a running ssh-agent, if any '''
+
+        if self.agent is None:
+            with self.lock:
+                if self.agent is None:
+                    try:
+                        self.agent = paramiko.Agent().get_keys()
+                    except Exception as ex:
+                        logger.debug('ssh-agent not available : %s' % ex)
+                        self.agent = ()
+        return self.agent
+
+    def clear(self):
+        with self.lock:
+            self.keys = {}
+            self.failures = {}
+            self.agent = None
+
+
+# shared by all ssh sessions in this process
+key_cache = KeyCache()
 
 
 class SSHTerm(object):
@@ -220,23 +622,34 @@ class SSHTerm(object):
 
     login_complete_guid = 'B79D8677-F58A-4E09-B917-855A6619A951' # GUID
 
-    def __init__(self, node, keyfile):
+    def __init__(self, node, keyfile, window_size=None, max_packet_size=None, compression=False):
         self.prompt = "dust:ssh:%s:$ " % node.name
         self.node = node
         self.keyfile = keyfile
 
+        # transport tuning, None for paramiko defaults
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.compression = compression
+
         self.state = 'not_connected'
         self.transport  = None
         self.chan = None
+        self.leases = 0         # users of this session in the pool
+        self.last_used = time.time()
         self.newchan = None
 
-        self.recvbuf = u('')
+        self.recvbuf = bytearray()
+        self.guid_scan_pos = 0
         self.login_guid_found = True
+        self.output_prefix = ("\n%s%s[%s]%s " % (colorama.Style.BRIGHT, colorama.Fore.WHITE, node.name, 
+                                                colorama.Style.RESET_ALL)).encode('utf-8')
 
         self.raw_shell_mode = False
         self.oldattrs  = None
 
         self.sftp = None # sftp subservice
+        self.sftp_lock = Lock()
 
         self.echo  = True
 
@@ -348,13 +761,17 @@ class SSHTerm(object):
         if ( self.oldattrs ):
             termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.oldattrs)
 
-    def shutdown(self):
-        ''' shutdown this ssh term '''
+    def close(self):
+        ''' close the channel and transport '''
         self.state = 'shutdown'
         if self.chan:
             self.chan.close()
         if self.transport:
             self.transport.close()
+
+    def shutdown(self):
+        ''' shutdown this ssh term '''
+        self.close()
         logger.info( '%s: closed ssh' % self.node.name )
 
     def command(self, line):
@@ -371,6 +788,66 @@ class SSHTerm(object):
         self.chan.send(line)
         self.chan.send('\n')
 
+    def exec_command(self, cmd, bufsize=32768, max_size=None):
+        '''
+        run cmd on a new exec channel on this session's transport and wait for it to finish.
+        no pty and no shell prompt, so the output is exactly what the command wrote.
+        output over max_size bytes per stream is spilled to a temp file, see OutputSink.
+        returns (stdout OutputSink, stderr OutputSink, exit status)
+        '''
+
+        if not self.is_connected():
+            raise Exception('ssh session not connected, authed, or active')
+
+        chan = self.transport.open_session()
+        try:
+            chan.exec_command(cmd)
+
+            # stderr is read while waiting on stdout so a chatty stderr cannot fill the window and stall
+            out = OutputSink(self.node.name, 'out', max_size)
+            err = OutputSink(self.node.name, 'err', max_size)
+            chan.settimeout(0.05)
+            while True:
+                while chan.recv_stderr_ready():
+                    err.write(chan.recv_stderr(bufsize))
+                try:
+                    data = chan.recv(bufsize)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                out.write(data)
+
+            # stdout is at eof, the rest of stderr is already buffered
+            chan.settimeout(None)
+            while True:
+                data = chan.recv_stderr(bufsize)
+                if not data:
+                    break
+                err.write(data)
+
+            exit_status = chan.recv_exit_status()
+        finally:
+            chan.close()
+
+        out.close()
+        err.close()
+
+        return out, err, exit_status
+
+    def exec_channel(self, cmd):
+        '''
+        start cmd on a new exec channel and return the channel, for commands that read a stream
+        on stdin. the caller sends to it, shuts down writes and collects the exit status.
+        '''
+
+        if not self.is_connected():
+            raise Exception('ssh session not connected, authed, or active')
+
+        chan = self.transport.open_session()
+        chan.exec_command(cmd)
+        return chan
+
     #TODO: override port from template
     def connect(self, hostname, username, port=22):
         ''' connect and authenticate ''' 
@@ -382,19 +859,36 @@ class SSHTerm(object):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((hostname, port))
 
-        self.transport = paramiko.Transport(sock)
+        tuning = {}
+        if self.window_size:
+            tuning['default_window_size'] = self.window_size
+        if self.max_packet_size:
+            tuning['default_max_packet_size'] = self.max_packet_size
+
+        self.transport = paramiko.Transport(sock, **tuning)
+        if self.compression:
+            self.transport.use_compression(True)
         self.transport.start_client()
 
         #TODO: check host key
 
-        try:
-            key = paramiko.RSAKey.from_private_key_file(private_key_path)
-        except paramiko.PasswordRequiredException:
-            password = getpass.getpass('RSA key password: ')
-            key = paramiko.RSAKey.from_private_key_file(private_key_path, password)
-
-        if key:
-            self.transport.auth_publickey(username, key)
+        keys = []
+        if private_key_path:
+            try:
+                keys.append(key_cache.get(private_key_path))
+            except KeyLoadError as ex:
+                if not key_cache.agent_keys():
+                    raise
+                logger.debug('%s: trying ssh-agent keys, %s' % (self.node.name, ex))
+        keys.extend(key_cache.agent_keys())
+
+        for key in keys:
+            try:
+                self.transport.auth_publickey(username, key)
+            except paramiko.AuthenticationException:
+                logger.debug('%s: key %s rejected' % (self.node.name, key.get_name()))
+            if self.transport.is_authenticated():
+                break
 
         if not self.transport.is_authenticated():
             self.transport.close()
@@ -406,6 +900,101 @@ class SSHTerm(object):
 
 
 
+class HostTiming(object):
+    ''' per host latency of a fanned out command, connect is 0 for an existing session '''
+
+    __slots__ = ('node', 'connect', 'total', 'error')
+
+    def __init__(self, node):
+        self.node = node
+        self.connect = 0.0
+        self.total = 0.0
+        self.error = None
+
+
+class OutputSink(object):
+    '''
+    collects an output stream in memory up to max_size bytes. past that the whole 
+    stream goes to a per host temp file and only the first max_size bytes stay in memory.
+    digest and size are over the whole stream.
+    '''
+
+    def __init__(self, name, stream, max_size=None):
+        self.name = name
+        self.stream = stream
+        self.max_size = max_size
+        self.head = bytearray()
+        self.size = 0
+        self.digest = hashlib.sha1()
+        self.path = None
+        self.file = None
+
+    def write(self, data):
+
+        self.size += len(data)
+        self.digest.update(data)
+
+        if self.file:
+            self.file.write(data)
+            return
+
+        room = len(data) if self.max_size is None else self.max_size - len(self.head)
+        if len(data) <= room:
+            self.head += data
+            return
+
+        fd, self.path = tempfile.mkstemp(prefix='dust-%s-' % self.name, suffix='.%s' % self.stream)
+        self.file = os.fdopen(fd, 'wb')
+        self.file.write(self.head)
+        self.file.write(data)
+        self.head += data[:room]
+        logger.debug('%s: output over %d bytes, spilling to %s' % (self.name, self.max_size, self.path))
+
+    def getvalue(self):
+        return bytes(self.head)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class ExecResult(object):
+    '''
+    result of a command run on one node over an exec channel.
+    exit_status is None if the command could not be run, error says why.
+    '''
+
+    __slots__ = ('node', 'cmd', 'stdout', 'stderr', 'exit_status', 'error', 'connect', 'elapsed',
+                 'stdout_size', 'stderr_size', 'stdout_file', 'stderr_file', 'digest')
+
+    def __init__(self, node, cmd):
+        self.node = node
+        self.cmd = cmd
+        self.stdout = ''        # up to buffer_max bytes of output, all of it is in stdout_file if that is set
+        self.stderr = ''
+        self.stdout_size = 0
+        self.stderr_size = 0
+        self.stdout_file = None
+        self.stderr_file = None
+        self.digest = None      # over the complete output and exit status, to group identical results
+        self.exit_status = None
+        self.error = None
+        self.connect = 0.0      # seconds to log in, 0 if the session was open
+        self.elapsed = 0.0      # seconds from dispatch to exit, including connect
+
+    @property
+    def ok(self):
+        return self.exit_status == 0
+
+    @property
+    def truncated(self):
+        return bool(self.stdout_file or self.stderr_file)
+
+    def __repr__(self):
+        return "ExecResult(%s, exit_status=%s, error=%s)" % (self.node.name, self.exit_status, self.error)
+
+
 class LineTerm(object):
     '''
     top level api - implements ssh and raw terminal functionality for a set of nodes 
@@ -413,6 +1002,46 @@ class LineTerm(object):
 
     def __init__(self):
         self.session_manager = SessionManager()
+        self.ssh_concurrency = 32
+        self.buffer_max = ReceiveDemux.buffer_max
+        self.sftp_stripes = 4                       # sftp channels per file for large files
+        self.stripe_transports = 1                  # ssh connections the stripes are spread over
+        self.stripe_min_size = 64 * 1024 * 1024     # files smaller than this use one channel
+
+    def configure(self, ssh_concurrency=None, buffer_max=None, max_sessions=None, max_idle=None,
+                        window_size=None, max_packet_size=None, compression=None,
+                        sftp_stripes=None, stripe_transports=None, stripe_min_size=None):
+        ''' tunables from user_data. window and packet size and compression apply to new sessions '''
+        if ssh_concurrency:
+            self.ssh_concurrency = max(1, int(ssh_concurrency))
+        if buffer_max:
+            self.buffer_max = max(65536, int(buffer_max))
+            self.session_manager.demux.buffer_max = self.buffer_max
+        if max_sessions:
+            self.session_manager.max_sessions = max(1, int(max_sessions))
+        if max_idle:
+            self.session_manager.max_idle = int(max_idle)
+
+        options = self.session_manager.transport_options
+        if window_size:
+            options['window_size'] = int(window_size)
+        if max_packet_size:
+            options['max_packet_size'] = int(max_packet_size)
+        if compression is not None:
+            options['compression'] = bool(compression)
+
+        if sftp_stripes:
+            self.sftp_stripes = max(1, int(sftp_stripes))
+        if stripe_transports:
+            self.stripe_transports = max(1, int(stripe_transports))
+        if stripe_min_size:
+            self.stripe_min_size = int(stripe_min_size)
+
+    def prune_sessions(self, region, live_ids, known_ids=None):
+        ''' close ssh sessions to nodes that are gone, see SessionManager.prune '''
+        closed = self.session_manager.prune(region, live_ids, known_ids)
+        if closed:
+            logger.debug('closed %d ssh sessions to nodes no longer in the inventory' % closed)
 
     def set_refresh_callback(self, callback):
         '''Optional callback after a block of ssh output is written to stdout. 
@@ -428,7 +1057,7 @@ class LineTerm(object):
         term = None
         try:
             rawshell= False if cmd else True
-            term = self.session_manager.term_from_node(node, keyfile, rawshell=rawshell)
+            term = self.session_manager.acquire(node, keyfile, rawshell=rawshell)
 
             if cmd:
                 if term.echo:
@@ -444,6 +1073,122 @@ class LineTerm(object):
         finally:
             if term:
                 term.revert_tty()
+                self.session_manager.release(term)
+
+    def command_all(self, targets, cmd):
+        '''
+        send cmd to the interactive shells of many nodes at once, logging in where needed.
+        targets is a list of (keyfile, node). connects run on a pool of ssh_concurrency workers.
+        returns a list of HostTiming, one per target, in target order
+        '''
+
+        def run(target):
+            keyfile, node = target
+            timing = HostTiming(node)
+            start = time.time()
+            term = None
+            try:
+                term = self.session_manager.acquire(node, keyfile)
+                timing.connect = time.time() - start
+                if term.echo:
+                    term.disable_echo()
+                term.command(cmd)
+            except Exception as e:
+                timing.error = str(e) or e.__class__.__name__
+                logger.error('%s: ssh error: %s' % (node.name, timing.error))
+            finally:
+                if term:
+                    self.session_manager.release(term)
+            timing.total = time.time() - start
+            return timing
+
+        if not targets:
+            return []
+
+        workers = min(self.ssh_concurrency, len(targets))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            timings = list(pool.map(run, targets))
+
+        for timing in timings:
+            logger.debug('%s: connect %.3fs, dispatch %.3fs' % (timing.node.name, timing.connect, timing.total - timing.connect))
+
+        return timings
+
+    def exec_all(self, targets, cmd):
+        '''
+        run cmd on many nodes over exec channels and wait for all of them to exit.
+        targets is a list of (keyfile, node), logins reuse or create the node's ssh session.
+        returns a list of ExecResult in target order
+        '''
+
+        def run(target):
+            keyfile, node = target
+            result = ExecResult(node, cmd)
+            start = time.time()
+            term = None
+            try:
+                term = self.session_manager.acquire(node, keyfile)
+                result.connect = time.time() - start
+                stdout, stderr, result.exit_status = term.exec_command(cmd, max_size=self.buffer_max)
+                result.stdout = stdout.getvalue().decode('utf-8', 'replace')
+                result.stderr = stderr.getvalue().decode('utf-8', 'replace')
+                result.stdout_size, result.stdout_file = stdout.size, stdout.path
+                result.stderr_size, result.stderr_file = stderr.size, stderr.path
+                digest = "%s:%s:%s" % (result.exit_status, stdout.digest.hexdigest(), stderr.digest.hexdigest())
+            except Exception as e:
+                result.error = str(e) or e.__class__.__name__
+                logger.debug('%s: exec error: %s' % (node.name, result.error))
+                digest = "error:%s" % result.error
+            finally:
+                if term:
+                    self.session_manager.release(term)
+            result.digest = hashlib.sha1(digest.encode('utf-8')).hexdigest()
+            result.elapsed = time.time() - start
+            return result
+
+        if not targets:
+            return []
+
+        workers = min(self.ssh_concurrency, len(targets))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(run, targets))
+
+    def open_stripes(self, term, keyfile):
+        '''
+        sftp clients for striped transfers to term's node: sftp_stripes channels, each with its own
+        window, spread over term and stripe_transports - 1 extra logins. every transport does its
+        crypto on its own thread. returns (sftp clients, extra sessions), close them with close_stripes
+        '''
+
+        terms = [term]
+        sftps = []
+        try:
+            for i in range(self.stripe_transports - 1):
+                terms.append(self.session_manager.connect(term.node, keyfile))
+            for i in range(self.sftp_stripes):
+                stripe_term = terms[i % len(terms)]
+                sftps.append(paramiko.SFTPClient.from_transport(stripe_term.transport, window_size=stripe_term.window_size,
+                                                                max_packet_size=stripe_term.max_packet_size))
+        except Exception:
+            self.close_stripes(sftps, terms[1:])
+            raise
+
+        return sftps, terms[1:]
+
+    def close_stripes(self, sftps, extra_terms):
+        for sftp in sftps:
+            sftp.close()
+        for term in extra_terms:
+            self.session_manager.close_session(term)
+
+    def open_sftp(self, term):
+        ''' the sftp client on a session, opened on first use and shared by the threads using the session '''
+
+        with term.sftp_lock:
+            if not term.sftp:
+                term.sftp = paramiko.SFTPClient.from_transport(term.transport, window_size=term.window_size,
+                                                                   max_packet_size=term.max_packet_size)
+            return term.sftp
 
     def shell(self, keyfile, node):
 
@@ -455,59 +1200,45 @@ class LineTerm(object):
         self.command(keyfile, node, cmd=None)
 
     def put(self, keyfile, node, srcfile, destdir=None):
+        ''' upload one file to one node, see transfer.put_files for many '''
 
         if not os.path.isfile(srcfile):
             logger.error('file does not exist locally : %s' % srcfile)
             return
 
+        term = None
         try:
-            term = self.session_manager.term_from_node(node, keyfile)
-            if not term.sftp:
-                term.sftp = paramiko.SFTPClient.from_transport(term.transport)
-
-            sftp = term.sftp
-            fname = os.path.basename(srcfile)
-            if not destdir:
-                destfile = fname
-            else:
-                destfile = destdir + "/" + fname
-            ret = sftp.put(srcfile, destfile, confirm=True)
-
-            if not getattr(ret, 'filename', None):
-                ret.filename = os.path.basename(destfile)
-            
-            logger.info('uploaded to %s : %s' % (node.name, ret))
+            term = self.session_manager.acquire(node, keyfile)
+            destfile = transfer.remote_path(srcfile, destdir)
+            sent = transfer.upload(self.open_sftp(term), srcfile, destfile)
+            logger.info('uploaded to %s : %s (%d bytes)' % (node.name, destfile, sent))
         except Exception as e:
             logger.error(e)
-
+        finally:
+            if term:
+                self.session_manager.release(term)
 
     def get(self, keyfile, node, remotefile, localdir):
+        ''' download one file from one node to localdir/file.nodename, see transfer.get_files for many '''
 
         if localdir and not os.path.isdir(localdir):
             logger.error('dir does not exist locally : %s' % localdir)
             return
 
+        term = None
         try:
-            term = self.session_manager.term_from_node(node, keyfile)
-            if not term.sftp:
-                term.sftp = paramiko.SFTPClient.from_transport(term.transport)
-
-            fname = os.path.basename(remotefile)
-            if localdir:
-                localfile = os.path.join(localdir, fname)
-            else:
-                localfile = fname
-
-            localfile = '%s.%s' % (localfile, node.name)
+            term = self.session_manager.acquire(node, keyfile)
+            sftp = self.open_sftp(term)
+            localfile = '%s.%s' % (os.path.join(localdir or '', os.path.basename(remotefile)), node.name)
 
-            sftp = term.sftp
             logger.info('getting %s' % (remotefile))
-
-            sftp.get(remotefile, localfile)
-
+            transfer.download(sftp, remotefile, localfile, sftp.stat(remotefile).st_size)
             logger.info('downloaded from %s : %s' % (node.name, localfile))
         except Exception as e:
             logger.error(e)
+        finally:
+            if term:
+                self.session_manager.release(term)
 
     def shutdown(self):
         self.session_manager.shutdown()
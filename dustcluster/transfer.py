@@ -0,0 +1,1423 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+'''
+Parallel sftp transfers between the local host and many nodes
+'''
+
+import os
+import sys
+import gzip
+import mmap
+import time
+import stat
+import shutil
+import shlex
+import hashlib
+import fnmatch
+import uuid
+import random
+import tarfile
+import posixpath
+from collections import Counter
+from threading import Lock, Thread
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor
+
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+# optional, get -z uses zstd on nodes that have it only if it can be decompressed here
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MB = 1024.0 * 1024.0
+
+# bytes per local read or write. paramiko splits these into sftp requests of up to 32K
+blocksize = 256 * 1024
+
+# block size for put -b deltas, one md5 per block is fetched from the node
+delta_blocksize = 1024 * 1024
+
+# striped transfers hand out the file to their channels in pieces of this size
+stripe_piece = 16 * 1024 * 1024
+
+
+class TransferResult(object):
+    ''' files and bytes moved to or from one node '''
+
+    __slots__ = ('node', 'files', 'bytes', 'sent', 'skipped', 'deleted', 'elapsed', 'error')
+
+    def __init__(self, node):
+        self.node = node
+        self.files = 0
+        self.bytes = 0
+        self.sent = 0           # bytes actually sent, less than bytes when files were skipped, resumed or delta'd
+        self.skipped = 0        # files already up to date
+        self.deleted = 0        # remote files removed by sync
+        self.elapsed = 0.0
+        self.error = None
+
+    @property
+    def rate(self):
+        ''' MB/s '''
+        return self.bytes / MB / self.elapsed if self.elapsed else 0.0
+
+
+class Progress(object):
+    '''
+    progress of a transfer to or from many hosts, shown on one status line on a terminal:
+    overall percentage, aggregate MB/s, hosts done and the host that is furthest behind
+    '''
+
+    interval = 0.5      # seconds between status line updates
+
+    def __init__(self, op, host_totals):
+
+        self.op = op
+        self.host_totals = host_totals     # { host : expected bytes }
+        self.total = sum(host_totals.values())
+        self.done = {}          # { host : bytes in finished files }
+        self.inflight = {}      # { (host, path) : bytes so far }
+        self.hosts_done = 0
+        self.start = time.time()
+        self.last_shown = 0
+        self.width = 0
+        self.lock = Lock()
+        self.enabled = sys.stdout.isatty()
+
+    def add_total(self, host, nbytes):
+        ''' bytes expected from a host, for downloads where sizes are known once remote files are listed '''
+        with self.lock:
+            self.host_totals[host] = self.host_totals.get(host, 0) + nbytes
+            self.total += nbytes
+
+    def callback(self, host, path):
+        ''' a paramiko progress callback for one file '''
+
+        def progress(transferred, total):
+            with self.lock:
+                self.inflight[(host, path)] = transferred
+            self.show()
+
+        return progress
+
+    def file_done(self, host, path, nbytes):
+        with self.lock:
+            self.inflight.pop((host, path), None)
+            self.done[host] = self.done.get(host, 0) + nbytes
+        self.show()
+
+    def host_done(self, host):
+        with self.lock:
+            self.hosts_done += 1
+            for key in [key for key in self.inflight if key[0] == host]:
+                del self.inflight[key]
+        self.show()
+
+    def transferred(self, host=None):
+        if host:
+            return self.done.get(host, 0) + sum(n for (h, p), n in self.inflight.items() if h == host)
+        return sum(self.done.values()) + sum(self.inflight.values())
+
+    def show(self, force=False):
+
+        now = time.time()
+        if not self.enabled or (not force and now - self.last_shown < self.interval):
+            return
+
+        with self.lock:
+            self.last_shown = now
+            transferred = self.transferred()
+            elapsed = max(now - self.start, 0.001)
+
+            # furthest behind of the hosts still transferring
+            behind = ""
+            active = set(h for h, p in self.inflight)
+            if active:
+                host = min(active, key=lambda h: self.transferred(h) / float(self.host_totals.get(h) or 1))
+                total = self.host_totals.get(host) or 1
+                behind = ", slowest %s %d%%" % (host, 100 * self.transferred(host) // total)
+
+            pct = 100 * transferred // self.total if self.total else 100
+            line = "%s %3d%% %.1f/%.1f MB %.1f MB/s, %d/%d hosts done%s" % (self.op, pct, transferred / MB, self.total / MB,
+                                                    transferred / MB / elapsed, self.hosts_done, len(self.host_totals), behind)
+
+            self.width = max(self.width, len(line))
+            sys.stdout.write("\r" + line.ljust(self.width))
+            sys.stdout.flush()
+
+    def finish(self):
+        if self.enabled and self.width:
+            sys.stdout.write("\r" + " " * self.width + "\r")
+            sys.stdout.flush()
+
+
+def remote_path(srcfile, destdir):
+    ''' destination of a local file in a remote dir, the remote cwd if destdir is empty '''
+
+    fname = os.path.basename(srcfile)
+    if not destdir:
+        return fname
+    return destdir.rstrip("/") + "/" + fname
+
+
+def upload(sftp, srcfile, destfile, callback=None, offset=0):
+    '''
+    copy a local file to the remote destfile with pipelined writes: requests are sent without 
+    waiting for their acks, which are collected when the file is closed. unlike sftp.put there
+    is no stat round trip afterwards. with an offset the remote file is kept and written from
+    offset on, to resume a partial upload. returns the number of bytes written
+    '''
+
+    size = os.path.getsize(srcfile)
+    written = 0
+    with open(srcfile, 'rb') as fl:
+        with sftp.open(destfile, 'r+' if offset else 'wb') as fr:
+            fr.set_pipelined(True)
+            if offset:
+                fl.seek(offset)
+                fr.seek(offset)
+            while True:
+                data = fl.read(blocksize)
+                if not data:
+                    break
+                fr.write(data)
+                written += len(data)
+                if callback:
+                    callback(offset + written, size)
+
+    return written
+
+
+def file_sha256(path, length=None):
+    ''' hex sha256 of a local file, or of its first length bytes '''
+
+    digest = hashlib.sha256()
+    remaining = length
+    with open(path, 'rb') as fh:
+        while remaining is None or remaining > 0:
+            data = fh.read(blocksize if remaining is None else min(blocksize, remaining))
+            if not data:
+                break
+            digest.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return digest.hexdigest()
+
+
+class Pieces(object):
+    ''' the (offset, length) pieces of a file, handed out to the channels of a striped transfer as they ask '''
+
+    def __init__(self, size, callback=None):
+        self.pieces = [(offset, min(stripe_piece, size - offset)) for offset in range(0, size, stripe_piece)]
+        self.size = size
+        self.done = 0
+        self.callback = callback
+        self.lock = Lock()
+
+    def next(self):
+        with self.lock:
+            return self.pieces.pop(0) if self.pieces else None
+
+    def progress(self, nbytes):
+        with self.lock:
+            self.done += nbytes
+            done = self.done
+        if self.callback:
+            self.callback(done, self.size)
+
+
+def striped_upload(sftps, srcfile, destfile, callback=None):
+    '''
+    upload one file over several sftp channels at once: each channel takes the next piece of the
+    file, read from a memory map, and writes it at its offset with pipelined writes.
+    returns the number of bytes written
+    '''
+
+    size = os.path.getsize(srcfile)
+    if not size:
+        return upload(sftps[0], srcfile, destfile, callback)
+
+    with sftps[0].open(destfile, 'wb'):
+        pass
+    pieces = Pieces(size, callback)
+
+    def send(sftp):
+        with sftp.open(destfile, 'r+') as fr:
+            fr.set_pipelined(True)
+            while True:
+                piece = pieces.next()
+                if not piece:
+                    break
+                offset, length = piece
+                fr.seek(offset)
+                for pos in range(offset, offset + length, blocksize):
+                    end = min(pos + blocksize, offset + length)
+                    fr.write(mm[pos:end])
+                    pieces.progress(end - pos)
+
+    with open(srcfile, 'rb') as fl:
+        with mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with ThreadPoolExecutor(max_workers=len(sftps)) as pool:
+                list(pool.map(send, sftps))
+
+    return size
+
+
+def striped_download(sftps, remotefile, localfile, size, callback=None):
+    '''
+    download one file of known size over several sftp channels at once: each channel takes the
+    next piece, reads it with pipelined requests and writes it at its offset in localfile.
+    returns the number of bytes read
+    '''
+
+    if not size:
+        return download(sftps[0], remotefile, localfile, size, callback)
+
+    with open(localfile, 'wb') as fl:
+        fl.truncate(size)
+    pieces = Pieces(size, callback)
+
+    def receive(sftp):
+        with sftp.open(remotefile, 'rb') as fr:
+            while True:
+                piece = pieces.next()
+                if not piece:
+                    break
+                offset, length = piece
+                chunks = [(pos, min(blocksize, offset + length - pos)) for pos in range(offset, offset + length, blocksize)]
+                for (pos, nbytes), data in zip(chunks, fr.readv(chunks)):
+                    if len(data) != nbytes:
+                        raise Exception('short read of %s at %d' % (remotefile, pos))
+                    os.pwrite(fd, data, pos)
+                    pieces.progress(nbytes)
+
+    fd = os.open(localfile, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=len(sftps)) as pool:
+            list(pool.map(receive, sftps))
+    finally:
+        os.close(fd)
+
+    return size
+
+
+class NodeStripes(object):
+    '''
+    the striping channels to one node, opened by the first large file and shared by the rest.
+    if they cannot be opened, large files go over the node's one sftp channel
+    '''
+
+    def __init__(self, lineterm, term, keyfile, sftp):
+        self.lineterm = lineterm
+        self.term = term
+        self.keyfile = keyfile
+        self.sftp = sftp
+        self.sftps = None
+        self.extra_terms = []
+        self.lock = Lock()
+
+    def get(self):
+        with self.lock:
+            if self.sftps is None:
+                try:
+                    self.sftps, self.extra_terms = self.lineterm.open_stripes(self.term, self.keyfile)
+                except Exception as e:
+                    logger.info('%s: could not open sftp stripes (%s), using one channel' % (self.term.node.name, e))
+                    self.sftps = []
+            return self.sftps or [self.sftp]
+
+    def close(self):
+        if self.sftps:
+            self.lineterm.close_stripes(self.sftps, self.extra_terms)
+
+
+def striped(lineterm, size):
+    ''' should a file of size be striped '''
+    return lineterm.sftp_stripes > 1 and size >= lineterm.stripe_min_size
+
+
+class LocalDigests(object):
+    '''
+    checksums of local files, computed once per put and shared by all the node workers.
+    keyed by (path, length) for sha256 of a prefix, and (path, blocksize) for block md5s
+    '''
+
+    def __init__(self):
+        self.sha256s = {}
+        self.block_md5s = {}
+        self.lock = Lock()
+
+    def sha256(self, path, length=None):
+
+        with self.lock:
+            key = (path, length)
+            if key not in self.sha256s:
+                self.sha256s[key] = file_sha256(path, length)
+            return self.sha256s[key]
+
+    def blocks(self, path, bsize):
+
+        with self.lock:
+            key = (path, bsize)
+            if key not in self.block_md5s:
+                ret = []
+                with open(path, 'rb') as fh:
+                    while True:
+                        data = fh.read(bsize)
+                        if not data:
+                            break
+                        ret.append(hashlib.md5(data).hexdigest())
+                self.block_md5s[key] = ret
+            return self.block_md5s[key]
+
+
+# one md5 per block of the file, with python on the node or else dd, so there is no round trip per block
+block_md5_script = '''
+import sys, hashlib
+with open(sys.argv[1], 'rb') as fh:
+    while True:
+        data = fh.read(int(sys.argv[2]))
+        if not data:
+            break
+        print(hashlib.md5(data).hexdigest())
+'''
+
+def remote_sha256(term, path, length=None):
+    ''' sha256 of a remote file or its first length bytes, run on an exec channel. None if it cannot be read '''
+
+    cmd = "sha256sum %s" % shlex.quote(path)
+    if length is not None:
+        cmd = "head -c %d %s | sha256sum" % (length, shlex.quote(path))
+
+    out, err, exit_status = term.exec_command(cmd)
+    fields = out.getvalue().split()
+    if exit_status != 0 or not fields:
+        return None
+    return fields[0].decode('ascii')
+
+
+def remote_blocks(term, path, bsize, size):
+    ''' md5s of the bsize blocks of a remote file of size bytes '''
+
+    qpath = shlex.quote(path)
+    nblocks = (size + bsize - 1) // bsize
+    cmd = ("if command -v python3 >/dev/null 2>&1; then python3 -c %s %s %d; "
+           "else i=0; while [ $i -lt %d ]; do dd if=%s bs=%d skip=$i count=1 2>/dev/null | md5sum | cut -d' ' -f1; i=$((i+1)); done; fi"
+                % (shlex.quote(block_md5_script), qpath, bsize, nblocks, qpath, bsize))
+
+    out, err, exit_status = term.exec_command(cmd)
+    if exit_status != 0:
+        raise Exception('could not checksum %s: %s' % (path, err.getvalue().decode('utf-8', 'replace').strip()))
+    return out.getvalue().decode('ascii').split()
+
+
+def update_file(term, sftp, srcfile, destfile, digests, delta=False, callback=None):
+    '''
+    upload srcfile unless destfile already has the same content, checked with sha256sum on the node.
+    a remote file that is a prefix of srcfile is a partial upload and is resumed from its size.
+    with delta, a remote file that differs has only its changed delta_blocksize blocks rewritten.
+    returns the number of bytes sent
+    '''
+
+    size = os.path.getsize(srcfile)
+    try:
+        remote_size = sftp.stat(destfile).st_size
+    except IOError:
+        remote_size = None
+
+    if not remote_size:
+        return upload(sftp, srcfile, destfile, callback)
+
+    if remote_size == size:
+        if remote_sha256(term, destfile) == digests.sha256(srcfile):
+            if callback:
+                callback(size, size)
+            return 0
+    elif remote_size < size:
+        if remote_sha256(term, destfile) == digests.sha256(srcfile, remote_size):
+            logger.debug('%s: resuming %s at %d bytes' % (term.node.name, destfile, remote_size))
+            return upload(sftp, srcfile, destfile, callback, offset=remote_size)
+
+    if not delta:
+        return upload(sftp, srcfile, destfile, callback)
+
+    return delta_upload(term, sftp, srcfile, destfile, remote_size, digests, callback)
+
+
+def delta_upload(term, sftp, srcfile, destfile, remote_size, digests, callback=None):
+    '''
+    rewrite the blocks of destfile that differ from srcfile in place, then truncate it to size
+    and verify the whole file. blocks are at fixed offsets, so this suits appends and in place
+    changes, not inserts. returns the number of bytes sent
+    '''
+
+    size = os.path.getsize(srcfile)
+    bsize = delta_blocksize
+    theirs = remote_blocks(term, destfile, bsize, remote_size)
+    ours = digests.blocks(srcfile, bsize)
+
+    sent = 0
+    with open(srcfile, 'rb') as fl:
+        with sftp.open(destfile, 'r+') as fr:
+            fr.set_pipelined(True)
+            for i, digest in enumerate(ours):
+                if i < len(theirs) and theirs[i] == digest:
+                    continue
+                fl.seek(i * bsize)
+                data = fl.read(bsize)
+                fr.seek(i * bsize)
+                fr.write(data)
+                sent += len(data)
+                if callback:
+                    callback(min(size, (i + 1) * bsize), size)
+
+    if remote_size > size:
+        sftp.truncate(destfile, size)
+
+    if remote_sha256(term, destfile) != digests.sha256(srcfile):
+        raise Exception('checksum mismatch after delta upload of %s' % destfile)
+
+    logger.debug('%s: delta upload of %s sent %d of %d bytes' % (term.node.name, destfile, sent, size))
+    return sent
+
+
+def download(sftp, remotefile, localfile, size, callback=None):
+    '''
+    copy remotefile of known size to localfile, with all read requests issued ahead (prefetch)
+    so the transfer is not one round trip per 32K. returns the number of bytes read
+    '''
+
+    received = 0
+    with sftp.open(remotefile, 'rb') as fr:
+        fr.prefetch(size)
+        with open(localfile, 'wb') as fl:
+            while True:
+                data = fr.read(blocksize)
+                if not data:
+                    break
+                fl.write(data)
+                received += len(data)
+                if callback:
+                    callback(received, size)
+
+    return received
+
+
+def put_files(lineterm, targets, srcfiles, destdir=None, files_per_node=4, update=False, delta=False):
+    '''
+    upload local files to many nodes at once.
+    targets is a list of (keyfile, node). nodes are served by a pool of lineterm.ssh_concurrency
+    workers, and each node has up to files_per_node files in flight on its sftp session.
+    with update, files already on a node are skipped and partial ones resumed, delta also
+    sends only the changed blocks of files that differ. see update_file.
+    returns (list of TransferResult in target order, elapsed seconds)
+    '''
+
+    digests = LocalDigests()
+    sizes = dict( (srcfile, os.path.getsize(srcfile)) for srcfile in srcfiles )
+    per_host = sum(sizes.values())
+    labels = dict( (id(node), label) for (keyfile, node), label in zip(targets, host_labels([node for keyfile, node in targets])) )
+    progress = Progress('put', dict( (label, per_host) for label in labels.values() ))
+
+    def put_node(target):
+
+        keyfile, node = target
+        host = labels[id(node)]
+        result = TransferResult(node)
+        start = time.time()
+        term = None
+        stripes = None
+        try:
+            term = lineterm.session_manager.acquire(node, keyfile)
+            sftp = lineterm.open_sftp(term)
+            stripes = NodeStripes(lineterm, term, keyfile, sftp)
+
+            def put_file(srcfile):
+                destfile = remote_path(srcfile, destdir)
+                callback = progress.callback(host, srcfile)
+                if update or delta:
+                    sent = update_file(term, sftp, srcfile, destfile, digests, delta, callback)
+                elif striped(lineterm, sizes[srcfile]):
+                    sent = striped_upload(stripes.get(), srcfile, destfile, callback)
+                    if remote_sha256(term, destfile) != digests.sha256(srcfile):
+                        raise Exception('checksum mismatch after striped upload of %s' % destfile)
+                else:
+                    sent = upload(sftp, srcfile, destfile, callback)
+                progress.file_done(host, srcfile, sizes[srcfile])
+                logger.debug('%s: uploaded %s to %s, sent %d bytes' % (node.name, srcfile, destfile, sent))
+                return sizes[srcfile], sent
+
+            workers = max(1, min(files_per_node, len(srcfiles)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for nbytes, sent in pool.map(put_file, srcfiles):
+                    result.files += 1
+                    result.bytes += nbytes
+                    result.sent += sent
+                    if nbytes and not sent:
+                        result.skipped += 1
+
+        except Exception as e:
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            if stripes:
+                stripes.close()
+            if term:
+                lineterm.session_manager.release(term)
+            progress.host_done(host)
+
+        result.elapsed = time.time() - start
+        return result
+
+    return run_all(lineterm, targets, put_node, progress)
+
+
+# serves one file to the listed peers over tcp, then exits. peers that do not connect within timeout are given up on
+serve_script = '''
+import sys, socket, threading
+path, port, timeout, peers = sys.argv[1], int(sys.argv[2]), float(sys.argv[3]), sys.argv[4:]
+srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+srv.bind(('', port))
+srv.listen(len(peers))
+srv.settimeout(timeout)
+def send(conn):
+    with conn, open(path, 'rb') as fh:
+        conn.sendfile(fh)
+threads = []
+while peers:
+    try:
+        conn, addr = srv.accept()
+    except socket.timeout:
+        break
+    if addr[0] not in peers:
+        conn.close()
+        continue
+    peers.remove(addr[0])
+    thread = threading.Thread(target=send, args=(conn,))
+    thread.start()
+    threads.append(thread)
+for thread in threads:
+    thread.join()
+'''
+
+# pulls a file from a serving peer into path, retrying the connect while the peer starts listening
+fetch_script = '''
+import os, sys, time, socket
+host, port, timeout, path = sys.argv[1], int(sys.argv[2]), float(sys.argv[3]), sys.argv[4]
+deadline = time.time() + timeout
+while True:
+    try:
+        sock = socket.create_connection((host, port), timeout)
+        break
+    except (OSError, socket.error):
+        if time.time() > deadline:
+            raise
+        time.sleep(0.2)
+with sock, open(path + '.part', 'wb') as fh:
+    while True:
+        data = sock.recv(1048576)
+        if not data:
+            break
+        fh.write(data)
+os.rename(path + '.part', path)
+'''
+
+def broadcast_files(lineterm, targets, srcfiles, destdir=None, seeds=2, fanout=3, timeout=60):
+    '''
+    upload local files to many nodes without sending each copy from this host.
+    each file is uploaded to a few seed nodes over sftp, then in rounds every node that has it
+    serves it to up to fanout nodes that do not, over the intra cluster network. a node pulls
+    from its parent's private ip on an exec channel and sha256sums the result.
+    nodes that fail to pull are uploaded to directly at the end.
+    returns (list of TransferResult in target order, elapsed seconds)
+    '''
+
+    start = time.time()
+    digests = LocalDigests()
+    sizes = dict( (srcfile, os.path.getsize(srcfile)) for srcfile in srcfiles )
+
+    # nodes are referred to by their position in targets, names need not be unique
+    nodes = [node for keyfile, node in targets]
+    hosts = host_labels(nodes)
+    progress = Progress('put', dict( (host, sum(sizes.values())) for host in hosts ))
+    results = [TransferResult(node) for node in nodes]
+    terms = [None] * len(targets)
+
+    def done(pos, srcfile, sent):
+        result = results[pos]
+        result.files += 1
+        result.bytes += sizes[srcfile]
+        result.sent += sent
+        progress.file_done(hosts[pos], srcfile, sizes[srcfile])
+
+    def direct(pos, srcfile):
+        ''' sftp from here, for seeds and nodes that could not pull from a peer '''
+        try:
+            destfile = remote_path(srcfile, destdir)
+            sent = upload(lineterm.open_sftp(terms[pos]), srcfile, destfile, progress.callback(hosts[pos], srcfile))
+            # seeds serve the file to their peers, check it like a pulled copy is checked
+            if remote_sha256(terms[pos], destfile) != digests.sha256(srcfile):
+                raise Exception('checksum mismatch after upload of %s' % destfile)
+            done(pos, srcfile, sent)
+            return True
+        except Exception as e:
+            results[pos].error = str(e) or e.__class__.__name__
+            return False
+
+    def serve(parent, children, srcfile):
+        ''' run the server on parent and the fetches on children, returns the children that have the file '''
+
+        destfile = remote_path(srcfile, destdir)
+        port = random.randint(20000, 60000)
+        ips = [nodes[child].get('private_ip_address') for child in children]
+        def run_server():
+            try:
+                cmd = "python3 -c %s %s %d %d %s" % (shlex.quote(serve_script), shlex.quote(destfile), port, timeout, " ".join(ips))
+                out, err, exit_status = terms[parent].exec_command(cmd)
+                if exit_status != 0:
+                    logger.debug('%s: serving %s failed: %s' % (hosts[parent], destfile, err.getvalue().decode('utf-8', 'replace').strip()))
+            except Exception as e:
+                logger.debug('%s: serving %s failed: %s' % (hosts[parent], destfile, e))
+
+        server = Thread(target=run_server)
+        server.start()
+
+        def fetch(child):
+            try:
+                cmd = "python3 -c %s %s %d %d %s && sha256sum %s" % (shlex.quote(fetch_script), nodes[parent].get('private_ip_address'),
+                                                    port, timeout, shlex.quote(destfile), shlex.quote(destfile))
+                out, err, exit_status = terms[child].exec_command(cmd)
+                fields = out.getvalue().split()
+                if exit_status == 0 and fields and fields[0].decode('ascii') == digests.sha256(srcfile):
+                    done(child, srcfile, 0)
+                    return True
+                logger.debug('%s: could not pull %s from %s: %s' % (hosts[child], destfile, hosts[parent],
+                                                                    err.getvalue().decode('utf-8', 'replace').strip()))
+            except Exception as e:
+                logger.debug('%s: could not pull %s from %s: %s' % (hosts[child], destfile, hosts[parent], e))
+            return False
+
+        with ThreadPoolExecutor(max_workers=len(children)) as pool:
+            ok = list(pool.map(fetch, children))
+        server.join()
+
+        return [child for child, pulled in zip(children, ok) if pulled]
+
+    try:
+        def connect(pos):
+            keyfile, node = targets[pos]
+            try:
+                terms[pos] = lineterm.session_manager.acquire(node, keyfile)
+                return True
+            except Exception as e:
+                results[pos].error = str(e) or e.__class__.__name__
+                return False
+
+        positions = list(range(len(targets)))
+        with ThreadPoolExecutor(max_workers=max(1, min(lineterm.ssh_concurrency, len(targets)))) as pool:
+            live = [pos for pos, connected in zip(positions, pool.map(connect, positions)) if connected]
+
+        for srcfile in srcfiles:
+
+            live = [pos for pos in live if not results[pos].error]
+            if not live:
+                break
+
+            with ThreadPoolExecutor(max_workers=max(1, min(seeds, len(live)))) as pool:
+                ok = list(pool.map(lambda pos: direct(pos, srcfile), live[:seeds]))
+            have = [pos for pos, sent in zip(live[:seeds], ok) if sent]
+            pending = live[seeds:]
+            missed = []
+
+            while pending and have:
+                rounds = []
+                for parent in have:
+                    if not pending:
+                        break
+                    rounds.append((parent, pending[:fanout]))
+                    pending = pending[fanout:]
+
+                with ThreadPoolExecutor(max_workers=min(lineterm.ssh_concurrency, len(rounds))) as pool:
+                    pulled = list(pool.map(lambda job: serve(job[0], job[1], srcfile), rounds))
+
+                for (parent, children), got in zip(rounds, pulled):
+                    have.extend(got)
+                    missed.extend(child for child in children if child not in got)
+
+            missed.extend(pending)
+            if missed:
+                logger.info('%d nodes could not pull %s from a peer, uploading directly' % (len(missed), srcfile))
+                with ThreadPoolExecutor(max_workers=min(lineterm.ssh_concurrency, len(missed))) as pool:
+                    list(pool.map(lambda pos: direct(pos, srcfile), missed))
+
+    finally:
+        for term in terms:
+            if term:
+                lineterm.session_manager.release(term)
+        progress.finish()
+
+    elapsed = time.time() - start
+    for result in results:
+        result.elapsed = elapsed
+
+    return results, elapsed
+
+
+def pull_command(pulls):
+    '''
+    shell command that downloads each (url, destfile) with curl, moves it into place once complete
+    and prints its sha256sum
+    '''
+
+    cmds = []
+    for url, destfile in pulls:
+        dest = shlex.quote(destfile)
+        part = shlex.quote(destfile + '.part')
+        cmds.append("curl -fsS --retry 3 -o %s %s && mv %s %s && sha256sum %s" % (part, shlex.quote(url), part, dest, dest))
+    return " && ".join(cmds)
+
+
+def stage_files(lineterm, targets, srcfiles, s3, bucket, destdir=None, prefix='dust-staging', expires=3600):
+    '''
+    upload local files to many nodes through s3: each file is uploaded once to bucket, then
+    every node pulls it with curl from a presigned url and its sha256sum is checked.
+    s3 is a boto3 s3 client, the staged objects are deleted when done.
+    returns (list of TransferResult in target order, elapsed seconds)
+    '''
+
+    start = time.time()
+    digests = LocalDigests()
+    staging = "%s/%s" % (prefix.strip('/'), uuid.uuid4().hex)
+    keys = []
+    results = [TransferResult(node) for keyfile, node in targets]
+
+    try:
+        pulls = []
+        for srcfile in srcfiles:
+            key = "%s/%s" % (staging, os.path.basename(srcfile))
+            s3.upload_file(srcfile, bucket, key)
+            keys.append(key)
+            url = s3.generate_presigned_url('get_object', Params={ 'Bucket' : bucket, 'Key' : key }, ExpiresIn=expires)
+            pulls.append((url, remote_path(srcfile, destdir)))
+        logger.info('staged %d files in s3://%s/%s, pulling on %d nodes' % (len(srcfiles), bucket, staging, len(targets)))
+
+        expected = [digests.sha256(srcfile) for srcfile in srcfiles]
+        for result, pulled in zip(results, lineterm.exec_all(targets, pull_command(pulls))):
+            sums = [line.split()[0] for line in pulled.stdout.splitlines() if line.strip()]
+            if pulled.error:
+                result.error = pulled.error
+            elif not pulled.ok:
+                result.error = pulled.stderr.strip() or 'exit status %s' % pulled.exit_status
+            elif sums != expected:
+                result.error = 'checksum mismatch after download'
+            else:
+                result.files = len(srcfiles)
+                result.bytes = sum(os.path.getsize(srcfile) for srcfile in srcfiles)
+            result.elapsed = pulled.elapsed
+
+    finally:
+        for key in keys:
+            try:
+                s3.delete_object(Bucket=bucket, Key=key)
+            except Exception as e:
+                logger.warning('could not delete staged s3://%s/%s : %s' % (bucket, key, e))
+
+    return results, time.time() - start
+
+
+class ChannelWriter(object):
+    '''
+    sends a stream to one node's exec channel on its own thread, from a bounded queue so a slow
+    node holds back the producer instead of buffering the whole stream. after an error the queue
+    is drained and discarded, so one failed node does not stall the others.
+    '''
+
+    def __init__(self, node, chan, depth, callback=None):
+        self.node = node
+        self.chan = chan
+        self.queue = Queue(depth)
+        self.callback = callback
+        self.sent = 0
+        self.error = None
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, data):
+        while self.error is None:
+            try:
+                self.queue.put(data, timeout=0.5)
+                return
+            except Full:
+                continue
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error:
+                continue
+            try:
+                self.chan.sendall(data)
+                self.sent += len(data)
+                if self.callback:
+                    self.callback(self.sent)
+            except Exception as e:
+                self.error = str(e) or e.__class__.__name__
+
+    def finish(self):
+        ''' end of stream, returns (exit status, stderr) of the remote command '''
+
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.chan.shutdown_write()
+            exit_status = self.chan.recv_exit_status()
+            err = b''
+            while True:
+                data = self.chan.recv_stderr(32768)
+                if not data:
+                    break
+                err += data
+            return exit_status, err.decode('utf-8', 'replace').strip()
+        finally:
+            self.chan.close()
+
+    def abort(self, reason):
+        ''' stop sending, the remote command sees the channel close without eof '''
+
+        self.error = self.error or reason
+        self.queue.put(None)
+        self.thread.join()
+        self.chan.close()
+
+
+class FanOut(object):
+    ''' a write only file that copies everything written to it to every channel writer '''
+
+    def __init__(self, writers):
+        self.writers = writers
+        self.written = 0
+
+    def write(self, data):
+        data = bytes(data)
+        for writer in self.writers:
+            writer.put(data)
+        self.written += len(data)
+        return len(data)
+
+
+def put_tree(lineterm, targets, srcdir, destdir=None, compress=False, depth=16):
+    '''
+    upload a local directory to many nodes as one tar stream each, unpacked by tar on the node.
+    the tar (gzipped with compress) is built once, on the fly, and every block is written to all
+    nodes' exec channels at once through bounded queues, so there is no temp file and no round
+    trip per file. srcdir arrives as destdir/basename(srcdir).
+    returns (list of TransferResult in target order, elapsed seconds)
+    '''
+
+    start = time.time()
+    srcdir = srcdir.rstrip(os.sep) or os.sep
+    nfiles, nbytes = 0, 0
+    for root, dirs, files in os.walk(srcdir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            if os.path.isfile(path) and not os.path.islink(path):
+                nfiles += 1
+                nbytes += os.path.getsize(path)
+
+    # per target state is kept by position in targets, names need not be unique
+    hosts = host_labels([node for keyfile, node in targets])
+    progress = Progress('put', dict( (host, nbytes) for host in hosts ))
+    results = [TransferResult(node) for keyfile, node in targets]
+    dest = shlex.quote(destdir or '.')
+    cmd = "mkdir -p %s && tar x%sf - -C %s" % (dest, 'z' if compress else '', dest)
+
+    terms = [None] * len(targets)
+    writers = [None] * len(targets)
+
+    def open_writer(pos):
+        keyfile, node = targets[pos]
+        try:
+            terms[pos] = lineterm.session_manager.acquire(node, keyfile)
+            progress_cb = progress.callback(hosts[pos], srcdir)
+            # progress in stream bytes, close enough to file bytes to show how far along a node is
+            writers[pos] = ChannelWriter(node, terms[pos].exec_channel(cmd), depth, lambda sent: progress_cb(sent, nbytes))
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(lineterm.ssh_concurrency, len(targets)))) as pool:
+            errors = list(pool.map(open_writer, range(len(targets))))
+
+        live = [writer for writer in writers if writer]
+        if live:
+            fanout = FanOut(live)
+            with tarfile.open(fileobj=fanout, mode='w|gz' if compress else 'w|', bufsize=blocksize) as tar:
+                tar.add(srcdir, arcname=os.path.basename(srcdir) or '.')
+
+        for pos, (result, error, writer) in enumerate(zip(results, errors, writers)):
+            if not writer:
+                result.error = error
+                continue
+            exit_status, err = writer.finish()
+            result.sent = writer.sent
+            if writer.error:
+                result.error = writer.error
+            elif exit_status != 0:
+                result.error = err or 'tar exit status %s' % exit_status
+            else:
+                result.files = nfiles
+                result.bytes = nbytes
+                progress.file_done(hosts[pos], srcdir, nbytes)
+
+    finally:
+        for writer in writers:
+            if writer and writer.thread.is_alive():
+                writer.abort('upload aborted')
+        for term in terms:
+            if term:
+                lineterm.session_manager.release(term)
+        progress.finish()
+
+    elapsed = time.time() - start
+    for result in results:
+        result.elapsed = elapsed
+
+    return results, elapsed
+
+
+def local_manifest(localdir):
+    ''' { relative posix path : (size, mtime, local path) } of the regular files under localdir '''
+
+    ret = {}
+    for root, dirs, files in os.walk(localdir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            rel = os.path.relpath(path, localdir).replace(os.sep, '/')
+            ret[rel] = (st.st_size, int(st.st_mtime), path)
+    return ret
+
+
+def remote_manifest(term, remotedir):
+    ''' { relative path : (size, mtime) } of the regular files under remotedir, with one find on the node '''
+
+    cmd = "mkdir -p %s && cd %s && find . -type f -printf '%%P\\0%%s\\0%%T@\\0'" % (shlex.quote(remotedir), shlex.quote(remotedir))
+    out, err, exit_status = term.exec_command(cmd)
+    if exit_status != 0:
+        raise Exception('could not list %s: %s' % (remotedir, err.getvalue().decode('utf-8', 'replace').strip()))
+
+    fields = out.getvalue().split(b'\0')
+    ret = {}
+    for i in range(0, len(fields) - 2, 3):
+        ret[fields[i].decode('utf-8', 'surrogateescape')] = (int(fields[i + 1]), int(float(fields[i + 2])))
+    return ret
+
+
+def exec_batched(term, remotedir, cmd, paths, batch=200):
+    ''' run cmd in remotedir with paths as arguments, a batch at a time to stay under the command line limit. returns stdout '''
+
+    ret = b''
+    for start in range(0, len(paths), batch):
+        args = " ".join(shlex.quote(path) for path in paths[start:start + batch])
+        out, err, exit_status = term.exec_command("cd %s && %s -- %s" % (shlex.quote(remotedir), cmd, args))
+        if exit_status != 0:
+            raise Exception('%s failed in %s: %s' % (cmd, remotedir, err.getvalue().decode('utf-8', 'replace').strip()))
+        ret += out.getvalue()
+    return ret
+
+
+def sync_files(lineterm, targets, localdir, remotedir, delete=False, files_per_node=4):
+    '''
+    make remotedir on many nodes match localdir: the local manifest (size, mtime) is built once,
+    each node lists remotedir with one exec, and only missing or changed files are uploaded,
+    with their local mtime so the next sync sees them as unchanged. files with the same size but
+    another mtime are compared by sha256 first. with delete, remote files not in localdir are removed.
+    returns (list of TransferResult in target order, elapsed seconds)
+    '''
+
+    manifest = local_manifest(localdir)
+    total = sum(size for size, mtime, path in manifest.values())
+    digests = LocalDigests()
+    labels = dict( (id(node), label) for (keyfile, node), label in zip(targets, host_labels([node for keyfile, node in targets])) )
+    progress = Progress('sync', dict( (label, total) for label in labels.values() ))
+
+    def sync_node(target):
+
+        keyfile, node = target
+        host = labels[id(node)]
+        result = TransferResult(node)
+        start = time.time()
+        term = None
+        try:
+            term = lineterm.session_manager.acquire(node, keyfile)
+            remote = remote_manifest(term, remotedir)
+
+            changed = [rel for rel, (size, mtime, path) in manifest.items() if rel not in remote or remote[rel][0] != size]
+            touched = [rel for rel, (size, mtime, path) in manifest.items() if rel in remote and remote[rel] != (size, mtime)
+                                                                                and remote[rel][0] == size]
+
+            # same size, different mtime: the content decides
+            same = set()
+            if touched:
+                out = exec_batched(term, remotedir, 'sha256sum', touched)
+                for line in out.decode('utf-8', 'surrogateescape').splitlines():
+                    digest, rel = line.split(None, 1)
+                    rel = rel.lstrip('*')
+                    if rel in manifest and digest == digests.sha256(manifest[rel][2]):
+                        same.add(rel)
+                changed.extend(rel for rel in touched if rel not in same)
+
+            sftp = lineterm.open_sftp(term)
+            parents = sorted(set(posixpath.dirname(rel) for rel in changed) - set(['']))
+            if parents:
+                exec_batched(term, remotedir, 'mkdir -p', parents)
+
+            def put_file(rel):
+                size, mtime, path = manifest[rel]
+                destfile = posixpath.join(remotedir, rel)
+                sent = upload(sftp, path, destfile, progress.callback(host, rel))
+                sftp.utime(destfile, (mtime, mtime))
+                return sent
+
+            workers = max(1, min(files_per_node, len(changed)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for sent in pool.map(put_file, changed):
+                    result.sent += sent
+
+            for rel in same:
+                mtime = manifest[rel][1]
+                sftp.utime(posixpath.join(remotedir, rel), (mtime, mtime))
+
+            if delete:
+                extra = sorted(set(remote) - set(manifest))
+                if extra:
+                    exec_batched(term, remotedir, 'rm -f', extra)
+                    result.deleted = len(extra)
+
+            result.files = len(manifest)
+            result.bytes = total
+            result.skipped = len(manifest) - len(changed)
+            progress.file_done(host, localdir, total)
+            logger.debug('%s: synced %s, %d files sent, %d deleted' % (node.name, remotedir, len(changed), result.deleted))
+
+        except Exception as e:
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            if term:
+                lineterm.session_manager.release(term)
+            progress.host_done(host)
+
+        result.elapsed = time.time() - start
+        return result
+
+    return run_all(lineterm, targets, sync_node, progress)
+
+
+def remote_glob(sftp, pattern):
+    '''
+    remote files matching a glob pattern, wildcards are allowed in any path component.
+    returns a list of (path, size), directories are skipped
+    '''
+
+    wildcards = '*?['
+    parts = pattern.split('/')
+    if pattern.startswith('/'):
+        paths = ['/']
+        parts = parts[1:]
+    else:
+        paths = ['']
+
+    for part in parts:
+        if not part:
+            continue
+        matched = []
+        for base in paths:
+            if not any(c in part for c in wildcards):
+                matched.append(posixpath.join(base, part))
+                continue
+            try:
+                entries = sftp.listdir_attr(base or '.')
+            except IOError:
+                continue
+            for entry in entries:
+                # like the shell, wildcards do not match hidden files
+                if entry.filename.startswith('.') and not part.startswith('.'):
+                    continue
+                if fnmatch.fnmatch(entry.filename, part):
+                    matched.append(posixpath.join(base, entry.filename))
+        paths = matched
+
+    ret = []
+    for path in paths:
+        try:
+            attrs = sftp.stat(path)
+        except IOError:
+            continue
+        if not stat.S_ISDIR(attrs.st_mode or 0):
+            ret.append((path, attrs.st_size or 0))
+
+    return sorted(ret)
+
+
+# the first byte of a compressed fetch says which compressor the node used
+compressed_exts = { b'Z' : '.zst', b'G' : '.gz' }
+
+def compressed_command(remotefile, zstd=True):
+    ''' compress remotefile to stdout with zstd if the node has it, else gzip -1, after a one byte marker '''
+
+    qpath = shlex.quote(remotefile)
+    gz = "printf G && gzip -1 -c -- %s" % qpath
+    if not zstd:
+        return gz
+    return "if command -v zstd >/dev/null 2>&1; then printf Z && zstd -q -c -- %s; else %s; fi" % (qpath, gz)
+
+
+def fetch_compressed(term, remotefile, localfile, size, zstd=True, callback=None, bufsize=32768):
+    '''
+    stream remotefile, compressed on the node, over an exec channel into localfile.gz or localfile.zst.
+    returns (compressed file, bytes received)
+    '''
+
+    chan = term.exec_channel(compressed_command(remotefile, zstd))
+    try:
+        ext = compressed_exts.get(chan.recv(1))
+        received = 0
+        part = localfile + (ext or '') + '.part'
+        if ext:
+            with open(part, 'wb') as fh:
+                while True:
+                    data = chan.recv(bufsize)
+                    if not data:
+                        break
+                    fh.write(data)
+                    received += len(data)
+                    if callback:
+                        callback(min(received, size), size)
+
+        exit_status = chan.recv_exit_status()
+        err = b''
+        while True:
+            data = chan.recv_stderr(bufsize)
+            if not data:
+                break
+            err += data
+    finally:
+        chan.close()
+
+    if not ext or exit_status != 0:
+        if os.path.exists(part):
+            os.remove(part)
+        raise Exception('could not compress %s: %s' % (remotefile, err.decode('utf-8', 'replace').strip() or 'exit status %s' % exit_status))
+
+    path = localfile + ext
+    os.replace(part, path)
+    return path, received
+
+
+def decompress(path, localfile):
+    ''' decompress a fetched .gz or .zst file into localfile, and remove it '''
+
+    with open(localfile, 'wb') as dst:
+        if path.endswith('.zst'):
+            with open(path, 'rb') as src:
+                zstandard.ZstdDecompressor().copy_stream(src, dst)
+        else:
+            with gzip.open(path, 'rb') as src:
+                shutil.copyfileobj(src, dst, blocksize)
+    os.remove(path)
+
+
+def host_labels(nodes):
+    '''
+    a distinct, non empty name per node, for local file names and progress. the node name, 
+    name.index if several nodes share the name, or the instance id for a node without a name
+    '''
+
+    counts = Counter(node.name for node in nodes)
+    labels = []
+    seen = set()
+    for pos, node in enumerate(nodes):
+        suffix = getattr(node, 'index', None) or node.get('id')
+        if not node.name:
+            label = node.get('id') or suffix
+        elif counts[node.name] > 1:
+            label = '%s.%s' % (node.name, suffix) if suffix else None
+        else:
+            label = node.name
+        if not label or label in seen:
+            label = '%s.%d' % (node.name or 'node', pos + 1)
+        seen.add(label)
+        labels.append(label)
+
+    return labels
+
+
+def local_path(host, remotefile, localdir, per_host_dirs=False):
+    '''
+    where a file downloaded from a node goes: localdir/file.host, 
+    or localdir/host/remote/path with per_host_dirs. host is the node's label from host_labels
+    '''
+
+    localdir = localdir or '.'
+    if per_host_dirs:
+        return os.path.join(localdir, host, *[part for part in remotefile.split('/') if part])
+    return os.path.join(localdir, '%s.%s' % (posixpath.basename(remotefile), host))
+
+
+def get_files(lineterm, targets, pattern, localdir=None, per_host_dirs=False, files_per_node=4,
+                    compressed=False, keep_compressed=False):
+    '''
+    download remote files matching pattern from many nodes at once.
+    targets is a list of (keyfile, node). nodes are served by a pool of lineterm.ssh_concurrency
+    workers, and each node has up to files_per_node files in flight on its sftp session.
+    with compressed, files are compressed on the node and streamed over exec channels instead,
+    then decompressed here on a pool of cpu count workers, or kept as .gz or .zst with keep_compressed.
+    returns (list of TransferResult in target order, elapsed seconds)
+    '''
+
+    labels = dict( (id(node), label) for (keyfile, node), label in zip(targets, host_labels([node for keyfile, node in targets])) )
+    progress = Progress('get', dict( (label, 0) for label in labels.values() ))
+    zstd = keep_compressed or zstandard is not None
+    decompressors = ThreadPoolExecutor(max_workers=os.cpu_count() or 4) if compressed and not keep_compressed else None
+
+    def get_node(target):
+
+        keyfile, node = target
+        host = labels[id(node)]
+        result = TransferResult(node)
+        start = time.time()
+        term = None
+        stripes = None
+        try:
+            term = lineterm.session_manager.acquire(node, keyfile)
+            sftp = lineterm.open_sftp(term)
+            stripes = NodeStripes(lineterm, term, keyfile, sftp)
+
+            remotefiles = remote_glob(sftp, pattern)
+            if not remotefiles:
+                raise Exception('no remote files match %s' % pattern)
+            progress.add_total(host, sum(size for path, size in remotefiles))
+
+            def get_file(remote):
+                remotefile, size = remote
+                localfile = local_path(host, remotefile, localdir, per_host_dirs)
+                parent = os.path.dirname(localfile)
+                if parent and not os.path.isdir(parent):
+                    os.makedirs(parent, exist_ok=True)
+                callback = progress.callback(host, remotefile)
+                received, decompressed = size, None
+                if compressed:
+                    path, received = fetch_compressed(term, remotefile, localfile, size, zstd, callback)
+                    if decompressors:
+                        decompressed = decompressors.submit(decompress, path, localfile)
+                elif striped(lineterm, size):
+                    striped_download(stripes.get(), remotefile, localfile, size, callback)
+                    if remote_sha256(term, remotefile) != file_sha256(localfile):
+                        raise Exception('checksum mismatch after striped download of %s' % remotefile)
+                else:
+                    download(sftp, remotefile, localfile, size, callback)
+                progress.file_done(host, remotefile, size)
+                logger.debug('%s: downloaded %s to %s, received %d bytes' % (host, remotefile, localfile, received))
+                return size, received, decompressed
+
+            workers = max(1, min(files_per_node, len(remotefiles)))
+            pending = []
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for nbytes, received, decompressed in pool.map(get_file, remotefiles):
+                    result.files += 1
+                    result.bytes += nbytes
+                    result.sent += received
+                    if decompressed:
+                        pending.append(decompressed)
+
+            for decompressed in pending:
+                decompressed.result()
+
+        except Exception as e:
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            if stripes:
+                stripes.close()
+            if term:
+                lineterm.session_manager.release(term)
+            progress.host_done(host)
+
+        result.elapsed = time.time() - start
+        return result
+
+    try:
+        return run_all(lineterm, targets, get_node, progress)
+    finally:
+        if decompressors:
+            decompressors.shutdown()
+
+
+def run_all(lineterm, targets, func, progress):
+    ''' func(target) for all targets on the node pool, returns (results, elapsed) '''
+
+    if not targets:
+        return [], 0.0
+
+    start = time.time()
+    try:
+        workers = min(lineterm.ssh_concurrency, len(targets))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(func, targets))
+    finally:
+        progress.finish()
+
+    return results, time.time() - start
+
+
+def summary(op, results, elapsed):
+    ''' e.g. put 3 files, 512.0 MB to 100 nodes in 42.10s, 1216.2 MB/s aggregate, 12.4 MB/s per node, slowest worker7 41.80s 12.2 MB/s '''
+
+    ok = [result for result in results if not result.error]
+    nfiles = sum(result.files for result in ok)
+    nbytes = sum(result.bytes for result in ok)
+    rate = nbytes / MB / elapsed if elapsed else 0.0
+
+    direction = "from" if op == "get" else "to"
+    ret = "%s %d files, %.1f MB %s %d nodes in %.2fs, %.1f MB/s aggregate" % (op, nfiles, nbytes / MB, direction,
+                                                                           len(ok), elapsed, rate)
+    if ok:
+        slowest = max(ok, key=lambda result: result.elapsed)
+        ret += ", %.1f MB/s per node, slowest %s %.2fs %.1f MB/s" % (sum(result.rate for result in ok) / len(ok),
+                                                        slowest.node.name, slowest.elapsed, slowest.rate)
+
+    sent = sum(result.sent for result in ok)
+    if sent < nbytes:
+        ret += ", %s %.1f MB, saved %.1f MB (%d%%)" % ("received" if op == "get" else "sent", sent / MB,
+                                                     (nbytes - sent) / MB, 100 * (nbytes - sent) // nbytes)
+        skipped = sum(result.skipped for result in ok)
+        if skipped:
+            ret += ", %d files up to date" % skipped
+
+    deleted = sum(result.deleted for result in ok)
+    if deleted:
+        ret += ", %d files deleted" % deleted
+
+    errors = len(results) - len(ok)
+    if errors:
+        ret += ", %d nodes failed" % errors
+
+    return ret
@@ -13,6 +13,7 @@
 ''' utility functions '''
 
 import logging
+import re
 
 def setup_logger(sname):
 
@@ -30,6 +31,56 @@ def setup_logger(sname):
     return logger
 
 
+def is_numeric(s):
+    try:
+        int(s)
+        return True
+    except ValueError:
+        return False
+
+
+def compact_hostlist(names):
+    '''
+    fold names that differ only in a trailing number into ranges
+    e.g. [worker1, worker2, worker3, worker7, master] -> master,worker[1-3,7]
+    numbers keep their digits as written, so [w08, w09, w10, w11] -> w[08-11].
+    every name is listed, a repeated name is not folded into one.
+    '''
+
+    groups = {}     # { prefix : [(number, digits)] }
+    plain = []
+    for name in names:
+        match = re.match(r'^(.*?)(\d+)$', name)
+        if not match:
+            plain.append(name)
+            continue
+        prefix, digits = match.groups()
+        groups.setdefault(prefix, []).append((int(digits), digits))
+
+    ret = sorted(plain)
+    for prefix, numbers in sorted(groups.items()):
+        numbers.sort()
+        if len(numbers) == 1:
+            ret.append(prefix + numbers[0][1])
+            continue
+
+        ranges = []
+        first = last = numbers[0]
+        for num in numbers[1:] + [None]:
+            if num is not None and num[0] == last[0] + 1:
+                last = num
+                continue
+            if first is last:
+                ranges.append(first[1])
+            else:
+                ranges.append("%s-%s" % (first[1], last[1]))
+            first = last = num
+
+        ret.append("%s[%s]" % (prefix, ",".join(ranges)))
+
+    return ",".join(ret)
+
+
 def intro():
     s_intro = r'''
         .___              __  
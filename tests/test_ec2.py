@@ -0,0 +1,107 @@
+from dustcluster.EC2 import EC2Cloud, EC2Node, NodeRecord
+from botocore.exceptions import ClientError
+
+import unittest
+
+'''
+EC2 cloud provider tests - no cloud connection needed
+'''
+
+class TestServerFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.cloud = EC2Cloud(region='eu-west-1')
+
+    def test_attribute_filter(self):
+
+        filters = self.cloud.server_filters("state=running")
+        self.assertEqual(filters, [ { 'Name' : 'instance-state-name', 'Values' : ['running'] } ])
+
+    def test_tag_filter(self):
+
+        filters = self.cloud.server_filters("tags=env:prod")
+        self.assertEqual(filters, [ { 'Name' : 'tag:env', 'Values' : ['prod'] } ])
+
+        filters = self.cloud.server_filters("tags=env:*")
+        self.assertEqual(filters, [ { 'Name' : 'tag-key', 'Values' : ['env'] } ])
+
+    def test_or_same_key(self):
+
+        filters = self.cloud.server_filters("state=running,state=pending")
+        self.assertEqual(filters, [ { 'Name' : 'instance-state-name', 'Values' : ['running', 'pending'] } ])
+
+    def test_not_pushed_down(self):
+
+        for target in ["*", "worker*", "1,2,3", "state=running,vpc=vpc-1", "tags=*name:x", "launch_time=2017*"]:
+            self.assertIsNone(self.cloud.server_filters(target), target)
+
+
+class FakeClient(object):
+    ''' records lifecycle calls, fails any call that includes a bad instance id '''
+
+    def __init__(self, bad_ids=()):
+        self.calls = []
+        self.bad_ids = set(bad_ids)
+
+    def _change(self, api, key, InstanceIds):
+        self.calls.append((api, list(InstanceIds)))
+        if self.bad_ids.intersection(InstanceIds):
+            raise ClientError({ 'Error' : { 'Code' : 'IncorrectInstanceState', 'Message' : 'bad state' } }, api)
+        return { key : [ { 'InstanceId' : iid, 'PreviousState' : { 'Name' : 'running' },
+                           'CurrentState' : { 'Name' : 'stopping' } } for iid in InstanceIds ] }
+
+    def stop_instances(self, InstanceIds):
+        return self._change('stop_instances', 'StoppingInstances', InstanceIds)
+
+    def terminate_instances(self, InstanceIds):
+        return self._change('terminate_instances', 'TerminatingInstances', InstanceIds)
+
+    def create_tags(self, Resources, Tags):
+        self.calls.append(('create_tags', list(Resources)))
+
+
+class TestBatchedLifecycle(unittest.TestCase):
+
+    def setUp(self):
+        self.cloud = EC2Cloud(region='eu-west-1')
+        self.cloud.instance_ids_max = 4
+        self.nodes = []
+        for i in range(10):
+            data = { 'InstanceId' : 'i-%d' % i, 'State' : { 'Name' : 'running' },
+                     'Tags' : [ { 'Key' : 'Name', 'Value' : 'worker' } ] }
+            node = EC2Node(cloud=self.cloud)
+            node.hydrate(NodeRecord(data))
+            self.nodes.append(node)
+
+    def use_client(self, client):
+        self.cloud.client = lambda: client
+
+    def test_stop_chunks(self):
+
+        client = FakeClient()
+        self.use_client(client)
+        results = self.cloud.stop_nodes(self.nodes)
+        self.assertEqual([len(ids) for api, ids in client.calls], [4, 4, 2])
+        self.assertEqual(results['i-3'], ('running', 'stopping'))
+
+    def test_bad_instance_retried_alone(self):
+
+        client = FakeClient(bad_ids=['i-1'])
+        self.use_client(client)
+        results = self.cloud.stop_nodes(self.nodes)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(results['i-1'][1].startswith('error'))
+        self.assertEqual(results['i-2'], ('running', 'stopping'))
+
+    def test_terminate_renames_in_bulk(self):
+
+        client = FakeClient()
+        self.use_client(client)
+        self.cloud.terminate_nodes(self.nodes)
+        apis = [api for api, ids in client.calls]
+        self.assertEqual(apis.count('create_tags'), 3)
+        self.assertEqual(apis.count('terminate_instances'), 3)
+        self.assertNotIn('stop_instances', apis)
+
+if __name__ == "__main__":
+    unittest.main()
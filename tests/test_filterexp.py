@@ -0,0 +1,90 @@
+from dustcluster.EC2 import EC2Node, NodeRecord
+from dustcluster.filterexp import NodeIndex, compile_target
+
+import unittest
+
+'''
+filter expression tests - index lookups must select the same nodes as a full scan
+'''
+
+def make_nodes():
+
+    nodes = []
+    for i in range(20):
+        name = 'worker%d' % i if i else 'master'
+        data = {
+                'InstanceId'        : 'i-%04d' % i,
+                'ImageId'           : 'ami-test',
+                'InstanceType'      : 't2.nano' if i % 2 else 'm4.large',
+                'State'             : { 'Name' : 'running' if i < 15 else 'stopped' },
+                'VpcId'             : 'vpc-1',
+                'PublicIpAddress'   : '54.12.0.%d' % i,
+                'PrivateIpAddress'  : '10.0.3.%d' % i,
+                'Tags'              : [ { 'Key' : 'Name', 'Value' : name },
+                                        { 'Key' : 'env', 'Value' : 'dev' if i < 10 else 'Prod' } ]
+               }
+        node = EC2Node()
+        node.hydrate(NodeRecord(data))
+        node.index = str(i + 1)
+        nodes.append(node)
+
+    return nodes
+
+
+class TestFilterExp(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = make_nodes()
+        self.node_index = NodeIndex(self.nodes)
+
+    def select(self, target):
+
+        plan = compile_target(target)
+        indexed = plan.select(self.nodes, self.node_index)
+        scanned = plan.select(self.nodes)
+        self.assertEqual(indexed, scanned, target)
+        return indexed
+
+    def test_name(self):
+        self.assertEqual(len(self.select("worker*")), 19)
+        self.assertEqual(len(self.select("worker1")), 1)
+        self.assertEqual(len(self.select("worker1?")), 10)
+
+    def test_index(self):
+        self.assertEqual(len(self.select("1,2,3")), 3)
+
+    def test_attributes(self):
+        self.assertEqual(len(self.select("state=running")), 15)
+        self.assertEqual(len(self.select("state=stop*")), 5)
+        self.assertEqual(len(self.select("type=t2.nano")), 10)
+        self.assertEqual(len(self.select("private_ip_address=10.0.3.1*")), 11)
+        self.assertEqual(len(self.select("image=ami-test")), 20)
+
+    def test_tags(self):
+        self.assertEqual(len(self.select("tags=env:dev")), 10)
+        self.assertEqual(len(self.select("tags=env:prod")), 10)
+        self.assertEqual(len(self.select("tags=*:prod")), 10)
+        self.assertEqual(len(self.select("tags=env:*")), 20)
+
+    def test_bare_ip(self):
+        self.assertEqual(len(self.select("10.0.3.*")), 20)
+        self.assertEqual(len(self.select("10.0.3.1*")), 11)
+        self.assertEqual(len(self.select("54.12.0.7")), 1)
+        self.assertEqual(len(self.select("10.0.3.7,master")), 2)
+
+    def test_union(self):
+        self.assertEqual(len(self.select("master,state=stopped")), 6)
+
+    def test_search(self):
+        plan = compile_target("10.0.3.7")
+        self.assertEqual(len(plan.search(self.nodes, self.node_index)), 1)
+        plan = compile_target("prod")
+        self.assertEqual(len(plan.search(self.nodes, self.node_index)), 10)
+        plan = compile_target("10.0.3.1?")
+        self.assertEqual(len(plan.search(self.nodes, self.node_index)), 10)
+
+    def test_bad_format(self):
+        self.assertRaises(Exception, compile_target, "a=b=c")
+
+if __name__ == "__main__":
+    unittest.main()
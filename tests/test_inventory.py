@@ -0,0 +1,129 @@
+from dustcluster.EC2 import EC2Cloud, NodeRecord
+from dustcluster.cluster import ClusterCommandEngine
+from dustcluster.inventory import Inventory, InventoryStore, fmt_age
+
+import datetime
+import tempfile
+import shutil
+import unittest
+
+'''
+inventory snapshot tests
+'''
+
+class TestInventoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cloud = EC2Cloud(region='eu-west-1')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_roundtrip(self):
+
+        data = {
+                'InstanceId'        : 'i-1234',
+                'ImageId'           : 'ami-test',
+                'InstanceType'      : 't2.nano',
+                'LaunchTime'        : datetime.datetime(2017, 10, 3, 12, 0, 0),
+                'State'             : { 'Name' : 'running', 'Code' : 16 },
+                'BlockDeviceMappings' : [ { 'DeviceName' : '/dev/xvda', 'Ebs' : { 'VolumeId' : 'vol-1' } } ],
+                'Tags'              : [ { 'Key' : 'Name', 'Value' : 'worker1' } ]
+               }
+
+        nodes = self.cloud.nodes_from_records([NodeRecord(data)])
+
+        store = InventoryStore(self.cache_dir)
+        store.write(Inventory('eu-west-1', nodes, scope='state=running'))
+
+        inventory = store.read('eu-west-1', self.cloud)
+        self.assertTrue(inventory.from_snapshot)
+        self.assertEqual(inventory.scope, 'state=running')
+
+        node = inventory.nodes[0]
+        self.assertEqual(node.name, 'worker1')
+        self.assertEqual(node.state, 'running')
+        self.assertEqual(node.get('volumes'), ['vol-1'])
+        self.assertEqual(node.get('launch_time'), str(data['LaunchTime']))
+
+        self.assertIsNone(store.read('us-east-1', self.cloud))
+
+    def make_node(self, iid, state='running'):
+        data = { 'InstanceId' : iid, 'ImageId' : 'ami-test', 'InstanceType' : 't2.nano', 'State' : { 'Name' : state } }
+        return self.cloud.nodes_from_records([NodeRecord(data)])[0]
+
+    def test_merge(self):
+
+        make_node = self.make_node
+        nodes = [make_node('i-1', 'running'), make_node('i-2', 'running')]
+        for i, node in enumerate(nodes):
+            node.index = str(i + 1)
+
+        inventory = Inventory('eu-west-1', nodes)
+        inventory.merge([make_node('i-2', 'stopping'), make_node('i-3', 'pending')])
+
+        self.assertEqual([node.index for node in inventory.nodes], ['1', '2', '3'])
+        self.assertEqual([node.state for node in inventory.nodes], ['running', 'stopping', 'pending'])
+        self.assertEqual(inventory.merges, 1)
+
+    def test_merge_prune(self):
+
+        nodes = [self.make_node('i-1'), self.make_node('i-2'), self.make_node('i-3')]
+        for i, node in enumerate(nodes):
+            node.index = str(i + 1)
+
+        inventory = Inventory('eu-west-1', nodes)
+        inventory.merge([self.make_node('i-3', 'stopped'), self.make_node('i-1'), self.make_node('i-4')], prune=True)
+
+        self.assertEqual([node.get('id') for node in inventory.nodes], ['i-1', 'i-3', 'i-4'])
+        self.assertEqual([node.index for node in inventory.nodes], ['1', '3', '4'])
+
+    def test_revalidate_keeps_indexes(self):
+
+        test = self
+
+        class FakeCloud(object):
+            def __init__(self):
+                self.clients = []
+            def refresh(self, filters=None, client=None):
+                self.clients.append(client)
+                return [test.make_node('i-2'), test.make_node('i-3')]
+            def new_client(self):
+                return object()
+
+        cloud = FakeCloud()
+        removed = []
+
+        engine = ClusterCommandEngine.__new__(ClusterCommandEngine)
+        engine.inventory_store = InventoryStore(self.cache_dir)
+        engine.get_cloud_provider_by_region = lambda provider, region: cloud
+        engine._prune_sessions = lambda inventory: removed.append(inventory)
+
+        nodes = [self.make_node('i-1'), self.make_node('i-2')]
+        for i, node in enumerate(nodes):
+            node.index = str(i + 1)
+
+        stale = Inventory('eu-west-1', nodes, fetched=1)
+        stale.from_snapshot = True
+        stale.revalidating = True
+        engine.nodecache = { 'eu-west-1' : stale }
+
+        engine._revalidate_inventory(stale)
+
+        self.assertIs(engine.nodecache['eu-west-1'], stale)
+        self.assertEqual([(node.get('id'), node.index) for node in stale.nodes], [('i-2', '2'), ('i-3', '3')])
+        self.assertFalse(stale.is_expired(600))
+        self.assertFalse(stale.revalidating or stale.from_snapshot)
+        self.assertIsNotNone(cloud.clients[0])
+        self.assertEqual(removed, [stale])
+
+    def test_expiry(self):
+
+        inventory = Inventory('eu-west-1', [], fetched=1)
+        self.assertTrue(inventory.is_expired(600))
+        self.assertFalse(inventory.is_expired(-1))
+        self.assertEqual(fmt_age(125), '2m')
+
+if __name__ == "__main__":
+    unittest.main()
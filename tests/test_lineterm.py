@@ -0,0 +1,530 @@
+from dustcluster.lineterm import SSHTerm, LineTerm, SessionManager, KeyCache, KeyLoadError, utf8_boundary
+
+import getpass
+import subprocess
+import mock
+import tempfile
+import shutil
+import io
+import os
+import sys
+import time
+import socket
+import threading
+import unittest
+
+'''
+ssh session tests - fake channels, no network
+'''
+
+class FakeChannel(object):
+    ''' replays stdout and stderr chunks then eof '''
+
+    def __init__(self, stdout, stderr, exit_status):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.exit_status = exit_status
+        self.cmd = None
+        self.closed = False
+
+    def exec_command(self, cmd):
+        self.cmd = cmd
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, n):
+        return self.stderr.pop(0) if self.stderr else b''
+
+    def recv(self, n):
+        if not self.stdout:
+            return b''
+        data = self.stdout.pop(0)
+        if data is None:
+            raise socket.timeout()
+        return data
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport(object):
+
+    def __init__(self, chan):
+        self.chan = chan
+
+    def open_session(self):
+        return self.chan
+
+    def is_authenticated(self):
+        return True
+
+    def is_active(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeNode(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.login_rule = {}
+
+    def get(self, key):
+        return self.name
+
+
+def make_term(node, chan):
+    term = SSHTerm(node, 'keyfile')
+    term.transport = FakeTransport(chan)
+    return term
+
+
+class TestExec(unittest.TestCase):
+
+    def test_exec_command(self):
+
+        chan = FakeChannel([b'up ', None, b'3 days\n'], [b'warn\n'], 0)
+        term = make_term(FakeNode('worker1'), chan)
+        stdout, stderr, exit_status = term.exec_command('uptime')
+        self.assertEqual(chan.cmd, 'uptime')
+        self.assertEqual(stdout.getvalue(), b'up 3 days\n')
+        self.assertEqual(stderr.getvalue(), b'warn\n')
+        self.assertEqual(exit_status, 0)
+        self.assertTrue(chan.closed)
+
+    def test_exec_all(self):
+
+        lineterm = LineTerm()
+        terms = {}
+        for i in range(5):
+            node = FakeNode('worker%d' % i)
+            terms[node] = make_term(node, FakeChannel([b'out%d' % i], [], i % 2))
+
+        lineterm.session_manager.term_from_node = lambda node, keyfile, rawshell=False: terms[node]
+        results = lineterm.exec_all([('keyfile', node) for node in terms], 'cmd')
+
+        self.assertEqual([r.stdout for r in results], ['out%d' % i for i in range(5)])
+        self.assertEqual([r.exit_status for r in results], [0, 1, 0, 1, 0])
+        self.assertEqual(sum(1 for r in results if r.ok), 3)
+
+        self.assertEqual(len(set(r.digest for r in results)), 5)
+
+        lineterm.session_manager.term_from_node = lambda node, keyfile, rawshell=False: None
+        results = lineterm.exec_all([('keyfile', node) for node in terms], 'cmd')
+        self.assertTrue(all(r.error and r.exit_status is None for r in results))
+
+    def test_exec_output_spills(self):
+
+        chunks = [b'x' * 1000 for i in range(100)]
+        chan = FakeChannel(chunks, [], 0)
+        term = make_term(FakeNode('worker1'), chan)
+        stdout, stderr, exit_status = term.exec_command('cat big', max_size=4096)
+
+        self.assertEqual(len(stdout.getvalue()), 4096)
+        self.assertEqual(stdout.size, 100000)
+        self.assertTrue(stdout.path)
+        with open(stdout.path, 'rb') as fh:
+            self.assertEqual(fh.read(), b''.join(chunks))
+        os.remove(stdout.path)
+        self.assertIsNone(stderr.path)
+
+
+class ShellChannel(object):
+    ''' records what is sent to an interactive shell '''
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+class TestCommandAll(unittest.TestCase):
+
+    def setUp(self):
+        self.lineterm = LineTerm()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.shells = {}
+
+    def tearDown(self):
+        self.lineterm.session_manager.shutdown()
+
+    def connect(self, node, keyfile, rawshell=False):
+        ''' a slow login, so overlapping connects show up in peak '''
+
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(0.05)
+            if node.name == 'bad':
+                raise socket.error('connection refused')
+            term = make_term(node, FakeChannel([], [], 0))
+            term.state = 'connected'
+            term.chan = self.shells[node.name] = ShellChannel()
+            return term
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def test_connects_bounded(self):
+
+        self.lineterm.ssh_concurrency = 4
+        self.lineterm.session_manager.connect = self.connect
+        nodes = [FakeNode('worker%d' % i) for i in range(12)]
+
+        timings = self.lineterm.command_all([('keyfile', node) for node in nodes], 'uptime')
+
+        self.assertEqual(self.peak, 4)
+        self.assertEqual([timing.node for timing in timings], nodes)
+        for node in nodes:
+            self.assertEqual(self.shells[node.name].sent[-2:], ['uptime', '\n'])
+
+        # second round reuses the pooled sessions, no connect time
+        timings = self.lineterm.command_all([('keyfile', node) for node in nodes], 'uptime')
+        self.assertTrue(all(timing.connect < 0.05 for timing in timings))
+
+    def test_error_does_not_stop_others(self):
+
+        self.lineterm.session_manager.connect = self.connect
+        nodes = [FakeNode('worker1'), FakeNode('bad'), FakeNode('worker2')]
+
+        timings = self.lineterm.command_all([('keyfile', node) for node in nodes], 'uptime')
+
+        self.assertEqual([timing.error for timing in timings], [None, 'connection refused', None])
+        self.assertEqual(sorted(self.shells), ['worker1', 'worker2'])
+        for timing in timings:
+            self.assertGreater(timing.total, 0)
+            self.assertGreaterEqual(timing.total, timing.connect)
+        self.assertGreaterEqual(timings[0].connect, 0.05)
+        self.assertEqual(timings[1].connect, 0.0)
+
+
+class PipeChannel(object):
+    ''' a channel the demux can select on, fed through a pipe '''
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.chunks = []
+        self.lock = threading.Lock()
+
+    def feed(self, data):
+        with self.lock:
+            self.chunks.append(data)
+        os.write(self.w, b'.')
+
+    def fileno(self):
+        return self.r
+
+    def recv_ready(self):
+        with self.lock:
+            return bool(self.chunks)
+
+    def recv(self, n):
+        os.read(self.r, 1)
+        with self.lock:
+            return self.chunks.pop(0)
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+class TestDemux(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        self.session_manager = SessionManager()
+        self.demux = self.session_manager.demux
+
+    def tearDown(self):
+        self.demux.shutdown()
+        sys.stdout = self.stdout
+
+    def output(self):
+        sys.stdout.flush()
+        return sys.stdout.buffer.getvalue().decode('utf-8')
+
+    def wait_for(self, text, timeout=2):
+        end = time.time() + timeout
+        while time.time() < end:
+            if text in self.output():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_output_prefixed_per_node(self):
+
+        terms = []
+        for i in range(3):
+            term = SSHTerm(FakeNode('worker%d' % i), 'keyfile')
+            term.chan = PipeChannel()
+            self.demux.start(term)
+            terms.append(term)
+
+        for i, term in enumerate(terms):
+            term.chan.feed(b'line one\nline two from %d' % i)
+
+        for i in range(3):
+            self.assertTrue(self.wait_for('line two from %d' % i))
+
+        out = self.output()
+        self.assertIn('[worker1]', out)
+        self.assertEqual(out.count('line one'), 3)
+
+        for term in terms:
+            self.demux.stop(term.chan)
+
+    def test_multibyte_split_across_reads(self):
+
+        term = SSHTerm(FakeNode('worker1'), 'keyfile')
+        term.chan = PipeChannel()
+        self.demux.start(term)
+
+        text = 'caf\u00e9 \u2603 done'.encode('utf-8')
+        pos = text.index(b'\xe2') + 1
+        term.chan.feed(text[:pos])
+        time.sleep(0.3)
+        term.chan.feed(text[pos:])
+
+        self.assertTrue(self.wait_for('\u2603 done'))
+        self.demux.stop(term.chan)
+
+    def test_login_guid_suppresses_banner(self):
+
+        term = SSHTerm(FakeNode('worker1'), 'keyfile')
+        term.login_guid_found = False
+        term.chan = PipeChannel()
+        self.demux.start(term)
+
+        guid = SSHTerm.login_complete_guid.encode('ascii')
+        term.chan.feed(b'welcome banner\n' + guid[:10])
+        time.sleep(0.1)
+        term.chan.feed(guid[10:] + b'\nhello')
+
+        self.assertTrue(self.wait_for('hello'))
+        self.assertNotIn('banner', self.output())
+        self.demux.stop(term.chan)
+
+    def test_banner_over_buffer_max_before_guid(self):
+
+        self.demux.buffer_max = 65536
+        term = SSHTerm(FakeNode('worker1'), 'keyfile')
+        term.login_guid_found = False
+        term.chan = PipeChannel()
+        self.demux.start(term)
+
+        for i in range(4):
+            term.chan.feed(b'motd banner line\n' * 2500)
+        guid = SSHTerm.login_complete_guid.encode('ascii')
+        term.chan.feed(b'\n' + guid[:10])
+        term.chan.feed(guid[10:] + b'\nhello')
+
+        self.assertTrue(self.wait_for('hello'))
+        self.assertNotIn('banner', self.output())
+        self.assertLess(len(term.recvbuf), 65536)
+        self.demux.stop(term.chan)
+
+
+class FakeCloud(object):
+
+    def __init__(self, region):
+        self.region = region
+
+
+class TestSessionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.session_manager = SessionManager()
+        self.connects = 0
+
+        def connect(node, keyfile, rawshell=False):
+            self.connects += 1
+            return make_term(node, FakeChannel([], [], 0))
+
+        self.session_manager.connect = connect
+
+    def tearDown(self):
+        self.session_manager.shutdown()
+
+    def nodes(self, count, region='eu-west-1'):
+        ret = []
+        for i in range(count):
+            node = FakeNode('%s-worker%d' % (region, i))
+            node.cloud = FakeCloud(region)
+            ret.append(node)
+        return ret
+
+    def test_sessions_reused(self):
+
+        node = self.nodes(1)[0]
+        term = self.session_manager.term_from_node(node, 'keyfile')
+        self.assertIs(self.session_manager.term_from_node(node, 'keyfile'), term)
+        self.assertEqual(self.connects, 1)
+
+    def test_lru_eviction_skips_leased(self):
+
+        self.session_manager.max_sessions = 3
+        nodes = self.nodes(5)
+        leased = self.session_manager.acquire(nodes[0], 'keyfile')
+        for node in nodes[1:]:
+            self.session_manager.term_from_node(node, 'keyfile')
+
+        ids = list(self.session_manager.session_map)
+        self.assertEqual(ids, [nodes[0].name, nodes[3].name, nodes[4].name])
+        self.session_manager.release(leased)
+        self.assertEqual(leased.leases, 0)
+
+    def test_prune(self):
+
+        nodes = self.nodes(3) + self.nodes(2, region='us-east-1')
+        for node in nodes:
+            self.session_manager.term_from_node(node, 'keyfile')
+
+        live = set([nodes[0].name])
+        self.assertEqual(self.session_manager.prune('eu-west-1', live), 2)
+        self.assertEqual(len(self.session_manager.session_map), 3)
+
+        # a partial inventory only prunes the nodes it knows about
+        self.assertEqual(self.session_manager.prune('us-east-1', set(), known_ids=set([nodes[3].name])), 1)
+        self.assertEqual(len(self.session_manager.session_map), 2)
+
+    def test_idle_sessions_closed(self):
+
+        node = self.nodes(1)[0]
+        term = self.session_manager.term_from_node(node, 'keyfile')
+        term.last_used -= self.session_manager.max_idle + 1
+        self.session_manager.check_sessions()
+        self.assertEqual(len(self.session_manager.session_map), 0)
+        self.assertEqual(term.state, 'shutdown')
+
+
+@unittest.skipUnless(shutil.which('ssh-keygen'), 'needs ssh-keygen')
+class TestKeyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.keyfile = os.path.join(self.tmpdir, 'key')
+        self.keygen()
+
+    def keygen(self):
+        if os.path.exists(self.keyfile):
+            os.remove(self.keyfile)
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', 'secret', '-f', self.keyfile])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_passphrase_asked_once(self):
+
+        key_cache = KeyCache()
+        with mock.patch.object(getpass, 'getpass', return_value='secret') as prompt:
+            threads = [threading.Thread(target=key_cache.get, args=(self.keyfile,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            key = key_cache.get(self.keyfile)
+
+        self.assertEqual(prompt.call_count, 1)
+        self.assertEqual(key.get_name(), 'ssh-ed25519')
+
+    def test_reloaded_when_changed(self):
+
+        key_cache = KeyCache()
+        with mock.patch.object(getpass, 'getpass', return_value='secret'):
+            key1 = key_cache.get(self.keyfile)
+            self.keygen()
+            os.utime(self.keyfile, (time.time() + 10, time.time() + 10))
+            key2 = key_cache.get(self.keyfile)
+
+        self.assertNotEqual(key1.get_base64(), key2.get_base64())
+
+    def test_wrong_passphrase_prompts_bounded(self):
+
+        key_cache = KeyCache()
+        with mock.patch.object(getpass, 'getpass', return_value='wrong') as prompt:
+            for i in range(5):
+                self.assertRaises(KeyLoadError, key_cache.get, self.keyfile)
+
+        self.assertEqual(prompt.call_count, KeyCache.passphrase_attempts)
+
+    def test_wrong_passphrase_not_retried_by_logins(self):
+
+        key_cache = KeyCache()
+        session_manager = SessionManager()
+        session_manager.retry_backoff = 0.01
+        logins = []
+
+        def login(term, cookie):
+            logins.append(term.node.name)
+            key_cache.get(self.keyfile)
+
+        try:
+            with mock.patch.object(getpass, 'getpass', return_value='wrong') as prompt, \
+                 mock.patch.object(SSHTerm, 'login', login):
+                for i in range(10):
+                    self.assertRaises(KeyLoadError, session_manager.connect, FakeNode('worker%d' % i), self.keyfile)
+        finally:
+            session_manager.shutdown()
+
+        self.assertEqual(len(logins), 10)
+        self.assertEqual(prompt.call_count, KeyCache.passphrase_attempts)
+
+    def test_missing_key_not_retried(self):
+
+        key_cache = KeyCache()
+        session_manager = SessionManager()
+        session_manager.retry_backoff = 0.01
+        logins = []
+        missing = os.path.join(self.tmpdir, 'nokey')
+
+        def login(term, cookie):
+            logins.append(term.node.name)
+            key_cache.get(missing)
+
+        try:
+            with mock.patch.object(SSHTerm, 'login', login):
+                self.assertRaises(KeyLoadError, session_manager.connect, FakeNode('worker1'), missing)
+        finally:
+            session_manager.shutdown()
+
+        self.assertEqual(logins, ['worker1'])
+        self.assertIn((missing, None), key_cache.failures)
+
+        # a key file that shows up later is read
+        shutil.copy(self.keyfile, missing)
+        with mock.patch.object(getpass, 'getpass', return_value='secret'):
+            self.assertTrue(key_cache.get(missing))
+
+
+class TestUtf8Boundary(unittest.TestCase):
+
+    def test_boundary(self):
+        snowman = '\u2603'.encode('utf-8')
+        self.assertEqual(utf8_boundary(b'abc'), 3)
+        self.assertEqual(utf8_boundary(b'ab' + snowman), 5)
+        self.assertEqual(utf8_boundary(b'ab' + snowman[:2]), 2)
+        self.assertEqual(utf8_boundary(b'ab' + snowman[:1]), 2)
+        self.assertEqual(utf8_boundary(b''), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,919 @@
+from dustcluster import transfer
+from dustcluster.lineterm import LineTerm
+
+import io
+import os
+import re
+import mock
+import random
+import subprocess
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+'''
+parallel transfer tests - fake sftp sessions, no network
+'''
+
+class FakeNode(object):
+
+    def __init__(self, name, index=None, id=None):
+        self.name = name
+        self.index = index
+        self.id = id
+
+    def get(self, key):
+        if key == 'id':
+            return self.id or ''
+        return self.name
+
+
+class FakeRemoteFile(io.BytesIO):
+    ''' a written remote file, stored in files on close '''
+
+    def __init__(self, files, path, delay):
+        io.BytesIO.__init__(self)
+        self.files = files
+        self.path = path
+        self.delay = delay
+        self.pipelined = False
+
+    def set_pipelined(self, pipelined=True):
+        self.pipelined = pipelined
+
+    def close(self):
+        if not self.closed:
+            time.sleep(self.delay)
+            self.files[self.path] = self.getvalue()
+        io.BytesIO.close(self)
+
+
+class FakeSFTP(object):
+    ''' copies into a dict { remote path : bytes }, slowly '''
+
+    def __init__(self, delay=0.05):
+        self.files = {}
+        self.delay = delay
+
+    def open(self, path, mode):
+        return FakeRemoteFile(self.files, path, self.delay)
+
+
+class FakeSessionManager(object):
+
+    def __init__(self):
+        self.leases = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, node, keyfile):
+        if node.name == 'broken':
+            raise Exception('no route to host')
+        with self.lock:
+            self.leases += 1
+        return node
+
+    def release(self, term):
+        with self.lock:
+            self.leases -= 1
+
+
+class RecordingProgress(transfer.Progress):
+    ''' keeps the last Progress made, so tests can check bytes per host '''
+
+    last = None
+
+    def __init__(self, op, host_totals):
+        super(RecordingProgress, self).__init__(op, host_totals)
+        RecordingProgress.last = self
+
+
+class FakeLineTerm(object):
+
+    def __init__(self):
+        self.ssh_concurrency = 32
+        self.sftp_stripes = 1
+        self.stripe_min_size = 0
+        self.session_manager = FakeSessionManager()
+        self.sftps = {}
+
+    def open_sftp(self, term):
+        return self.sftps.setdefault(term.name, FakeSFTP())
+
+
+class TestPut(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcfiles = []
+        for i in range(4):
+            path = os.path.join(self.tmpdir, 'data%d.csv' % i)
+            with open(path, 'wb') as fh:
+                fh.write(b'x' * (1000 * (i + 1)))
+            self.srcfiles.append(path)
+        self.lineterm = FakeLineTerm()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_parallel(self):
+
+        targets = [('keyfile', FakeNode('worker%d' % i)) for i in range(20)]
+        results, elapsed = transfer.put_files(self.lineterm, targets, self.srcfiles, '/opt/data/')
+
+        # 20 nodes x 4 files x 50ms serially would be 4s
+        self.assertLess(elapsed, 1.0)
+        self.assertTrue(all(result.files == 4 and result.bytes == 10000 for result in results))
+        self.assertEqual(sorted(self.lineterm.sftps['worker3'].files), ['/opt/data/data%d.csv' % i for i in range(4)])
+        self.assertEqual(self.lineterm.session_manager.leases, 0)
+
+    def test_put_errors_per_node(self):
+
+        targets = [('keyfile', FakeNode('worker1')), ('keyfile', FakeNode('broken'))]
+        results, elapsed = transfer.put_files(self.lineterm, targets, self.srcfiles)
+
+        self.assertIsNone(results[0].error)
+        self.assertEqual(results[1].error, 'no route to host')
+        self.assertIn('1 nodes failed', transfer.summary('put', results, elapsed))
+
+    def test_progress_per_target(self):
+
+        targets = [('keyfile', FakeNode('worker', str(i + 1))) for i in range(3)]
+        with mock.patch.object(transfer, 'Progress', RecordingProgress):
+            results, elapsed = transfer.put_files(self.lineterm, targets, self.srcfiles, '/opt/data/')
+
+        progress = RecordingProgress.last
+        self.assertEqual(sorted(progress.host_totals), ['worker.1', 'worker.2', 'worker.3'])
+        self.assertEqual(progress.done, dict( (host, 10000) for host in progress.host_totals ))
+        self.assertEqual(progress.hosts_done, 3)
+
+class LocalTerm(object):
+    ''' runs exec commands in a local shell in cwd, so remote paths are local paths '''
+
+    def __init__(self, name, cwd=None):
+        self.name = name
+        self.node = self
+        self.cwd = cwd
+        self.commands = []
+
+    def get(self, key):
+        return '127.0.0.1'
+
+    def exec_command(self, cmd):
+        self.commands.append(cmd)
+        proc = subprocess.run(cmd, shell=True, cwd=self.cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return io.BytesIO(proc.stdout), io.BytesIO(proc.stderr), proc.returncode
+
+
+class CountingFile(object):
+    ''' a local file opened over "sftp", counting the bytes written '''
+
+    def __init__(self, sftp, path, mode):
+        self.sftp = sftp
+        self.fh = open(path, mode if 'b' in mode else mode + 'b')
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+    def seek(self, offset):
+        self.fh.seek(offset)
+
+    def write(self, data):
+        with self.sftp.lock:
+            self.sftp.written += len(data)
+        self.fh.write(data)
+
+    def readv(self, chunks):
+        for offset, size in chunks:
+            self.fh.seek(offset)
+            yield self.fh.read(size)
+
+    def prefetch(self, size):
+        pass
+
+    def read(self, size):
+        return self.fh.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fh.close()
+
+
+class LocalSFTP(object):
+
+    def __init__(self, cwd=''):
+        self.cwd = cwd
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def stat(self, path):
+        return os.stat(os.path.join(self.cwd, path))
+
+    def open(self, path, mode):
+        return CountingFile(self, os.path.join(self.cwd, path), mode)
+
+    def truncate(self, path, size):
+        os.truncate(path, size)
+
+    def utime(self, path, times):
+        os.utime(os.path.join(self.cwd, path), times)
+
+
+class TestSingleFile(unittest.TestCase):
+    ''' LineTerm.put and LineTerm.get, one file to or from one node '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.remotedir = os.path.join(self.tmpdir, 'remote')
+        os.mkdir(self.remotedir)
+        self.srcfile = os.path.join(self.tmpdir, 'app.conf')
+        with open(self.srcfile, 'wb') as fh:
+            fh.write(b'port=8080\n' * 1000)
+
+        self.lineterm = LineTerm()
+        self.lineterm.session_manager = FakeSessionManager()
+        self.lineterm.open_sftp = lambda term: LocalSFTP()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+
+        node = FakeNode('worker1')
+        self.lineterm.put('keyfile', node, self.srcfile, self.remotedir)
+        remotefile = os.path.join(self.remotedir, 'app.conf')
+        with open(remotefile, 'rb') as fh:
+            self.assertEqual(fh.read(), b'port=8080\n' * 1000)
+
+        self.lineterm.get('keyfile', node, remotefile, self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'app.conf.worker1'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'port=8080\n' * 1000)
+        self.assertEqual(self.lineterm.session_manager.leases, 0)
+
+
+@unittest.skipUnless(shutil.which('sha256sum'), 'needs sha256sum')
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcfile = os.path.join(self.tmpdir, 'app.jar')
+        self.destfile = os.path.join(self.tmpdir, 'remote.jar')
+        rand = random.Random(42)
+        self.data = bytes(rand.getrandbits(8) for i in range(100000))
+        with open(self.srcfile, 'wb') as fh:
+            fh.write(self.data)
+
+        self.term = LocalTerm('worker1')
+        self.sftp = LocalSFTP()
+        self.lineterm = FakeLineTerm()
+        self.lineterm.session_manager.acquire = lambda node, keyfile: self.term
+        self.lineterm.open_sftp = lambda term: self.sftp
+
+        self.blocksize = transfer.delta_blocksize
+        transfer.delta_blocksize = 4096
+
+    def tearDown(self):
+        transfer.delta_blocksize = self.blocksize
+        shutil.rmtree(self.tmpdir)
+
+    def remote(self, data=None):
+        if data is not None:
+            with open(self.destfile, 'wb') as fh:
+                fh.write(data)
+        with open(self.destfile, 'rb') as fh:
+            return fh.read()
+
+    def update(self, delta=False):
+        return transfer.update_file(self.term, self.sftp, self.srcfile, self.destfile, transfer.LocalDigests(), delta)
+
+    def test_missing_file_uploaded(self):
+        self.assertEqual(self.update(), len(self.data))
+        self.assertEqual(self.remote(), self.data)
+
+    def test_unchanged_file_skipped(self):
+        self.remote(self.data)
+        self.assertEqual(self.update(), 0)
+        self.assertEqual(self.sftp.written, 0)
+
+    def test_partial_upload_resumed(self):
+        self.remote(self.data[:30000])
+        self.assertEqual(self.update(), 70000)
+        self.assertEqual(self.remote(), self.data)
+
+    def test_delta_sends_changed_blocks(self):
+        changed = bytearray(self.data)
+        changed[50000] ^= 0xff
+        self.remote(bytes(changed) + b'trailing junk')
+
+        # the changed block, and the last block which the junk makes longer
+        sent = self.update(delta=True)
+        self.assertEqual(sent, 4096 + len(self.data) % 4096)
+        self.assertEqual(self.remote(), self.data)
+
+    def test_changed_file_resent_without_delta(self):
+        self.remote(b'something else')
+        self.assertEqual(self.update(), len(self.data))
+        self.assertEqual(self.remote(), self.data)
+
+    def test_put_files_summary(self):
+        destdir = os.path.join(self.tmpdir, 'remote')
+        os.makedirs(destdir)
+        with open(os.path.join(destdir, 'app.jar'), 'wb') as fh:
+            fh.write(self.data)
+
+        results, elapsed = transfer.put_files(self.lineterm, [('keyfile', FakeNode('worker1'))], [self.srcfile], destdir, update=True)
+        self.assertEqual((results[0].skipped, results[0].sent, results[0].bytes), (1, 0, len(self.data)))
+        self.assertIn('1 files up to date', transfer.summary('put', results, elapsed))
+
+
+@unittest.skipUnless(shutil.which('sha256sum'), 'needs sha256sum')
+class TestStriped(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcfile = os.path.join(self.tmpdir, 'dataset.bin')
+        self.data = os.urandom(1000000)
+        with open(self.srcfile, 'wb') as fh:
+            fh.write(self.data)
+        self.sftps = [LocalSFTP() for i in range(3)]
+
+        self.piece = transfer.stripe_piece
+        transfer.stripe_piece = 65536
+
+    def tearDown(self):
+        transfer.stripe_piece = self.piece
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def test_striped_upload(self):
+        destfile = os.path.join(self.tmpdir, 'remote.bin')
+        self.assertEqual(transfer.striped_upload(self.sftps, self.srcfile, destfile), len(self.data))
+        self.assertEqual(self.read(destfile), self.data)
+        self.assertEqual(sum(sftp.written for sftp in self.sftps), len(self.data))
+
+    def test_striped_download(self):
+        localfile = os.path.join(self.tmpdir, 'local.bin')
+        progress = []
+        transfer.striped_download(self.sftps, self.srcfile, localfile, len(self.data), lambda done, total: progress.append(done))
+        self.assertEqual(self.read(localfile), self.data)
+        self.assertEqual(max(progress), len(self.data))
+
+    def test_put_files_striped_and_verified(self):
+
+        node = LocalTerm('worker1', self.tmpdir)
+        lineterm = FakeLineTerm()
+        lineterm.sftp_stripes = 3
+        lineterm.session_manager.acquire = lambda node, keyfile: node
+        lineterm.open_sftp = lambda term: LocalSFTP(self.tmpdir)
+        lineterm.open_stripes = lambda term, keyfile: ([LocalSFTP(self.tmpdir) for i in range(3)], [])
+        lineterm.close_stripes = lambda sftps, terms: closed.append(len(sftps))
+        closed = []
+        os.makedirs(os.path.join(self.tmpdir, 'remote'))
+
+        results, elapsed = transfer.put_files(lineterm, [('keyfile', node)], [self.srcfile], 'remote')
+        self.assertIsNone(results[0].error)
+        self.assertEqual(self.read(os.path.join(self.tmpdir, 'remote', 'dataset.bin')), self.data)
+        self.assertTrue(any('sha256sum' in cmd for cmd in node.commands))
+        self.assertEqual(closed, [3])
+
+
+@unittest.skipUnless(shutil.which('sha256sum') and shutil.which('python3'), 'needs sha256sum and python3')
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcfile = os.path.join(self.tmpdir, 'dataset.bin')
+        self.data = os.urandom(300000)
+        with open(self.srcfile, 'wb') as fh:
+            fh.write(self.data)
+
+        # every node is a directory on this host
+        self.nodes = []
+        for i in range(7):
+            root = os.path.join(self.tmpdir, 'worker%d' % i)
+            os.makedirs(root)
+            self.nodes.append(LocalTerm('worker%d' % i, root))
+
+        self.lineterm = FakeLineTerm()
+        self.lineterm.session_manager.acquire = lambda node, keyfile: node
+        self.sftps = dict( (node.name, LocalSFTP(node.cwd)) for node in self.nodes )
+        self.lineterm.open_sftp = lambda term: self.sftps[term.name]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def broadcast(self):
+        return transfer.broadcast_files(self.lineterm, [('keyfile', node) for node in self.nodes], [self.srcfile],
+                                        seeds=1, fanout=2, timeout=5)
+
+    def test_broadcast_tree(self):
+
+        results, elapsed = self.broadcast()
+
+        self.assertTrue(all(result.error is None and result.files == 1 for result in results))
+        for node in self.nodes:
+            with open(os.path.join(node.cwd, 'dataset.bin'), 'rb') as fh:
+                self.assertEqual(fh.read(), self.data)
+
+        # only the seed was sent the file from here
+        self.assertEqual(sum(result.sent for result in results), len(self.data))
+        self.assertEqual(sum(sftp.written for sftp in self.sftps.values()), len(self.data))
+        self.assertIn('saved', transfer.summary('put', results, elapsed))
+
+    def test_shared_names(self):
+
+        for node in self.nodes:
+            node.name = 'worker'
+        self.lineterm.open_sftp = lambda term: LocalSFTP(term.cwd)
+
+        results, elapsed = self.broadcast()
+
+        self.assertEqual([result.node for result in results], self.nodes)
+        self.assertTrue(all(result.error is None and result.files == 1 for result in results))
+        for node in self.nodes:
+            with open(os.path.join(node.cwd, 'dataset.bin'), 'rb') as fh:
+                self.assertEqual(fh.read(), self.data)
+        self.assertEqual(sum(result.sent for result in results), len(self.data))
+
+    def test_failed_pull_uploaded_directly(self):
+
+        broken = self.nodes[3]
+        run = broken.exec_command
+        broken.exec_command = lambda cmd: run('false') if 'create_connection' in cmd else run(cmd)
+
+        results, elapsed = self.broadcast()
+
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(results[3].sent, len(self.data))
+        with open(os.path.join(broken.cwd, 'dataset.bin'), 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_corrupt_seed_upload(self):
+
+        # the seed's copy loses a byte per write, it must not be served to peers
+        seed = self.sftps['worker0']
+        open_file = seed.open
+        def corrupt(path, mode):
+            fr = open_file(path, mode)
+            write = fr.write
+            fr.write = lambda data: write(data[:-1])
+            return fr
+        seed.open = corrupt
+
+        results, elapsed = self.broadcast()
+
+        self.assertIn('checksum mismatch', results[0].error)
+        self.assertTrue(all(result.error is None and result.files == 1 for result in results[1:]))
+        for node in self.nodes[1:]:
+            with open(os.path.join(node.cwd, 'dataset.bin'), 'rb') as fh:
+                self.assertEqual(fh.read(), self.data)
+
+
+class FakeS3(object):
+    ''' a bucket in a local directory, presigned urls are file:// urls '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def upload_file(self, srcfile, bucket, key):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copy(srcfile, path)
+
+    def generate_presigned_url(self, op, Params, ExpiresIn):
+        return 'file://' + os.path.join(self.root, Params['Key'])
+
+    def delete_object(self, Bucket, Key):
+        os.remove(os.path.join(self.root, Key))
+
+
+class ExecAllTerm(FakeLineTerm):
+    ''' exec_all over LocalTerms '''
+
+    def exec_all(self, targets, cmd):
+        ret = []
+        for keyfile, node in targets:
+            out, err, exit_status = node.exec_command(cmd)
+            ret.append(type('ExecResult', (object,), { 'stdout' : out.getvalue().decode(), 'stderr' : err.getvalue().decode(),
+                                                       'exit_status' : exit_status, 'ok' : exit_status == 0,
+                                                       'error' : None, 'elapsed' : 0.1 })())
+        return ret
+
+
+@unittest.skipUnless(shutil.which('curl') and shutil.which('sha256sum'), 'needs curl and sha256sum')
+class TestStaged(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcfile = os.path.join(self.tmpdir, 'model.bin')
+        self.data = os.urandom(200000)
+        with open(self.srcfile, 'wb') as fh:
+            fh.write(self.data)
+        self.nodes = []
+        for i in range(3):
+            root = os.path.join(self.tmpdir, 'worker%d' % i)
+            os.makedirs(root)
+            self.nodes.append(LocalTerm('worker%d' % i, root))
+        self.targets = [('keyfile', node) for node in self.nodes]
+        self.bucket = os.path.join(self.tmpdir, 'bucket')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_staged_put(self):
+
+        results, elapsed = transfer.stage_files(ExecAllTerm(), self.targets, [self.srcfile], FakeS3(self.bucket), 'bucket')
+
+        self.assertTrue(all(result.error is None and result.bytes == len(self.data) for result in results))
+        for node in self.nodes:
+            with open(os.path.join(node.cwd, 'model.bin'), 'rb') as fh:
+                self.assertEqual(fh.read(), self.data)
+
+        # staged objects are cleaned up
+        self.assertEqual([files for root, dirs, files in os.walk(self.bucket) if files], [])
+
+    def test_checksum_mismatch(self):
+
+        lineterm = ExecAllTerm()
+        run = self.nodes[1].exec_command
+        self.nodes[1].exec_command = lambda cmd: run(cmd.replace('&& sha256sum', '&& echo x >> model.bin && sha256sum'))
+
+        results, elapsed = transfer.stage_files(lineterm, self.targets, [self.srcfile], FakeS3(self.bucket), 'bucket')
+        self.assertEqual([result.error for result in results], [None, 'checksum mismatch after download', None])
+
+
+@unittest.skipUnless(mock_aws, 'needs moto')
+class TestStagedMoto(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcfile = os.path.join(self.tmpdir, 'model.bin')
+        with open(self.srcfile, 'wb') as fh:
+            fh.write(os.urandom(100000))
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id='x', aws_secret_access_key='x')
+        self.s3.create_bucket(Bucket='staging')
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_staged_through_s3(self):
+
+        import requests
+
+        class PullTerm(FakeLineTerm):
+            ''' fetches the presigned urls in process, where moto intercepts them '''
+            def exec_all(inner, targets, cmd):
+                ret = []
+                for keyfile, node in targets:
+                    data = requests.get(re.search("'(https?://[^']+)'", cmd).group(1)).content
+                    ret.append(type('ExecResult', (object,), { 'stdout' : transfer.hashlib.sha256(data).hexdigest() + '  model.bin\n',
+                                                               'stderr' : '', 'exit_status' : 0, 'ok' : True,
+                                                               'error' : None, 'elapsed' : 0.1 })())
+                return ret
+
+        results, elapsed = transfer.stage_files(PullTerm(), [('keyfile', FakeNode('worker1'))], [self.srcfile], self.s3, 'staging')
+
+        self.assertIsNone(results[0].error)
+        self.assertNotIn('Contents', self.s3.list_objects_v2(Bucket='staging'))
+
+
+class ProcChannel(object):
+    ''' an exec channel that is a local shell process '''
+
+    def __init__(self, cmd, cwd, delay=0):
+        self.proc = subprocess.Popen(cmd, shell=True, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.delay = delay
+        self.err = None
+
+    def sendall(self, data):
+        time.sleep(self.delay)
+        self.proc.stdin.write(data)
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def recv(self, n):
+        return self.proc.stdout.read1(n)
+
+    def recv_exit_status(self):
+        self.err = io.BytesIO(self.proc.stderr.read())
+        return self.proc.wait()
+
+    def recv_stderr(self, n):
+        return self.err.read(n)
+
+    def close(self):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+class TarTerm(LocalTerm):
+
+    delay = 0
+
+    def exec_channel(self, cmd):
+        return ProcChannel(cmd, self.cwd, self.delay)
+
+
+@unittest.skipUnless(shutil.which('tar'), 'needs tar')
+class TestPutTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        for i in range(200):
+            path = os.path.join(self.srcdir, 'pkg%d' % (i % 10), 'mod%d.py' % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fh:
+                fh.write('x = %d\n' % i * 50)
+
+        self.nodes = []
+        for i in range(4):
+            root = os.path.join(self.tmpdir, 'worker%d' % i)
+            os.makedirs(root)
+            self.nodes.append(TarTerm('worker%d' % i, root))
+
+        self.lineterm = FakeLineTerm()
+        self.lineterm.session_manager.acquire = lambda node, keyfile: node
+        self.targets = [('keyfile', node) for node in self.nodes]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, node, destdir):
+        with open(os.path.join(node.cwd, destdir, 'src', 'pkg3', 'mod13.py')) as fh:
+            self.assertEqual(fh.read(), 'x = 13\n' * 50)
+        self.assertEqual(sum(len(files) for root, dirs, files in os.walk(os.path.join(node.cwd, destdir))), 200)
+
+    def test_put_tree(self):
+        results, elapsed = transfer.put_tree(self.lineterm, self.targets, self.srcdir, 'opt/app')
+        self.assertTrue(all(result.error is None and result.files == 200 for result in results))
+        for node in self.nodes:
+            self.check(node, 'opt/app')
+
+    def test_put_tree_compressed(self):
+        results, elapsed = transfer.put_tree(self.lineterm, self.targets, self.srcdir, compress=True)
+        self.assertTrue(all(result.sent < result.bytes for result in results))
+        for node in self.nodes:
+            self.check(node, '.')
+
+    def test_shared_names(self):
+        for node in self.nodes:
+            node.name = 'worker'
+        results, elapsed = transfer.put_tree(self.lineterm, self.targets, self.srcdir)
+        self.assertEqual([result.node for result in results], self.nodes)
+        self.assertTrue(all(result.error is None for result in results))
+        for node in self.nodes:
+            self.check(node, '.')
+
+    def test_failed_node_does_not_stall_others(self):
+        broken = self.nodes[2]
+        broken.exec_channel = lambda cmd: ProcChannel('exit 3', broken.cwd)
+
+        results, elapsed = transfer.put_tree(self.lineterm, self.targets, self.srcdir, depth=2)
+        self.assertEqual([result.error is None for result in results], [True, True, False, True])
+        self.check(self.nodes[3], '.')
+
+
+@unittest.skipUnless(shutil.which('sha256sum') and shutil.which('find'), 'needs sha256sum and find')
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.localdir = os.path.join(self.tmpdir, 'app')
+        for rel in ['main.py', 'lib/util.py', 'lib/deep/data file.txt']:
+            self.write(os.path.join(self.localdir, rel), rel * 100)
+
+        self.nodes = []
+        for i in range(3):
+            root = os.path.join(self.tmpdir, 'worker%d' % i)
+            os.makedirs(root)
+            self.nodes.append(LocalTerm('worker%d' % i, root))
+
+        self.lineterm = FakeLineTerm()
+        self.lineterm.session_manager.acquire = lambda node, keyfile: node
+        self.sftps = dict( (node.name, LocalSFTP(node.cwd)) for node in self.nodes )
+        self.lineterm.open_sftp = lambda term: self.sftps[term.name]
+        self.targets = [('keyfile', node) for node in self.nodes]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write(text)
+
+    def sync(self, delete=False):
+        for sftp in self.sftps.values():
+            sftp.written = 0
+        results, elapsed = transfer.sync_files(self.lineterm, self.targets, self.localdir, 'opt/app', delete)
+        self.assertTrue(all(result.error is None for result in results))
+        return results
+
+    def test_only_changes_sent(self):
+
+        self.sync()
+        for node in self.nodes:
+            with open(os.path.join(node.cwd, 'opt/app/lib/deep/data file.txt')) as fh:
+                self.assertEqual(fh.read(), 'lib/deep/data file.txt' * 100)
+
+        results = self.sync()
+        self.assertEqual(sum(sftp.written for sftp in self.sftps.values()), 0)
+        self.assertEqual(results[0].skipped, 3)
+
+        self.write(os.path.join(self.localdir, 'lib/util.py'), 'changed')
+        self.write(os.path.join(self.localdir, 'lib/new.py'), 'new')
+        results = self.sync()
+        self.assertEqual([sftp.written for sftp in self.sftps.values()], [len('changed') + len('new')] * 3)
+
+    def test_shared_names(self):
+
+        for node in self.nodes:
+            node.name = 'worker'
+        self.lineterm.open_sftp = lambda term: LocalSFTP(term.cwd)
+
+        with mock.patch.object(transfer, 'Progress', RecordingProgress):
+            results = self.sync()
+
+        progress = RecordingProgress.last
+        total = sum(len(rel) * 100 for rel in ['main.py', 'lib/util.py', 'lib/deep/data file.txt'])
+        self.assertEqual(len(progress.host_totals), 3)
+        self.assertEqual(list(progress.done.values()), [total] * 3)
+        for node in self.nodes:
+            self.assertTrue(os.path.exists(os.path.join(node.cwd, 'opt/app/main.py')))
+
+    def test_touched_file_not_resent(self):
+
+        self.sync()
+        path = os.path.join(self.localdir, 'main.py')
+        os.utime(path, (time.time() + 100, time.time() + 100))
+
+        results = self.sync()
+        self.assertEqual(sum(sftp.written for sftp in self.sftps.values()), 0)
+        remote = os.path.join(self.nodes[0].cwd, 'opt/app/main.py')
+        self.assertEqual(int(os.path.getmtime(remote)), int(os.path.getmtime(path)))
+
+    def test_delete(self):
+
+        self.sync()
+        self.write(os.path.join(self.nodes[1].cwd, 'opt/app/stale.py'), 'old')
+
+        self.sync()
+        self.assertTrue(os.path.exists(os.path.join(self.nodes[1].cwd, 'opt/app/stale.py')))
+
+        results = self.sync(delete=True)
+        self.assertFalse(os.path.exists(os.path.join(self.nodes[1].cwd, 'opt/app/stale.py')))
+        self.assertEqual([result.deleted for result in results], [0, 1, 0])
+        self.assertIn('1 files deleted', transfer.summary('sync', results, 1.0))
+
+
+class RootedSFTP(object):
+    ''' a remote filesystem under a local directory '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def local(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def listdir_attr(self, path):
+        ret = []
+        for fname in os.listdir(self.local(path)):
+            attrs = os.stat(os.path.join(self.local(path), fname))
+            attrs = type('SFTPAttributes', (object,), { 'filename' : fname, 'st_mode' : attrs.st_mode, 'st_size' : attrs.st_size })
+            ret.append(attrs)
+        return ret
+
+    def stat(self, path):
+        if not os.path.exists(self.local(path)):
+            raise IOError('no such file')
+        return os.stat(self.local(path))
+
+    def open(self, path, mode):
+        fh = open(self.local(path), mode)
+        return type('SFTPFile', (object,), { 'prefetch' : lambda self, size: None, 'read' : lambda self, n: fh.read(n),
+                                             '__enter__' : lambda self: self, '__exit__' : lambda self, *args: fh.close() })()
+
+
+class TestGet(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = tempfile.mkdtemp()
+        self.localdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.remote, 'var/log'))
+        for fname in ['syslog.log', 'auth.log', '.hidden.log', 'notes.txt']:
+            with open(os.path.join(self.remote, 'var/log', fname), 'w') as fh:
+                fh.write(fname)
+
+        self.lineterm = FakeLineTerm()
+        self.lineterm.open_sftp = lambda term: RootedSFTP(self.remote)
+        self.targets = [('keyfile', FakeNode('worker%d' % i)) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.remote)
+        shutil.rmtree(self.localdir)
+
+    def test_remote_glob(self):
+        sftp = RootedSFTP(self.remote)
+        self.assertEqual([path for path, size in transfer.remote_glob(sftp, '/var/log/*.log')],
+                         ['/var/log/auth.log', '/var/log/syslog.log'])
+        self.assertEqual(len(transfer.remote_glob(sftp, '/v*/*/notes.txt')), 1)
+        self.assertEqual(transfer.remote_glob(sftp, '/var/nothing/*'), [])
+
+    def test_get_flat(self):
+        results, elapsed = transfer.get_files(self.lineterm, self.targets, '/var/log/syslog.log', self.localdir)
+        self.assertTrue(all(result.files == 1 for result in results))
+        self.assertEqual(sorted(os.listdir(self.localdir)), ['syslog.log.worker%d' % i for i in range(3)])
+
+    def test_get_per_host_dirs(self):
+        results, elapsed = transfer.get_files(self.lineterm, self.targets, '/var/log/*.log', self.localdir, per_host_dirs=True)
+        self.assertTrue(all(result.files == 2 for result in results))
+        self.assertTrue(os.path.isfile(os.path.join(self.localdir, 'worker2', 'var', 'log', 'auth.log')))
+
+    def test_host_labels(self):
+        nodes = [FakeNode('master', '1'), FakeNode('worker', '2'), FakeNode('worker', '3'), FakeNode('', '4', 'i-0abc'),
+                 FakeNode('', None, None)]
+        self.assertEqual(transfer.host_labels(nodes), ['master', 'worker.2', 'worker.3', 'i-0abc', 'node.5'])
+
+    def test_get_shared_names(self):
+        targets = [('keyfile', FakeNode('worker', str(i))) for i in range(3)] + [('keyfile', FakeNode('', '9', 'i-0abc'))]
+        results, elapsed = transfer.get_files(self.lineterm, targets, '/var/log/syslog.log', self.localdir)
+        self.assertTrue(all(result.files == 1 for result in results))
+        self.assertEqual(sorted(os.listdir(self.localdir)), ['syslog.log.i-0abc'] + ['syslog.log.worker.%d' % i for i in range(3)])
+
+        results, elapsed = transfer.get_files(self.lineterm, targets, '/var/log/syslog.log', self.localdir, per_host_dirs=True)
+        self.assertTrue(os.path.isfile(os.path.join(self.localdir, 'worker.1', 'var', 'log', 'syslog.log')))
+
+    def test_get_no_match(self):
+        results, elapsed = transfer.get_files(self.lineterm, self.targets, '/var/log/*.gz', self.localdir)
+        self.assertTrue(all(result.error for result in results))
+
+@unittest.skipUnless(shutil.which('gzip'), 'needs gzip')
+class TestCompressedGet(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = tempfile.mkdtemp()
+        self.localdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.remote, 'var/log'))
+        self.text = ''.join('%d GET /index.html 200\n' % i for i in range(20000))
+        for fname in ['syslog.log', 'auth.log']:
+            with open(os.path.join(self.remote, 'var/log', fname), 'w') as fh:
+                fh.write(self.text)
+
+        self.lineterm = FakeLineTerm()
+        self.lineterm.session_manager.acquire = lambda node, keyfile: node
+        self.lineterm.open_sftp = lambda term: RootedSFTP(self.remote)
+        self.targets = [('keyfile', TarTerm('worker%d' % i, self.remote)) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.remote)
+        shutil.rmtree(self.localdir)
+
+    def test_get_compressed(self):
+
+        results, elapsed = transfer.get_files(self.lineterm, self.targets, 'var/log/*.log', self.localdir, compressed=True)
+
+        self.assertTrue(all(result.error is None and result.files == 2 for result in results))
+        self.assertTrue(all(result.sent * 5 < result.bytes for result in results))
+        self.assertEqual(len(os.listdir(self.localdir)), 6)
+        with open(os.path.join(self.localdir, 'auth.log.worker1')) as fh:
+            self.assertEqual(fh.read(), self.text)
+        self.assertIn('received', transfer.summary('get', results, elapsed))
+
+    def test_get_keep_compressed(self):
+
+        results, elapsed = transfer.get_files(self.lineterm, self.targets, 'var/log/syslog.log', self.localdir,
+                                              compressed=True, keep_compressed=True)
+        self.assertTrue(all(result.error is None for result in results))
+        ext = '.zst' if shutil.which('zstd') else '.gz'
+        self.assertEqual(sorted(os.listdir(self.localdir)), ['syslog.log.worker%d%s' % (i, ext) for i in range(3)])
+
+    def test_missing_compressor(self):
+
+        node = self.targets[0][1]
+        node.exec_channel = lambda cmd: ProcChannel('exit 127', self.remote)
+        results, elapsed = transfer.get_files(self.lineterm, self.targets[:1], 'var/log/syslog.log', self.localdir, compressed=True)
+        self.assertIn('could not compress', results[0].error)
+        self.assertEqual(os.listdir(self.localdir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
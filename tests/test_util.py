@@ -0,0 +1,56 @@
+from dustcluster.util import compact_hostlist
+from dustcluster.lineterm import ExecResult
+from dustcluster.commands.atssh import show_aggregated
+
+import io
+import mock
+import logging
+import unittest
+
+class TestCompactHostlist(unittest.TestCase):
+
+    def test_ranges(self):
+        names = ['worker%d' % i for i in range(1, 41)] + ['worker42']
+        self.assertEqual(compact_hostlist(names), 'worker[1-40,42]')
+
+    def test_mixed(self):
+        names = ['worker3', 'master', 'worker1', 'worker2', 'db7']
+        self.assertEqual(compact_hostlist(names), 'master,db7,worker[1-3]')
+
+    def test_zero_padded(self):
+        self.assertEqual(compact_hostlist(['node01', 'node02', 'node03']), 'node[01-03]')
+        self.assertEqual(compact_hostlist(['w10', 'w08', 'w11', 'w09']), 'w[08-11]')
+        self.assertEqual(compact_hostlist(['w098', 'w099', 'w100', 'w7']), 'w[7,098-100]')
+
+    def test_duplicates_kept(self):
+        self.assertEqual(compact_hostlist(['web', 'web', 'db1', 'db1', 'db2']), 'web,web,db[1,1-2]')
+        self.assertEqual(compact_hostlist(['web.1', 'web.2', 'web.3']), 'web.[1-3]')
+
+class FakeNode(object):
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+    def get(self, key):
+        return 'i-%s' % self.index if key == 'id' else self.name
+
+
+class TestShowAggregated(unittest.TestCase):
+
+    def test_shared_names_labelled(self):
+
+        results = []
+        for i, name in enumerate(['web', 'web', 'db1']):
+            result = ExecResult(FakeNode(name, str(i + 1)), 'uptime')
+            result.stdout, result.exit_status, result.digest = 'up\n', 0, 'same'
+            results.append(result)
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            show_aggregated(results, logging.getLogger('test'))
+
+        self.assertIn('db1,web.[1-2] (3)', stdout.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()